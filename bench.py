@@ -0,0 +1,442 @@
+'''Benchmarks for the replay memories, the LM task, the models and full training turns.
+
+Flags after -- are passed to main.py's parser to configure the models and task, e.g.
+
+    python bench.py --save base.json -- --batch_size 64
+    python bench.py --compare base.json --filter 'disc|actor' -- --batch_size 64
+
+Results are written as JSON. With --compare, benchmarks whose median time is more than --tolerance
+slower than in the baseline file are reported, and the exit status is 1 if there are any.
+
+--checkpoint_memory runs the disc action costs benchmark in a fresh process for each sequence
+length and disc checkpoint segment length, and reports its time and peak memory:
+
+    python bench.py --checkpoint_memory 8,32,128 --checkpoint_segments 0,1,8 -- --batch_size 64
+
+--precision_ab trains each of the given tasks in float32 and with --bf16 1 from the same seed,
+and compares the turn times and the progress of training (the train Wdist, when the task was
+solved, and the held-out evaluation after the last turn):
+
+    python bench.py --precision_ab longterm,lm --ab_iters 500 -- --threads 8
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import contextlib
+import copy
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+import main
+import util
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name):
+    '''Register a benchmark. The decorated function takes (opt, bopt) and returns either a function
+       to time, or a list of seconds that it measured itself.'''
+    def decorator(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return decorator
+
+
+def synchronize(opt):
+    if opt.cuda:
+        torch.cuda.synchronize()
+
+
+def time_fn(fn, opt, bopt):
+    for _ in range(bopt.warmup):
+        fn()
+    times = []
+    deadline = time.time() + bopt.max_seconds
+    for _ in range(bopt.repeat):
+        synchronize(opt)
+        start = time.time()
+        fn()
+        synchronize(opt)
+        times.append(time.time() - start)
+        if time.time() > deadline:
+            break
+    return times
+
+
+def replay_benchmarks(cls_name, make):
+    for scale in [1, 10]:
+        def push(opt, bopt, scale=scale):
+            memory = make(opt, scale)
+            rows = np.random.randint(0, opt.vocab_size, size=(opt.batch_size, opt.seq_len))
+            return lambda: memory.push(rows)
+
+        def sample(opt, bopt, scale=scale):
+            memory = make(opt, scale)
+            rows = np.random.randint(0, opt.vocab_size, size=(memory.capacity, opt.seq_len))
+            memory.push(rows)
+            return lambda: memory.sample(opt.batch_size)
+        benchmark('replay/%s/push/x%d' % (cls_name, scale))(push)
+        benchmark('replay/%s/sample/x%d' % (cls_name, scale))(sample)
+
+
+replay_benchmarks('uniform', lambda opt, scale: util.ReplayMemory(scale * opt.replay_size))
+replay_benchmarks('exponential', lambda opt, scale: util.ExponentialReplayMemory(
+    scale * opt.replay_size, scale * opt.replay_size_half))
+replay_benchmarks('indexed', lambda opt, scale: util.ReplayMemory(scale * opt.replay_size,
+                                                                 index=True))
+
+
+def lm_opt(opt):
+    opt = copy.copy(opt)
+    opt.task = 'lm'
+    return opt
+
+
+@benchmark('lm/init/nocache')
+def lm_init_nocache(opt, bopt):
+    opt = lm_opt(opt)
+    opt.lm_cache = 0
+    return lambda: main.make_task(copy.copy(opt))
+
+
+@benchmark('lm/init/cache')
+def lm_init_cache(opt, bopt):
+    opt = lm_opt(opt)
+    opt.lm_cache = 1
+    main.make_task(copy.copy(opt))  # make sure the cache exists
+    return lambda: main.make_task(copy.copy(opt))
+
+
+@benchmark('lm/get_data')
+def lm_get_data(opt, bopt):
+    task = main.make_task(lm_opt(opt))
+    return lambda: task.get_data(opt.batch_size)
+
+
+@benchmark('lm/quality')
+def lm_quality(opt, bopt):
+    '''n-gram metrics of a batch of eval size, with the index already built'''
+    task = main.make_task(lm_opt(opt))
+    task.ngram_index()
+    samples = np.random.randint(0, opt.vocab_size, size=(opt.eval_samples, opt.seq_len))
+    return lambda: task.quality(samples)
+
+
+def model(cls, opt):
+    net = cls(opt)
+    if opt.cuda:
+        net.cuda()
+    return net
+
+
+def random_batch(opt):
+    batch = np.random.randint(0, opt.vocab_size, size=(opt.batch_size, opt.seq_len))
+    return util.maybe_cuda(torch.from_numpy(batch), opt.cuda)
+
+
+@benchmark('actor/forward')
+def actor_forward(opt, bopt):
+    actor = model(main.Actor, opt)
+    return lambda: actor()
+
+
+@benchmark('actor/forward_backward')
+def actor_forward_backward(opt, bopt):
+    '''Sampling and backward through the log probabilities and entropies, as in an actor update'''
+    actor = model(main.Actor, opt)
+
+    def fn():
+        actor.zero_grad()
+        _, logprobs, entropies, _ = actor()
+        (logprobs.sum() - opt.entropy_reg * entropies.sum()).backward()
+    return fn
+
+
+@benchmark('disc/forward')
+def disc_forward(opt, bopt):
+    disc = model(main.Discriminator, opt)
+    real = random_batch(opt)
+    return lambda: disc(real)
+
+
+@benchmark('disc/action_costs')
+def disc_action_costs(opt, bopt):
+    '''Forward and backward of the costs of the taken actions, as in disc and actor updates'''
+    disc = model(main.Discriminator, opt)
+    real = random_batch(opt)
+
+    def fn():
+        disc.zero_grad()
+        disc.action_costs(real).sum().backward()
+    return fn
+
+
+@benchmark('disc/forward_gp')
+def disc_forward_gp(opt, bopt):
+    '''The gradient penalty step: forward on interpolated inputs, double backward'''
+    disc = model(main.Discriminator, opt)
+    real = random_batch(opt)
+    fake = random_batch(opt)
+
+    def fn():
+        disc.zero_grad()
+        main.gradient_penalty(opt, disc, real, fake).backward()
+    return fn
+
+
+@benchmark('critic/forward')
+def critic_forward(opt, bopt):
+    critic = model(main.Critic, opt)
+    real = random_batch(opt)
+    return lambda: critic(real)
+
+
+@benchmark('train/turn')
+def train_turn(opt, bopt):
+    '''Full disc + actor turns of main.train, excluding the first turn and setup'''
+    opt = copy.copy(opt)
+    opt.name = 'bench'
+    opt.niter = bopt.warmup + bopt.repeat + 1
+    opt.burnin = 0
+    opt.save_every = -1
+    opt.print_every = opt.niter + 1
+    opt.gen_every = opt.niter + 1
+    opt.solved_threshold = opt.niter + 1
+    ends = []
+
+    def callback(cur_iter, stats):
+        synchronize(opt)
+        ends.append(time.time())
+    with quiet():
+        main.train(opt, main.make_task(opt), callback)
+    return list(np.diff(ends)[bopt.warmup:])
+
+
+@contextlib.contextmanager
+def quiet():
+    '''Discard the output of training'''
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def summarize(times):
+    times = np.array(times)
+    return collections.OrderedDict([('median', float(np.median(times))),
+                                    ('mean', float(times.mean())),
+                                    ('min', float(times.min())),
+                                    ('runs', len(times))])
+
+
+def compare(results, baseline, tolerance):
+    '''Print the change against the baseline results. Returns the names of regressed benchmarks.'''
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['median'] / max(baseline[name]['median'], 1e-12)
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-40s %10.3f ms -> %10.3f ms  %+6.1f%%%s' %
+              (name, 1e3 * baseline[name]['median'], 1e3 * result['median'],
+               100 * (ratio - 1), flag))
+    return regressions
+
+
+def peak_memory_mb(opt):
+    '''Peak memory of the process so far: resident memory on CPU, allocated memory on GPU'''
+    if opt.cuda:
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10  # KB on Linux
+
+
+def checkpoint_memory_sweep(bopt, main_args):
+    '''Time the forward and backward of the disc action costs, as in the disc updates, and
+       measure their peak memory, in a fresh process per config. The memory of a process with the
+       same sequence length that runs no benchmarks is subtracted.'''
+    def run(bench_filter, extra_args):
+        with tempfile.NamedTemporaryFile(suffix='.json') as f:
+            subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                                   '--filter', bench_filter, '--save', f.name,
+                                   '--warmup', str(bopt.warmup), '--repeat', str(bopt.repeat),
+                                   '--max_seconds', str(bopt.max_seconds), '--'] +
+                                  main_args + extra_args, stdout=open(os.devnull, 'w'))
+            with open(f.name, 'r') as saved:
+                return json.load(saved)
+    print('%8s %8s %12s %12s' % ('seq_len', 'segment', 'median ms', 'peak MB'))
+    for seq_len in bopt.checkpoint_memory.split(','):
+        base_mb = run('^$', ['--seq_len', seq_len])['meta']['peak_memory_mb']
+        for segment in bopt.checkpoint_segments.split(','):
+            output = run('^disc/action_costs$',
+                         ['--seq_len', seq_len, '--disc_checkpoint', segment])
+            result = output['results']['disc/action_costs']
+            print('%8s %8s %12.3f %12.1f' % (seq_len, segment, 1e3 * result['median'],
+                                             output['meta']['peak_memory_mb'] - base_mb))
+
+
+def precision_ab(bopt, main_args):
+    '''Train each task of bopt.precision_ab for bopt.ab_iters turns in float32 and with bfloat16
+       autocast, from the same seed. Returns a row of results per run.'''
+    rows = []
+    for task_name in bopt.precision_ab.split(','):
+        for bf16 in [0, 1]:
+            opt = main.get_parser().parse_args(['--cuda', '0'] + main_args +
+                                               ['--task', task_name, '--bf16', str(bf16)])
+            opt.name = 'bench-%s-%s' % (task_name, 'bf16' if bf16 else 'fp32')
+            opt.niter = bopt.ab_iters
+            opt.save_every = -1
+            opt.print_every = opt.niter + 1
+            opt.gen_every = opt.niter + 1
+            opt.eval_every = max(opt.niter - 1, 1)  # the first and the last turn
+            opt.eval_process = 0
+            opt.live_plot = 0
+            opt.eval_batches = opt.eval_batches or 10
+            opt.seed = max(opt.seed, 0)
+            if opt.threads > 0:
+                torch.set_num_threads(opt.threads)
+            np.random.seed(opt.seed)
+            torch.manual_seed(opt.seed)
+            ends = []
+            turns = []
+
+            def callback(cur_iter, stats):
+                ends.append(time.time())
+                turns.append(stats)
+            with quiet():
+                stats = main.train(opt, main.make_task(opt), callback)
+            evals = [r for r in util.read_metrics(opt.save + '/metrics.jsonl')
+                     if 'eval_Wdist' in r]
+            row = collections.OrderedDict([
+                ('task', task_name), ('precision', 'bf16' if bf16 else 'fp32'),
+                ('turn_ms', 1e3 * float(np.median(np.diff(ends)))),
+                ('turns', len(turns)),
+                ('Wdist', float(np.mean([t['Wdist'] for t in turns[-10:]]))),
+                ('solved_iter', turns[-1]['iter'] if stats['task_solved'] else -1)])
+            if evals:
+                for key, value in sorted(evals[-1].items()):
+                    if key.startswith('eval_') and isinstance(value, float):
+                        row[key] = value
+            rows.append(row)
+    return rows
+
+
+def print_ab(rows):
+    fp32_ms = {r['task']: r['turn_ms'] for r in rows if r['precision'] == 'fp32'}
+    print('%-10s %-9s %10s %8s %8s %10s %12s %12s' % ('task', 'precision', 'turn ms', 'speedup',
+                                                      'turns', 'Wdist', 'solved iter',
+                                                      'eval Wdist'))
+    for r in rows:
+        print('%-10s %-9s %10.2f %7.2fx %8d %10.4f %12d %12.4f' %
+              (r['task'], r['precision'], r['turn_ms'], fp32_ms[r['task']] / r['turn_ms'],
+               r['turns'], r['Wdist'], r['solved_iter'], r.get('eval_Wdist', float('nan'))))
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if '--' in argv:
+        main_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    else:
+        main_args = []
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filter', type=str, default='', help='regex of benchmarks to run')
+    parser.add_argument('--list', type=int, default=0, help='list the benchmarks and exit')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed runs per benchmark')
+    parser.add_argument('--repeat', type=int, default=20, help='timed runs per benchmark')
+    parser.add_argument('--max_seconds', type=float, default=30,
+                        help='stop timing a benchmark after about these many seconds')
+    parser.add_argument('--save', type=str, default='', help='write the results to this file')
+    parser.add_argument('--compare', type=str, default='', help='baseline results file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='slowdown relative to the baseline that counts as a regression')
+    parser.add_argument('--checkpoint_memory', type=str, default='',
+                        help='comma separated sequence lengths for the disc checkpoint memory '
+                             'sweep. the other benchmarks are not run')
+    parser.add_argument('--checkpoint_segments', type=str, default='0,1,4',
+                        help='comma separated disc checkpoint segment lengths for the sweep')
+    parser.add_argument('--precision_ab', type=str, default='',
+                        help='comma separated tasks to train in float32 and bfloat16 and compare. '
+                             'the other benchmarks are not run')
+    parser.add_argument('--ab_iters', type=int, default=200,
+                        help='number of turns of each --precision_ab run')
+    bopt = parser.parse_args(argv)
+    if bopt.checkpoint_memory:
+        checkpoint_memory_sweep(bopt, main_args)
+        sys.exit(0)
+    if bopt.precision_ab:
+        rows = precision_ab(bopt, main_args)
+        print_ab(rows)
+        if bopt.save:
+            with open(bopt.save, 'w') as f:
+                json.dump({'meta': {'torch': torch.__version__, 'threads': torch.get_num_threads(),
+                                    'machine': platform.machine()}, 'precision_ab': rows},
+                          f, indent=2)
+            print('Saved results to', bopt.save)
+        sys.exit(0)
+
+    opt = main.get_parser().parse_args(['--cuda', '0'] + main_args)
+    opt.replay_size = opt.replay_actors * opt.batch_size * opt.disc_iters
+    opt.replay_size_half = opt.replay_actors_half * opt.batch_size * opt.disc_iters
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    if opt.seed >= 0:
+        np.random.seed(opt.seed)
+        torch.manual_seed(opt.seed)
+    try:
+        main.make_task(opt)  # sets opt.vocab_size for the task
+    except (IOError, OSError, AssertionError) as e:
+        print('warning: could not create the %s task, using vocab_size %d: %s' %
+              (opt.task, opt.vocab_size, e))
+
+    names = [n for n in BENCHMARKS if re.search(bopt.filter, n)]
+    if bopt.list:
+        print('\n'.join(names))
+        sys.exit(0)
+    results = collections.OrderedDict()
+    for name in names:
+        try:
+            measured = BENCHMARKS[name](opt, bopt)
+            if callable(measured):
+                measured = time_fn(measured, opt, bopt)
+        except (IOError, OSError, AssertionError) as e:  # e.g. missing corpus files
+            print('%-40s skipped: %s' % (name, e))
+            continue
+        results[name] = summarize(measured)
+        print('%-40s %10.3f ms  (min %.3f ms, %d runs)' %
+              (name, 1e3 * results[name]['median'], 1e3 * results[name]['min'],
+               results[name]['runs']))
+
+    output = {'meta': {'torch': torch.__version__, 'python': platform.python_version(),
+                       'machine': platform.machine(), 'threads': torch.get_num_threads(),
+                       'peak_memory_mb': peak_memory_mb(opt), 'opt': vars(opt)},
+              'results': results}
+    if bopt.save:
+        with open(bopt.save, 'w') as f:
+            json.dump(output, f, indent=2)
+        print('Saved results to', bopt.save)
+    if bopt.compare:
+        with open(bopt.compare, 'r') as f:
+            baseline = json.load(f)['results']
+        print('\nComparison with', bopt.compare)
+        if compare(results, baseline, bopt.tolerance):
+            sys.exit(1)
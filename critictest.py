@@ -1,127 +1,227 @@
+'''Train the discriminator or critic alone against fixed fake data, to tune their architectures
+without running the whole GAN.
+
+Flags after -- are passed to main.py's parser to configure the model and task, e.g.
+
+    python critictest.py --model disc --strategy close -- --task longterm --cuda 0
+    python critictest.py --strategy replay --actor logs/default -- --task lm
+
+Fake data strategies:
+    zeros   all zero sequences
+    close   real sequences with --close_tokens tokens replaced by random ones
+    random  uniformly random sequences
+    replay  a pool of samples of the actor saved in the run directory --actor
+
+Every --eval_every steps, the model scores held-out real sequences and fakes. The separation of
+the two is reported as the AUC and the difference of mean scores, against training seconds.
+'''
+
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
 import argparse
+import os
 from six.moves import xrange
 import sys
+import time
 
 import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
+import torch.nn as nn
 import torch.optim as optim
 
-from main import Critic
+import main
 import util
 
 
-def get_fake_toy_data_words(batch_size, seq_len, vocab_size, strategy):
-    batch = np.zeros([batch_size, seq_len], dtype=np.int)
-    if strategy == 'real':  # TODO more strategies
-        cur_word = np.random.randint(1, vocab_size, size=batch_size, dtype=np.int)
-        batch[:, 0] = cur_word
-        for i in xrange(1, seq_len):
-            zero_mask = cur_word == 0
-            cur_word += 1
-            cur_word[cur_word > vocab_size-1] = 0
-            cur_word *= np.random.binomial(np.ones(batch_size, dtype=np.int), 0.75)
-            cur_word[zero_mask] = np.random.randint(1, vocab_size, size=np.sum(zero_mask),
-                                                    dtype=np.int)
-            batch[:, i] = cur_word
-        return batch
-
-
-def get_fake_toy_data_longterm(batch_size, seq_len, vocab_size, strategy):
-    batch = np.zeros([batch_size, seq_len], dtype=np.int)
-    if strategy == 'zeros':
-        return batch
-    elif strategy == 'real':
-        batch[:, int(0.33 * seq_len)] = np.random.randint(1, vocab_size, size=batch_size,
-                                                          dtype=np.int)
-        batch[:, int(0.8 * seq_len)] = np.random.randint(1, vocab_size, size=batch_size,
-                                                         dtype=np.int)
-        return batch
-    elif strategy == 'close':
-        for i in xrange(batch_size):
-            r1 = max(min(np.random.normal(loc=0.33, scale=0.001), 0.999), 0.0)
-            batch[i, int(r1 * seq_len)] = np.random.randint(1, vocab_size, dtype=np.int)
-            r2 = max(min(np.random.normal(loc=0.8, scale=0.001), 0.999), 0.0)
-            batch[i, int(r2 * seq_len)] = np.random.randint(1, vocab_size, dtype=np.int)
-        return batch
-    elif strategy == 'random':
-        batch = np.random.randint(1, vocab_size, size=batch.shape, dtype=np.int)
-        return batch
+class FakeData(object):
+    '''Makes fake batches for real batches with one of the strategies'''
+
+    def __init__(self, strategy, opt, hopt):
+        self.strategy = strategy
+        self.opt = opt
+        self.close_tokens = hopt.close_tokens
+        if strategy == 'replay':
+            self.actor = load_actor(hopt.actor, opt)
+            self.pool = util.ReplayMemory(hopt.pool)
+            while len(self.pool) < hopt.pool:
+                self.pool.push(self.sample_actor(min(opt.eval_batch_size,
+                                                     hopt.pool - len(self.pool))))
+        elif strategy not in ('zeros', 'close', 'random'):
+            raise ValueError('unknown fake data strategy: %s' % strategy)
+
+    def sample_actor(self, batch_size):
+        with torch.no_grad():
+            return self.actor(batch_size)[0].cpu().numpy()
+
+    def make(self, real, held_out=False):
+        '''Return a fake batch of the size of the real batch. Held-out replay batches are fresh
+           actor samples instead of samples from the training pool.'''
+        if self.strategy == 'zeros':
+            return np.zeros_like(real)
+        elif self.strategy == 'close':
+            fake = real.copy()
+            rows = np.arange(real.shape[0])[:, None]
+            cols = np.random.randint(0, real.shape[1], size=(real.shape[0], self.close_tokens))
+            fake[rows, cols] = np.random.randint(0, self.opt.vocab_size, size=cols.shape)
+            return fake
+        elif self.strategy == 'random':
+            return np.random.randint(0, self.opt.vocab_size, size=real.shape)
+        elif held_out:
+            return self.sample_actor(real.shape[0])
+        else:
+            return self.pool.sample(real.shape[0])
+
+
+def load_actor(save, opt):
+    '''Load the last saved actor of the run in the directory save'''
+    actor_opt = util.load_opt(os.path.join(save, 'opt.json'))
+    if actor_opt.vocab_size != opt.vocab_size or actor_opt.seq_len != opt.seq_len:
+        raise ValueError('the actor in %s is for vocab_size %d and seq_len %d' %
+                         (save, actor_opt.vocab_size, actor_opt.seq_len))
+    actor_opt.cuda = opt.cuda
+    actor_opt.bf16 = opt.bf16
+    actor = util.maybe_cuda(main.Actor(actor_opt), opt.cuda)
+    kwargs = {} if opt.cuda else {'map_location': lambda storage, loc: storage}
+    state_dict, _, cur_iter = torch.load(actor_opt.save_actor, **kwargs)
+    actor.load_state_dict(state_dict)
+    actor.eval()
+    print('Loaded actor of iter %d from %s' % (cur_iter, actor_opt.save_actor))
+    return actor
+
+
+def scores(model, batch):
+    '''Per sequence scores, higher for sequences that look generated: the summed costs of the
+       disc, or the summed values of the critic'''
+    if isinstance(model, main.Discriminator):
+        return model.action_costs(batch).sum(1)
+    return model(batch).sum(1)
+
+
+def auc(fake_scores, real_scores):
+    '''Probability that a fake sequence scores higher than a real one, counting ties as half'''
+    all_scores = np.concatenate([fake_scores, real_scores])
+    _, inverse, counts = np.unique(all_scores, return_inverse=True, return_counts=True)
+    ranks = (np.cumsum(counts) - (counts - 1) / 2)[inverse]  # average ranks of ties
+    num_fake = len(fake_scores)
+    rank_sum = ranks[:num_fake].sum() - num_fake * (num_fake + 1) / 2
+    return rank_sum / (num_fake * len(real_scores))
+
+
+def evaluate(model, task, fake_data, opt):
+    '''Score the held-out split and as many fakes without autograd. Returns the AUC and the
+       difference of the mean fake and real scores.'''
+    fake_scores = []
+    real_scores = []
+    model.eval()
+    with torch.no_grad():
+        for batch in task.iterate(opt.eval_split, opt.eval_batch_size, opt.eval_batches):
+            real = util.maybe_cuda(torch.from_numpy(batch), opt.cuda)
+            fake = fake_data.make(batch, held_out=True)
+            fake = util.maybe_cuda(torch.from_numpy(fake), opt.cuda)
+            real_scores.append(scores(model, real).cpu().numpy())
+            fake_scores.append(scores(model, fake).cpu().numpy())
+    model.train()
+    fake_scores = np.concatenate(fake_scores)
+    real_scores = np.concatenate(real_scores)
+    return auc(fake_scores, real_scores), fake_scores.mean() - real_scores.mean()
 
 
 if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if '--' in argv:
+        main_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    else:
+        main_args = []
     parser = argparse.ArgumentParser()
-    parser.add_argument('--niter', type=int, default=100000, help='number of epochs to train for')
-    parser.add_argument('--batch_size', type=int, default=16, help='batch size')
-    parser.add_argument('--seq_len', type=int, default=15, help='toy sequence length')
-    parser.add_argument('--vocab_size', type=int, default=6,
-                        help='character vocab size for toy data')
-    parser.add_argument('--emb_size', type=int, default=32, help='embedding size')
-    parser.add_argument('--hidden_size', type=int, default=128, help='RNN hidden size')
-    parser.add_argument('--learning_rate', type=float, default=0.00005, help='learning rate')
-    parser.add_argument('--clamp_limit', type=float, default=1.0)
-    parser.add_argument('--critic_iters', type=int, default=5,
-                        help='number of critic iters per turn')
-    parser.add_argument('--task', type=str, default='longterm', help='longterm or words')
-    parser.add_argument('--strategy', type=str, default='close', help='fake data strategy')
-    parser.add_argument('--print_every', type=int, default=25,
-                        help='print losses every these many steps')
-    opt = parser.parse_args()
-    opt.gamma = 1.0
+    parser.add_argument('--model', type=str, default='disc', help='disc or critic')
+    parser.add_argument('--strategy', type=str, default='close',
+                        help='fake data strategy: zeros/close/random/replay')
+    parser.add_argument('--close_tokens', type=int, default=1,
+                        help='number of tokens replaced for the close strategy')
+    parser.add_argument('--actor', type=str, default='',
+                        help='run directory of the actor for the replay strategy')
+    parser.add_argument('--pool', type=int, default=10000,
+                        help='number of actor samples to replay from')
+    parser.add_argument('--niter', type=int, default=5000, help='number of training steps')
+    parser.add_argument('--max_seconds', type=float, default=0,
+                        help='if > 0, stop after training for these many seconds')
+    parser.add_argument('--eval_every', type=int, default=100,
+                        help='evaluate separation every these many steps')
+    parser.add_argument('--clamp_limit', type=float, default=1.0,
+                        help='critic weight clipping. 0 to disable')
+    parser.add_argument('--log', type=str, default='', help='also write the results to this file')
+    hopt = parser.parse_args(argv)
+
+    opt = main.get_parser().parse_args(main_args)
+    print(hopt)
     print(opt)
-
-    cudnn.benchmark = True
+    cudnn.enabled = False
     np.set_printoptions(precision=4, threshold=10000, linewidth=200, suppress=True)
-
-    if opt.task == 'words':
-        get_data = util.get_toy_data_words
-        get_fake_data = get_fake_toy_data_words
-    elif opt.task == 'longterm':
-        get_data = util.get_toy_data_longterm
-        get_fake_data = get_fake_toy_data_longterm
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    if opt.seed >= 0:
+        np.random.seed(opt.seed)
+        torch.manual_seed(opt.seed)
+    task = main.make_task(opt)
+    task.shuffle()
+    fake_data = FakeData(hopt.strategy, opt, hopt)
+
+    if hopt.model == 'disc':
+        model = util.maybe_cuda(main.Discriminator(opt), opt.cuda)
+    elif hopt.model == 'critic':
+        model = util.maybe_cuda(main.Critic(opt), opt.cuda)
     else:
-        print('error: invalid task name:', opt.task)
+        print('error: invalid model name:', hopt.model)
         sys.exit(1)
+    kwargs = {'lr': opt.learning_rate}
+    if opt.optimizer == 'Adam':
+        kwargs['betas'] = (opt.beta1, opt.beta2)
+    optimizer = getattr(optim, opt.optimizer)(model.parameters(), **kwargs)
+    log = util.MetricsLog(hopt.log) if hopt.log else None
 
-    critic = Critic(opt)
-    critic.cuda()
-
-    one = torch.cuda.FloatTensor([1])
-    mone = one * -1
-
-    optimizer = optim.RMSprop(critic.parameters(), lr=opt.learning_rate)
-
+    train_seconds = 0.0
     Wdists = []
-    err_r = []
-    err_f = []
-    for epoch in xrange(opt.niter):
-        for param in critic.parameters():
-            param.data.clamp_(-opt.clamp_limit, opt.clamp_limit)
-        critic.zero_grad()
-
-        fake = torch.from_numpy(get_fake_data(opt.batch_size, opt.seq_len, opt.vocab_size,
-                                              opt.strategy)).cuda()
-        E_generated = critic(fake).sum() / opt.batch_size
-        E_generated.backward(mone)
-
-        real = torch.from_numpy(get_data(opt.batch_size, opt.seq_len,
-                                         opt.vocab_size)).cuda()
-        E_real = critic(real).sum() / opt.batch_size
-        E_real.backward(one)
-
+    for cur_iter in xrange(hopt.niter):
+        start = time.time()
+        batch = task.get_data(opt.batch_size)
+        real = util.maybe_cuda(torch.from_numpy(batch), opt.cuda)
+        fake = util.maybe_cuda(torch.from_numpy(fake_data.make(batch)), opt.cuda)
+        model.zero_grad()
+        E_fake = scores(model, fake).mean()
+        E_real = scores(model, real).mean()
+        if hopt.model == 'disc':
+            loss = -E_fake + opt.real_multiplier * E_real
+            if opt.gradient_penalty > 0:
+                loss = loss + main.gradient_penalty(opt, model, real, fake)
+        else:
+            loss = -E_fake + E_real
+        loss.backward()
+        if opt.max_grad_norm > 0:
+            nn.utils.clip_grad_norm_(model.parameters(), opt.max_grad_norm)
         optimizer.step()
-        Wdist = (E_generated - E_real).data[0]
-        Wdists.append(Wdist)
-        err_r.append(E_real.data[0])
-        err_f.append(E_generated.data[0])
-
-        if epoch % opt.print_every == 0:
-            print(epoch, ':\tWdist:', np.array(Wdists).mean(), '\terr R: ', np.array(err_r).mean(),
-                  '\terr F: ', np.array(err_f).mean())
+        if hopt.model == 'critic' and hopt.clamp_limit > 0:
+            for param in model.parameters():
+                param.data.clamp_(-hopt.clamp_limit, hopt.clamp_limit)
+        Wdists.append((E_fake - E_real).item())  # synchronizes the device
+        train_seconds += time.time() - start
+
+        last = cur_iter == hopt.niter - 1 or 0 < hopt.max_seconds < train_seconds
+        if cur_iter % hopt.eval_every == 0 or last:
+            eval_start = time.time()
+            held_out_auc, held_out_Wdist = evaluate(model, task, fake_data, opt)
+            record = {'iter': cur_iter, 'seconds': train_seconds, 'Wdist': np.mean(Wdists),
+                      'auc': held_out_auc, 'eval_Wdist': held_out_Wdist,
+                      'eval_seconds': time.time() - eval_start}
+            print('%d:\t%.1fs\tWdist: %.4f\theld-out AUC: %.4f\theld-out Wdist: %.4f' %
+                  (cur_iter, train_seconds, record['Wdist'], held_out_auc, held_out_Wdist))
+            if log is not None:
+                log.write(record)
             Wdists = []
-            err_r = []
-            err_f = []
+        if last:
+            break
+    if log is not None:
+        log.close()
@@ -0,0 +1,162 @@
+'''Evaluate the discriminator, critic and actor of a run on held-out data.
+
+main.py calls evaluate() every --eval_every turns. With --eval_process 1 it runs this script in
+the background instead, which evaluates the checkpoints as they are saved:
+
+    python evaluate.py logs/default                # evaluate the last checkpoint once
+    python evaluate.py logs/default --watch 30     # evaluate every new checkpoint
+
+Results are appended to <save dir>/eval.jsonl.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import contextlib
+import glob
+import os
+import random
+import time
+
+import numpy as np
+import torch
+
+import util
+
+
+@contextlib.contextmanager
+def preserved_rng(use_cuda):
+    '''Restore the random states on exit, so that evaluating does not change the training run'''
+    states = (random.getstate(), np.random.get_state(), torch.get_rng_state(),
+              torch.cuda.get_rng_state() if use_cuda else None)
+    try:
+        yield
+    finally:
+        random.setstate(states[0])
+        np.random.set_state(states[1])
+        torch.set_rng_state(states[2])
+        if use_cuda:
+            torch.cuda.set_rng_state(states[3])
+
+
+def evaluate(opt, task, actor, disc, critic, split='valid'):
+    '''Score the real sequences of the held-out split and opt.eval_samples actor samples with the
+       disc and critic, in batches of opt.eval_batch_size and without autograd. Returns a dict of
+       metrics, with keys prefixed by eval_.'''
+    start = time.time()
+    modes = [(model, model.training) for model in (actor, disc, critic)]
+    for model, _ in modes:
+        model.eval()
+    real_costs = real_values = 0.0
+    num_real = num_tokens = 0
+    fake_costs = fake_values = 0.0
+    samples = []
+    first_real = None
+    with torch.no_grad(), preserved_rng(opt.cuda):
+        for batch in task.iterate(split, opt.eval_batch_size, opt.eval_batches):
+            if first_real is None:
+                first_real = batch
+            real = util.maybe_cuda(torch.from_numpy(batch), opt.cuda)
+            real_costs += disc.action_costs(real).sum().item()
+            real_values += critic(real).sum().item()
+            num_real += real.size(0)
+            num_tokens += real.numel()
+        num_fake = 0
+        while num_fake < opt.eval_samples:
+            generated = actor(min(opt.eval_batch_size, opt.eval_samples - num_fake))[0]
+            fake_costs += disc.action_costs(generated).sum().item()
+            fake_values += critic(generated).sum().item()
+            num_fake += generated.size(0)
+            samples.append(generated.cpu().numpy())
+    for model, training in modes:
+        model.train(training)
+
+    samples = np.concatenate(samples)
+    E_real = real_costs / num_real if num_real else float('nan')
+    E_fake = fake_costs / num_fake
+    results = {'eval_split': split, 'eval_real': num_real, 'eval_fake': num_fake,
+               'eval_E_real': E_real, 'eval_E_fake': E_fake, 'eval_Wdist': E_fake - E_real,
+               'eval_V_real': real_values / num_tokens if num_tokens else float('nan'),
+               'eval_V_fake': fake_values / samples.size,
+               'eval_distinct': np.unique(samples, axis=0).shape[0] / num_fake}
+    for key, value in task.quality(samples).items():
+        results['eval_' + key] = value
+    if first_real is not None:  # the quality of held-out data, for reference
+        for key, value in task.quality(first_real).items():
+            results['eval_real_' + key] = value
+    results['eval_seconds'] = time.time() - start
+    return results
+
+
+def format_results(results):
+    return '\t'.join('%s: %.4f' % (k[5:], v) for k, v in sorted(results.items())
+                     if k.startswith('eval_') and k not in ('eval_split', 'eval_real', 'eval_fake'))
+
+
+def checkpoint_suffix(opt):
+    '''Suffix of the save files of the last complete checkpoint of the run, or None'''
+    if opt.save_overwrite:
+        return '' if os.path.exists(opt.save_state) else None
+    iters = [int(f.rsplit('.', 1)[1]) for f in glob.glob(opt.save_state + '.*')
+             if f.rsplit('.', 1)[1].isdigit()]
+    return '.%d' % max(iters) if iters else None
+
+
+def load_checkpoint(opt, suffix, actor, disc, critic):
+    '''Load the models saved with suffix. Returns their iter, or None if they are not all from the
+       same iter yet.'''
+    kwargs = {} if opt.cuda else {'map_location': lambda storage, loc: storage}
+    state_dicts = []
+    for path in [opt.save_actor, opt.save_disc, opt.save_critic]:
+        checkpoint = util.load(path + suffix, **kwargs)
+        state_dicts.append((checkpoint[0], checkpoint[2]))
+    if len(set(cur_iter for _, cur_iter in state_dicts)) != 1:
+        return None
+    for model, (state_dict, _) in zip([actor, disc, critic], state_dicts):
+        model.load_state_dict(state_dict)
+    return state_dicts[0][1]
+
+
+if __name__ == '__main__':
+    import main  # main imports this module for evaluate(), only the script needs the models
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('save', type=str, help='save directory of the run, like logs/default')
+    parser.add_argument('--watch', type=int, default=0,
+                        help='if > 0, check for new checkpoints every these many seconds')
+    parser.add_argument('--split', type=str, default='', help='held-out split. default as in run')
+    parser.add_argument('--cuda', type=int, default=-1, help='1 to evaluate on the GPU. default '
+                                                             'as in run')
+    eval_opt = parser.parse_args()
+
+    opt = util.load_opt(os.path.join(eval_opt.save, 'opt.json'))
+    if eval_opt.cuda >= 0:
+        opt.cuda = eval_opt.cuda
+    split = eval_opt.split or opt.eval_split
+    task = main.make_task(opt)
+    actor = util.maybe_cuda(main.Actor(opt), opt.cuda)
+    disc = util.maybe_cuda(main.Discriminator(opt), opt.cuda)
+    critic = util.maybe_cuda(main.Critic(opt), opt.cuda)
+    log = util.MetricsLog(os.path.join(eval_opt.save, 'eval.jsonl'), append=True)
+
+    last_iter = None
+    while True:
+        suffix = checkpoint_suffix(opt)
+        cur_iter = None
+        if suffix is not None:
+            try:
+                cur_iter = load_checkpoint(opt, suffix, actor, disc, critic)
+            except (IOError, OSError, EOFError, RuntimeError) as e:  # e.g. replaced while loading
+                print('warning: could not load checkpoint:', e)
+        if cur_iter is not None and cur_iter != last_iter:
+            results = evaluate(opt, task, actor, disc, critic, split)
+            results['iter'] = cur_iter
+            log.write(results)
+            print('%d: eval %s\t%s' % (cur_iter, split, format_results(results)))
+            last_iter = cur_iter
+        if eval_opt.watch <= 0:
+            break
+        time.sleep(eval_opt.watch)
+    log.close()
@@ -4,14 +4,11 @@ from __future__ import print_function
 
 import argparse
 import os
+import random
 from six.moves import xrange
+import subprocess
 import sys
 
-import matplotlib
-matplotlib.use('Agg')  # allows for saving images without display
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-
 import numpy as np
 import torch
 from torch import autograd
@@ -20,10 +17,42 @@ import torch.backends.cudnn as cudnn
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.utils.checkpoint import checkpoint
 
+import evaluate
 import util
 
 
+def sequence_lengths(opt, actions):
+    '''Lengths of the sequences up to and including their first <e>'''
+    ends = (actions == opt.end_token).long()
+    return ((ends.cumsum(1) - ends) == 0).long().sum(1)
+
+
+def num_tokens(opt, actions):
+    '''Number of tokens of the batch, without the padding after <e> of packed sequences. Those
+       are counted on the device, so that timing does not wait for it.'''
+    if opt.pack_sequences:
+        return sequence_lengths(opt, actions).sum()
+    return actions.numel()
+
+
+def length_mask(lengths, seq_len):
+    '''[batch_size, seq_len] float mask of the steps within the lengths'''
+    steps = torch.arange(seq_len, device=lengths.device).unsqueeze(0)
+    return (steps < lengths.unsqueeze(1)).float()
+
+
+def run_packed(rnn, inputs, state, lengths):
+    '''Run rnn over the first lengths steps of each row of the batch first inputs only. The outputs
+       of the other steps are 0.'''
+    packed = pack_padded_sequence(inputs, lengths.cpu(), batch_first=True, enforce_sorted=False)
+    outputs, _ = rnn(packed, state)
+    outputs, _ = pad_packed_sequence(outputs, batch_first=True, total_length=inputs.size(1))
+    return outputs
+
+
 class Discriminator(nn.Module):
     '''The imitation GAN costs network (discriminator).'''
 
@@ -35,46 +64,91 @@ class Discriminator(nn.Module):
                           num_layers=opt.disc_layers, dropout=opt.disc_dropout,
                           batch_first=True)
         self.cost = nn.Linear(opt.disc_hidden_size, opt.vocab_size)
-        self.zero_input = torch.LongTensor(opt.batch_size, 1).zero_().cuda()
-        self.zero_state = torch.zeros([opt.disc_layers, opt.batch_size,
-                                       opt.disc_hidden_size]).cuda()
+        # expanded to the batch size in forward
+        self.zero_input = util.maybe_cuda(torch.LongTensor(1, 1).zero_(), opt.cuda)
+        self.zero_state = util.maybe_cuda(torch.zeros([opt.disc_layers, 1,
+                                                       opt.disc_hidden_size]), opt.cuda)
         self.gradient_penalize = False
 
+    @util.autocast_forward
     def forward(self, actions):
         if self.gradient_penalize:
             # actions is tuple of (real_batch, fake_batch)
             real, fake = actions
-            padded_real = torch.cat([self.zero_input, real], 1)
-            padded_fake = torch.cat([self.zero_input, fake], 1)
-            onehot_real = torch.zeros(padded_real.size() + (self.opt.vocab_size,)).cuda()
-            onehot_fake = torch.zeros(padded_fake.size() + (self.opt.vocab_size,)).cuda()
+            batch_size = real.size(0)
+            zero_input = self.zero_input.expand(batch_size, 1)
+            padded_real = torch.cat([zero_input, real], 1)
+            padded_fake = torch.cat([zero_input, fake], 1)
+            onehot_real = util.maybe_cuda(torch.zeros(padded_real.size() + (self.opt.vocab_size,)),
+                                          self.opt.cuda)
+            onehot_fake = util.maybe_cuda(torch.zeros(padded_fake.size() + (self.opt.vocab_size,)),
+                                          self.opt.cuda)
             padded_real.unsqueeze_(2)
             padded_fake.unsqueeze_(2)
             onehot_real.scatter_(2, padded_real, 1)
             onehot_fake.scatter_(2, padded_fake, 1)
-            alpha = torch.rand(real.size(0)).unsqueeze(1).unsqueeze(2).expand_as(onehot_real).cuda()
+            alpha = torch.rand(real.size(0)).unsqueeze(1).unsqueeze(2).expand_as(onehot_real)
+            alpha = util.maybe_cuda(alpha, self.opt.cuda)
             onehot_actions = (alpha * onehot_real) + ((1 - alpha) * onehot_fake)
             onehot_actions = Variable(onehot_actions, requires_grad=True)
             inputs = torch.mm(onehot_actions.view(-1, self.opt.vocab_size), self.embedding.weight)
             inputs = inputs.view(onehot_actions.size(0), -1, self.opt.emb_size)
         else:
-            padded_actions = torch.cat([self.zero_input, actions], 1)
+            batch_size = actions.size(0)
+            padded_actions = torch.cat([self.zero_input.expand(batch_size, 1), actions], 1)
             inputs = self.embedding(Variable(padded_actions))
             onehot_actions = None
-        outputs, _ = self.rnn(inputs, Variable(self.zero_state))
-        outputs = outputs.contiguous()
+        outputs = self.hidden_states(inputs, batch_size).contiguous()
         flattened = outputs.view(-1, self.opt.disc_hidden_size)
         flat_costs = self.cost(flattened)
-        costs = flat_costs.view(self.opt.batch_size, self.opt.seq_len + 1, self.opt.vocab_size)
-        costs = costs[:, :-1]  # account for the padding
+        costs = flat_costs.view(batch_size, -1, self.opt.vocab_size)
+        return self.smooth(costs), onehot_actions
+
+    @util.autocast_forward
+    def action_costs(self, actions):
+        '''The costs of the taken actions only, [batch_size, seq_len]. Only the rows of the cost
+           layer of the actions are used, instead of computing the costs of the whole vocab.'''
+        batch_size = actions.size(0)
+        padded_actions = torch.cat([self.zero_input.expand(batch_size, 1), actions], 1)
+        lengths = sequence_lengths(self.opt, actions) if self.opt.pack_sequences else None
+        outputs = self.hidden_states(self.embedding(padded_actions), batch_size, lengths)
+        weight = F.embedding(actions, self.cost.weight)
+        bias = F.embedding(actions, self.cost.bias.unsqueeze(1)).squeeze(2)
+        costs = self.smooth((outputs * weight).sum(2) + bias)
+        if lengths is not None:
+            costs = costs * length_mask(lengths, actions.size(1))
+        return costs
+
+    def hidden_states(self, inputs, batch_size, lengths=None):
+        '''The RNN outputs for the inputs, without the last step of the padded sequence. With
+           lengths, the steps after them are skipped and their outputs are 0.'''
+        zero_state = self.zero_state.expand(self.opt.disc_layers, batch_size,
+                                            self.opt.disc_hidden_size).contiguous()
+        segment = self.opt.disc_checkpoint
+        if lengths is not None:
+            outputs = run_packed(self.rnn, inputs, zero_state, lengths)
+        elif segment > 0 and torch.is_grad_enabled() and not self.gradient_penalize:
+            # not for the gradient penalty: its double backward keeps the recomputed activations
+            outputs = []
+            hidden = Variable(zero_state)
+            for start in xrange(0, inputs.size(1), segment):
+                output, hidden = checkpoint(self.rnn, inputs[:, start:start+segment], hidden,
+                                            use_reentrant=False)
+                outputs.append(output)
+            outputs = torch.cat(outputs, 1)
+        else:
+            outputs, _ = self.rnn(inputs, Variable(zero_state))
+        return outputs[:, :-1]  # account for the padding
+
+    def smooth(self, costs):
         costs_abs = torch.abs(costs)
         if self.opt.smooth_zero > 1e-4:
             select = (costs_abs >= self.opt.smooth_zero).float()
             costs_abs = costs_abs - (self.opt.smooth_zero / 2)
             costs_sq = (costs ** 2) / (self.opt.smooth_zero * 2)
-            return (select * costs_abs) + ((1.0 - select) * costs_sq), onehot_actions
+            return (select * costs_abs) + ((1.0 - select) * costs_sq)
         else:
-            return costs_abs, onehot_actions
+            return costs_abs
 
 
 class Critic(nn.Module):
@@ -89,20 +163,127 @@ class Critic(nn.Module):
                           num_layers=opt.critic_layers, dropout=opt.critic_dropout,
                           batch_first=True)
         self.value = nn.Linear(opt.critic_hidden_size, 1)
-        self.zero_input = torch.LongTensor(opt.batch_size, 1).zero_().cuda()
-        self.zero_state = torch.zeros([opt.critic_layers, opt.batch_size,
-                                       opt.critic_hidden_size]).cuda()
+        # expanded to the batch size in forward
+        self.zero_input = util.maybe_cuda(torch.LongTensor(1, 1).zero_(), opt.cuda)
+        self.zero_state = util.maybe_cuda(torch.zeros([opt.critic_layers, 1,
+                                                       opt.critic_hidden_size]), opt.cuda)
 
+    @util.autocast_forward
     def forward(self, actions):
-        padded_actions = torch.cat([self.zero_input, actions], 1)
+        batch_size = actions.size(0)
+        padded_actions = torch.cat([self.zero_input.expand(batch_size, 1), actions], 1)
         inputs = self.embedding(Variable(padded_actions))
-        outputs, _ = self.rnn(inputs, Variable(self.zero_state))
+        zero_state = self.zero_state.expand(self.opt.critic_layers, batch_size,
+                                            self.opt.critic_hidden_size).contiguous()
+        if self.opt.pack_sequences:
+            lengths = sequence_lengths(self.opt, actions)
+            outputs = run_packed(self.rnn, inputs, Variable(zero_state), lengths)
+        else:
+            outputs, _ = self.rnn(inputs, Variable(zero_state))
         outputs = outputs.contiguous()
         flattened = outputs.view(-1, self.opt.critic_hidden_size)
         flat_value = self.value(flattened)
-        value = flat_value.view(self.opt.batch_size, self.opt.seq_len + 1)
+        value = flat_value.view(batch_size, -1)
         # account for the padding
-        return value[:, :-1]
+        value = value[:, :-1]
+        if self.opt.pack_sequences:
+            value = value * length_mask(lengths, actions.size(1))  # ended sequences have value 0
+        return value
+
+
+def sample_logits(logits):
+    '''Sample from the softmax distributions of the batch of logits. Returns the samples, their
+       log probabilities, the entropies of the distributions and the probabilities.'''
+    logprobs = F.log_softmax(logits.float(), dim=1)  # in float32 also under autocast
+    probs = torch.exp(logprobs)
+    sampled = torch.multinomial(probs.detach(), 1)
+    logprob = logprobs.gather(1, sampled).squeeze(1)
+    entropy = -(probs * logprobs).sum(1)
+    return sampled.squeeze(1), logprob, entropy, probs
+
+
+def logits_log_prob(logits, targets):
+    '''Log probabilities of the targets under the softmax of logits of any batch shape'''
+    logprobs = F.log_softmax(logits.float(), dim=-1)
+    return logprobs.gather(-1, targets.unsqueeze(-1)).squeeze(-1)
+
+
+class FullSoftmax(nn.Linear):
+    '''Output layer with a softmax over the whole vocab.'''
+
+    def sample(self, hidden):
+        '''Sample from the distributions of the batch of hidden states. See sample_logits.'''
+        return sample_logits(self(hidden))
+
+    def log_prob(self, hidden, targets):
+        '''Log probabilities of the targets, for hidden states of any batch shape'''
+        return logits_log_prob(self(hidden), targets)
+
+
+class AdaptiveSoftmax(nn.Module):
+    '''Output layer with a softmax over the most frequent words and one token per cluster of rarer
+       words, followed by a softmax within the cluster. Clusters of rarer words use smaller
+       projections of the hidden state. The vocab has to be sorted by frequency.'''
+
+    def __init__(self, hidden_size, cutoffs, vocab_size, div_value=4):
+        super(AdaptiveSoftmax, self).__init__()
+        self.cutoffs = list(cutoffs) + [vocab_size]
+        self.shortlist = self.cutoffs[0]
+        self.head = nn.Linear(hidden_size, self.shortlist + len(cutoffs))
+        self.tails = nn.ModuleList()
+        for k in xrange(len(cutoffs)):
+            size = max(hidden_size // (div_value ** (k + 1)), 1)
+            self.tails.append(nn.Sequential(nn.Linear(hidden_size, size, bias=False),
+                                            nn.Linear(size, self.cutoffs[k+1] - self.cutoffs[k])))
+
+    def sample(self, hidden):
+        '''Like FullSoftmax.sample, without the probabilities. The entropy is exact: the entropy of
+           the head plus the entropies of the clusters weighted by their probabilities.'''
+        head_logprobs = F.log_softmax(self.head(hidden).float(), dim=1)
+        head_probs = torch.exp(head_logprobs)
+        sampled = torch.multinomial(head_probs.detach(), 1).squeeze(1)
+        logprob = head_logprobs.gather(1, sampled.unsqueeze(1)).squeeze(1)
+        entropy = -(head_probs * head_logprobs).sum(1)
+        for k, tail in enumerate(self.tails):
+            tail_logprobs = F.log_softmax(tail(hidden).float(), dim=1)
+            tail_probs = torch.exp(tail_logprobs)
+            entropy = entropy - head_probs[:, self.shortlist + k] * \
+                (tail_probs * tail_logprobs).sum(1)
+            in_cluster = sampled == self.shortlist + k
+            words = torch.multinomial(tail_probs.detach(), 1)
+            logprob = logprob + in_cluster.float() * tail_logprobs.gather(1, words).squeeze(1)
+            sampled = torch.where(in_cluster, words.squeeze(1) + self.cutoffs[k], sampled)
+        return sampled, logprob, entropy, None
+
+    def log_prob(self, hidden, targets):
+        '''Log probabilities of the targets. Each cluster is only evaluated for its targets.'''
+        flat_hidden = hidden.reshape(-1, hidden.size(-1))
+        flat_targets = targets.reshape(-1)
+        head_targets = flat_targets.clone()
+        tail_logprob = torch.zeros_like(flat_targets, dtype=torch.float)
+        for k, tail in enumerate(self.tails):
+            low = self.cutoffs[k]
+            in_cluster = (flat_targets >= low) & (flat_targets < self.cutoffs[k+1])
+            head_targets = head_targets.masked_fill(in_cluster, self.shortlist + k)
+            rows = in_cluster.nonzero().squeeze(1)
+            if rows.numel():
+                tail_logprobs = F.log_softmax(tail(flat_hidden[rows]).float(), dim=1)
+                words = (flat_targets[rows] - low).unsqueeze(1)
+                tail_logprob = tail_logprob.index_add(0, rows,
+                                                      tail_logprobs.gather(1, words).squeeze(1))
+        head_logprobs = F.log_softmax(self.head(flat_hidden).float(), dim=1)
+        logprob = head_logprobs.gather(1, head_targets.unsqueeze(1)).squeeze(1) + tail_logprob
+        return logprob.view_as(targets)
+
+
+def make_head(opt):
+    '''The output layer of the actor'''
+    if opt.actor_softmax == 'adaptive':
+        if getattr(opt, 'actor_cutoffs', None) is None:
+            raise ValueError('the adaptive softmax needs the cutoffs that make_task derives from '
+                             'the lm task, make the task with these options first')
+        return AdaptiveSoftmax(opt.actor_hidden_size, opt.actor_cutoffs, opt.vocab_size)
+    return FullSoftmax(opt.actor_hidden_size, opt.vocab_size)
 
 
 class Actor(nn.Module):
@@ -113,54 +294,130 @@ class Actor(nn.Module):
         self.opt = opt
         self.embedding = nn.Embedding(opt.vocab_size, opt.emb_size)
         self.cell = nn.GRUCell(opt.emb_size, opt.actor_hidden_size)
-        self.dist = nn.Linear(opt.actor_hidden_size, opt.vocab_size)
+        self.dist = make_head(opt)
         #self.dist1 = nn.Linear(opt.actor_hidden_size, opt.emb_size)
         #self.dist2 = nn.Linear(opt.emb_size, opt.vocab_size)
         #self.embedding.weight = self.dist2.weight  # tie weights
-        self.zero_input = torch.LongTensor(opt.batch_size).zero_().cuda()
-        self.zero_state = torch.zeros([opt.batch_size, opt.actor_hidden_size]).cuda()
+        # expanded to the batch size in forward
+        self.zero_input = util.maybe_cuda(torch.LongTensor(1).zero_(), opt.cuda)
+        self.zero_state = util.maybe_cuda(torch.zeros([1, opt.actor_hidden_size]), opt.cuda)
 
-    def forward(self):
+    @util.autocast_forward
+    def forward(self, batch_size=None, seq_len=None):
+        '''Sample a batch. Returns the samples, their log probabilities and the entropies of the
+           distributions they were sampled from, all [batch_size, seq_len], and the batch-averaged
+           step-wise probabilities (empty for the adaptive softmax). seq_len defaults to
+           opt.seq_len.'''
+        if batch_size is None:
+            batch_size = self.opt.batch_size
+        if seq_len is None:
+            seq_len = self.opt.seq_len
+        if self.opt.pack_sequences:
+            return self.forward_until_end(batch_size, seq_len)
         outputs = []
         all_logprobs = []
-        all_probs = []
+        all_entropies = []
         probs = []  # for debugging
-        hidden = Variable(self.zero_state)
-        inputs = self.embedding(Variable(self.zero_input))
-        for out_i in xrange(self.opt.seq_len):
+        hidden = Variable(self.zero_state.expand(batch_size, self.opt.actor_hidden_size))
+        inputs = self.embedding(Variable(self.zero_input.expand(batch_size)))
+        for out_i in xrange(seq_len):
             hidden = self.cell(inputs, hidden)
-            #dist = F.log_softmax(self.dist2(self.dist1(hidden)))
-            dist = F.log_softmax(self.dist(hidden))
-            all_logprobs.append(dist.unsqueeze(1))
-            prob = torch.exp(dist)
-            all_probs.append(prob.unsqueeze(1))
-            prob_new = prob.detach()
-            probs.append(prob.data.mean(0).squeeze(0).cpu().numpy())  # for debugging
-            sampled = torch.multinomial(prob_new, 1)
-            outputs.append(sampled)
-            if out_i < self.opt.seq_len - 1:
-                inputs = self.embedding(sampled.squeeze(1))
-        return (torch.cat(outputs, 1), torch.cat(all_logprobs, 1), torch.cat(all_probs, 1),
+            sampled, logprob, entropy, prob = self.dist.sample(hidden)
+            all_logprobs.append(logprob.unsqueeze(1))
+            all_entropies.append(entropy.unsqueeze(1))
+            if prob is not None:
+                probs.append(prob.data.mean(0).cpu().numpy())  # for debugging
+            outputs.append(sampled.unsqueeze(1))
+            if out_i < seq_len - 1:
+                inputs = self.embedding(sampled)
+        return (torch.cat(outputs, 1), torch.cat(all_logprobs, 1), torch.cat(all_entropies, 1),
                 np.array(probs))
 
+    def forward_until_end(self, batch_size, seq_len):
+        '''Like forward, but each row ends at its first <e>, and only the rows that have not ended
+           are computed. Ended rows are padded with <p>, with log probability and entropy 0.'''
+        outputs = []
+        all_logprobs = []
+        all_entropies = []
+        probs = []  # for debugging
+        pad = self.zero_input.new_full((batch_size,), self.opt.pad_token)
+        zeros = self.zero_state.new_zeros(batch_size)
+        active = util.maybe_cuda(torch.arange(batch_size), self.opt.cuda)
+        hidden = self.zero_state.expand(batch_size, self.opt.actor_hidden_size)
+        inputs = self.embedding(self.zero_input.expand(batch_size))
+        for out_i in xrange(seq_len):
+            if not active.numel():
+                outputs.append(pad.unsqueeze(1))
+                all_logprobs.append(zeros.unsqueeze(1))
+                all_entropies.append(zeros.unsqueeze(1))
+                continue
+            hidden = self.cell(inputs, hidden)
+            sampled, logprob, entropy, prob = self.dist.sample(hidden)
+            outputs.append(pad.index_copy(0, active, sampled).unsqueeze(1))
+            all_logprobs.append(zeros.index_copy(0, active, logprob).unsqueeze(1))
+            all_entropies.append(zeros.index_copy(0, active, entropy).unsqueeze(1))
+            if prob is not None:
+                probs.append(prob.data.mean(0).cpu().numpy())  # for debugging, of active rows
+            keep = (sampled != self.opt.end_token).nonzero().squeeze(1)
+            active = active[keep]
+            hidden = hidden[keep]
+            inputs = self.embedding(sampled[keep])
+        return (torch.cat(outputs, 1), torch.cat(all_logprobs, 1), torch.cat(all_entropies, 1),
+                np.array(probs))
 
-if __name__ == '__main__':
+
+def gradient_penalty(opt, disc, real, generated):
+    '''The gradient penalty loss of disc at random interpolations of the real and generated
+       one-hot batches'''
+    disc.gradient_penalize = True
+    costs, inputs = disc((real, generated))
+    disc.gradient_penalize = False
+    costs = costs * inputs[:, 1:]
+    loss = ((opt.real_multiplier + 1) / 2) * costs.sum()
+    inputs_grad, = autograd.grad([loss], [inputs], create_graph=True)
+    inputs_grad = inputs_grad.view(real.size(0), -1)
+    norm_sq = (inputs_grad ** 2).sum(1)
+    norm_errors = norm_sq - 2 * torch.sqrt(norm_sq) + 1
+    return opt.gradient_penalty * norm_errors.sum() / real.size(0)
+
+
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--load_actor', type=str, default='', help='actor load file')
+    parser.add_argument('--pretrain_actor', type=str, default='',
+                        help='start the actor from the weights in this file, like the actor '
+                             'trained by rnn.py. --burnin can then be lowered')
     parser.add_argument('--load_disc', type=str, default='', help='disc load file')
     parser.add_argument('--load_critic', type=str, default='', help='critic load file')
+    parser.add_argument('--load_state', type=str, default='',
+                        help='training state load file, to resume exactly where training stopped')
+    parser.add_argument('--resume', type=int, default=0,
+                        help='resume from the actor, disc, critic and state save files')
     parser.add_argument('--save_actor', type=str, default='',
                         help='actor save file. saves as actor.model in logs by default')
     parser.add_argument('--save_disc', type=str, default='',
                         help='disc save file. saves as disc.model in logs by default')
     parser.add_argument('--save_critic', type=str, default='',
                         help='critic save file. saves as critic.model in logs by default')
+    parser.add_argument('--save_state', type=str, default='',
+                        help='training state save file. saves as state.model in logs by default')
     parser.add_argument('--save_every', type=int, default=500,
                         help='save every these many iters. -1 to disable')
     parser.add_argument('--save_overwrite', type=int, default=1, help='overwrite same save files')
+    parser.add_argument('--replay_compact_every', type=int, default=10,
+                        help='rewrite the whole replay memory every these many saves. other saves '
+                             'only write the rows added since the previous save')
     parser.add_argument('--niter', type=int, default=1000000, help='number of iters to train for')
     parser.add_argument('--batch_size', type=int, default=32, help='batch size')
     parser.add_argument('--seq_len', type=int, default=8, help='sequence length')
+    parser.add_argument('--seq_len_start', type=int, default=0,
+                        help='if > 0, train on prefixes of this length first, and grow them up to '
+                             'seq_len in a curriculum. 0 to always use seq_len')
+    parser.add_argument('--seq_len_step', type=int, default=1,
+                        help='curriculum: increase the length by this amount at a time')
+    parser.add_argument('--seq_len_every', type=int, default=0,
+                        help='curriculum: also increase the length every these many steps. 0 '
+                             'to increase it only when the task is solved at the current length')
     parser.add_argument('--vocab_size', type=int, default=60, help='vocab size for data')
     parser.add_argument('--emb_size', type=int, default=32, help='embedding size')
     parser.add_argument('--actor_hidden_size', type=int, default=256, help='Actor RNN hidden size')
@@ -168,8 +425,22 @@ if __name__ == '__main__':
                         help='Discriminator RNN hidden size')
     parser.add_argument('--critic_hidden_size', type=int, default=256,
                         help='Critic RNN hidden size')
+    parser.add_argument('--actor_softmax', type=str, default='full', choices=['full', 'adaptive'],
+                        help='output layer of the actor. adaptive clusters the rarer words of the '
+                             'lm task, for large word vocabs')
+    parser.add_argument('--softmax_cutoffs', type=str, default='0.9,0.98',
+                        help='adaptive softmax: fractions of the word frequency mass covered by '
+                             'the head and by each cluster but the last')
+    parser.add_argument('--pack_sequences', type=int, default=0,
+                        help='1 to end actor rows at <e> and skip the steps after it in the disc '
+                             'and critic RNNs, for the lm task. the full vocab disc costs (disc '
+                             'entropy, gradient penalty) still run over all steps')
     parser.add_argument('--disc_layers', type=int, default=1)
     parser.add_argument('--disc_dropout', type=float, default=0.0)
+    parser.add_argument('--disc_checkpoint', type=int, default=0,
+                        help='if > 0, recompute the disc RNN activations in backward, in segments '
+                             'of these many steps. saves memory in the disc updates. the gradient '
+                             'penalty is not checkpointed')
     parser.add_argument('--critic_layers', type=int, default=1)
     parser.add_argument('--critic_dropout', type=float, default=0.0)
     parser.add_argument('--freeze_actor', type=int, default=-1,
@@ -200,6 +471,12 @@ if __name__ == '__main__':
                         help='s, use c^2/2s instead of c-(s/2) when abs disc score c<s')
     parser.add_argument('--exp_replay_buffer', type=int, default=0,
                         help='use a replay buffer with an exponential distribution')
+    parser.add_argument('--replay_index', type=int, default=0,
+                        help='1 to count the copies of the replay rows by hash, and log the '
+                             'fraction of duplicate and distinct rows every turn')
+    parser.add_argument('--replay_max_copies', type=int, default=0,
+                        help='if > 0, drop generated rows that already have these many copies in '
+                             'the replay buffer. 1 to deduplicate. implies --replay_index')
     parser.add_argument('--real_multiplier', type=float, default=7.0,  # crucial
                         help='weight for real samples as compared to fake for disc learning')
     parser.add_argument('--replay_actors', type=int, default=10,  # higher with exp buffer
@@ -222,6 +499,18 @@ if __name__ == '__main__':
                         help='number of actor iters per turn')  # crucial
     parser.add_argument('--disc_iters', type=int, default=25,  # 20 or 25 for larger tasks
                         help='number of disc iters per turn')  # crucial
+    parser.add_argument('--iter_schedule', type=str, default='fixed', choices=['fixed', 'adaptive'],
+                        help='fixed to always run the disc/actor iters of a turn. adaptive to '
+                             'end a phase early once its loss stalls, with the iters as maximum')
+    parser.add_argument('--stall_window', type=int, default=5,
+                        help='adaptive schedule: number of iters averaged to detect stalls')
+    parser.add_argument('--stall_tol', type=float, default=0.01,
+                        help='adaptive schedule: a phase stalls if the improvement between '
+                             'windows is below this fraction')
+    parser.add_argument('--min_disc_iters', type=int, default=10,
+                        help='adaptive schedule: minimum disc iters per turn')
+    parser.add_argument('--min_actor_iters', type=int, default=10,
+                        help='adaptive schedule: minimum actor iters per turn')
     parser.add_argument('--burnin', type=int, default=25, help='number of burnin iterations')
     parser.add_argument('--burnin_actor_iters', type=int, default=1)
     parser.add_argument('--burnin_disc_iters', type=int, default=100)
@@ -232,15 +521,98 @@ if __name__ == '__main__':
     parser.add_argument('--lm_word_vocab', type=int, default=1000,
                         help='word vocab size for char LM')
     parser.add_argument('--lm_single_word', type=int, default=1, help='single word GAN')
+    parser.add_argument('--lm_bucket', type=int, default=0,
+                        help='if > 0, batch real sequences of similar length, sorting the lengths '
+                             'in buckets of these many batches')
     parser.add_argument('--print_every', type=int, default=25,
                         help='print losses every these many steps')
     parser.add_argument('--plot_every', type=int, default=1,
-                        help='plot losses every these many steps')
+                        help='log metrics for plot.py every these many steps')
+    parser.add_argument('--sync_timers', type=int, default=0,
+                        help='synchronize the device when timing phases. slower, but accurate on GPU')
+    parser.add_argument('--profile_start', type=int, default=-1,
+                        help='record a torch profiler trace starting at this iter. -1 to disable')
+    parser.add_argument('--profile_iters', type=int, default=3,
+                        help='number of iters to record in the profiler trace')
+    parser.add_argument('--live_plot', type=int, default=0,
+                        help='if > 0, run plot.py in the background to redraw the plots from the '
+                             'metrics log every these many seconds')
+    parser.add_argument('--eval_every', type=int, default=0,
+                        help='evaluate on held-out data every these many steps. 0 to disable')
+    parser.add_argument('--eval_split', type=str, default='valid',
+                        help='held-out split of the lm task to evaluate on')
+    parser.add_argument('--eval_batch_size', type=int, default=1024, help='batch size for eval')
+    parser.add_argument('--eval_samples', type=int, default=4096,
+                        help='number of actor samples to score in eval')
+    parser.add_argument('--eval_batches', type=int, default=0,
+                        help='max number of held-out batches in eval. 0 for the whole split')
+    parser.add_argument('--eval_process', type=int, default=0,
+                        help='if > 0, instead evaluate the saved checkpoints in a background '
+                             'process that checks for new ones every these many seconds')
     parser.add_argument('--gen_every', type=int, default=50,
                         help='generate sample every these many steps')
-    opt = parser.parse_args()
-    print(opt)
+    parser.add_argument('--echo_samples', type=int, default=1,
+                        help='also print the generated samples written to samples.jsonl')
+    parser.add_argument('--cuda', type=int, default=1, help='1 to train on the GPU')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='number of CPU threads for torch. 0 to use the default')
+    parser.add_argument('--bf16', type=int, default=0,
+                        help='1 to run the actor, disc and critic under bfloat16 autocast. log '
+                             'softmax, entropies, losses, returns and the gradient penalty norm '
+                             'stay in float32')
+    parser.add_argument('--seed', type=int, default=-1, help='random seed. -1 to not seed')
+    parser.add_argument('--lm_cache', type=int, default=1,
+                        help='cache the tokenized corpus in lm_data_dir')
+    return parser
+
+
+# options that make_task derives from the task, to copy to other options of the same task
+TASK_OPTS = ['vocab_size', 'data_vocab_size', 'actor_cutoffs', 'end_token', 'pad_token']
+
 
+def task_opts(opt):
+    '''The options derived by make_task that are set in opt, as a dict'''
+    return dict((k, getattr(opt, k)) for k in TASK_OPTS if getattr(opt, k, None) is not None)
+
+
+def make_task(opt):
+    '''Create the task named by opt.task. opt.vocab_size is updated to match the task.'''
+    if opt.task == 'words':
+        task = util.WordsTask(opt.seq_len, opt.vocab_size)
+    elif opt.task == 'longterm':
+        task = util.LongtermTask(opt.seq_len, opt.vocab_size)
+    elif opt.task == 'lm':
+        # the requested vocab size is kept, so that the task can be made again from saved options
+        if getattr(opt, 'data_vocab_size', None) is None:
+            opt.data_vocab_size = opt.vocab_size
+        task = util.LMTask(opt.seq_len, opt.data_vocab_size, opt.lm_data_dir, opt.lm_char,
+                           opt.lm_word_vocab, opt.lm_single_word, cache=opt.lm_cache)
+        if task.vocab_size != opt.vocab_size:
+            opt.vocab_size = task.vocab_size
+            print('Updated vocab_size:', opt.vocab_size)
+        if opt.lm_bucket > 0:
+            task.set_bucketing(opt.batch_size, opt.lm_bucket)
+        opt.end_token = task.word2idx['<e>']
+        opt.pad_token = task.word2idx['<p>']
+    else:
+        print('error: invalid task name:', opt.task)
+        sys.exit(1)
+    if opt.pack_sequences and opt.task != 'lm':
+        print('error: packed sequences need the <e> token of the lm task')
+        sys.exit(1)
+    if opt.actor_softmax == 'adaptive':
+        if opt.task != 'lm':
+            print('error: the adaptive softmax needs the word frequencies of the lm task')
+            sys.exit(1)
+        opt.actor_cutoffs = task.frequency_cutoffs([float(m)
+                                                    for m in opt.softmax_cutoffs.split(',')])
+        print('Adaptive softmax cutoffs:', opt.actor_cutoffs)
+    return task
+
+
+def train(opt, task, callback=None):
+    '''Train the imitation GAN on task. If given, callback(cur_iter, stats) is called at the end
+       of every turn, and training stops early if it returns True. Returns the last stats.'''
     # some logging stuff
     opt.save = 'logs/' + opt.name
     if not os.path.exists(opt.save):
@@ -251,15 +623,16 @@ if __name__ == '__main__':
         opt.save_disc = opt.save + '/disc.model'
     if not opt.save_critic:
         opt.save_critic = opt.save + '/critic.model'
-    train_log = open(opt.save + '/train.log', 'w')
+    if not opt.save_state:
+        opt.save_state = opt.save + '/state.model'
+    if opt.resume:
+        opt.load_actor = opt.load_actor or opt.save_actor
+        opt.load_disc = opt.load_disc or opt.save_disc
+        opt.load_critic = opt.load_critic or opt.save_critic
+        opt.load_state = opt.load_state or opt.save_state
+    train_log = open(opt.save + '/train.log', 'a' if opt.load_state else 'w')
+    util.save_opt(opt, opt.save + '/opt.json')
     gamma = opt.gamma
-    colors = cm.rainbow(np.linspace(0, 1, 3))
-    plot_r = []
-    plot_f = []
-    plot_w = []
-    plot_cgnorm = []
-    plot_ctgnorm = []
-    plot_agnorm = []
 
     # TODO replay for critic?
     opt.replay_size = opt.replay_actors * opt.batch_size * opt.disc_iters
@@ -267,27 +640,23 @@ if __name__ == '__main__':
 
     cudnn.enabled = False
     np.set_printoptions(precision=4, threshold=10000, linewidth=200, suppress=True)
-
-    if opt.task == 'words':
-        task = util.WordsTask(opt.seq_len, opt.vocab_size)
-    elif opt.task == 'longterm':
-        task = util.LongtermTask(opt.seq_len, opt.vocab_size)
-    elif opt.task == 'lm':
-        task = util.LMTask(opt.seq_len, opt.vocab_size, opt.lm_data_dir, opt.lm_char,
-                           opt.lm_word_vocab, opt.lm_single_word)
-        if task.vocab_size != opt.vocab_size:
-            opt.vocab_size = task.vocab_size
-            print('Updated vocab_size:', opt.vocab_size)
-    else:
-        print('error: invalid task name:', opt.task)
-        sys.exit(1)
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    if opt.seed >= 0:
+        random.seed(opt.seed)
+        np.random.seed(opt.seed)
+        torch.manual_seed(opt.seed)
+        if opt.cuda:
+            torch.cuda.manual_seed(opt.seed)
+    task.shuffle()
 
     disc = Discriminator(opt)  #.apply(util.weights_init)
     critic = Critic(opt)  #.apply(util.weights_init)
     actor = Actor(opt)  #.apply(util.weights_init)
-    actor.cuda()
-    disc.cuda()
-    critic.cuda()
+    if opt.cuda:
+        actor.cuda()
+        disc.cuda()
+        critic.cuda()
 
     kwargs = {'lr': opt.learning_rate}
     if opt.optimizer == 'Adam':
@@ -303,19 +672,36 @@ if __name__ == '__main__':
         print('Loaded actor from', opt.load_actor)
     else:
         actor_cur_iter = -1
+        if opt.pretrain_actor:  # only the weights, the optimizer and iter start over
+            actor.load_state_dict(torch.load(opt.pretrain_actor,
+                                             map_location=lambda storage, loc: storage)[0])
+            print('Loaded pretrained actor weights from', opt.pretrain_actor)
+    replay_snapshotter = util.ReplaySnapshotter(opt.save_disc + '.replay', opt.replay_compact_every,
+                                                remove_old=opt.save_overwrite)
     if opt.load_disc:
-        state_dict, optimizer_dict, disc_cur_iter, buffer = torch.load(opt.load_disc)
+        state_dict, optimizer_dict, disc_cur_iter, buffer = util.load(opt.load_disc)
         disc.load_state_dict(state_dict)
         disc_optimizer.load_state_dict(optimizer_dict)
+        if isinstance(buffer, dict):  # replay snapshot manifest
+            replay_snapshotter.resume(buffer)
+            buffer = util.load_replay(buffer, util.load)
+        index = bool(opt.replay_index or opt.replay_max_copies)
+        if (buffer.hashes is not None) != index or buffer.max_copies != opt.replay_max_copies:
+            print('Changing the replay index settings of the loaded buffer to --replay_index %d '
+                  '--replay_max_copies %d' % (opt.replay_index, opt.replay_max_copies))
+            buffer.set_index(opt.replay_index, opt.replay_max_copies)
         print('Loaded disc from', opt.load_disc)
     else:
         disc_cur_iter = -1
         assert opt.replay_size >= opt.batch_size
         if opt.exp_replay_buffer:
-            buffer = util.ExponentialReplayMemory(opt.replay_size, opt.replay_size_half)
+            buffer = util.ExponentialReplayMemory(opt.replay_size, opt.replay_size_half,
+                                                  width=opt.seq_len, index=opt.replay_index,
+                                                  max_copies=opt.replay_max_copies)
         else:
-            buffer = util.ReplayMemory(opt.replay_size)
-    if opt.load_actor:
+            buffer = util.ReplayMemory(opt.replay_size, width=opt.seq_len, index=opt.replay_index,
+                                       max_copies=opt.replay_max_copies)
+    if opt.load_critic:
         state_dict, optimizer_dict, critic_cur_iter = torch.load(opt.load_critic)
         critic.load_state_dict(state_dict)
         critic_optimizer.load_state_dict(optimizer_dict)
@@ -326,14 +712,68 @@ if __name__ == '__main__':
 
     solved = 0
     solved_fail = 0
+    # length of the sequences of the curriculum, and the iter it was reached at
+    cur_len = opt.seq_len_start if 0 < opt.seq_len_start < opt.seq_len else opt.seq_len
+    len_start_iter = start_iter
+    stats = {}
     print('\nReal examples:')
     task.display(task.get_data(opt.batch_size))
     print()
-    plot_x = []
+    if opt.load_state:
+        state = util.load(opt.load_state)
+        if state['iter'] != start_iter - 1:
+            print('warning: training state is from iter %d, models are from iter %d' %
+                  (state['iter'], start_iter - 1))
+        start_iter = state['iter'] + 1
+        gamma = state['gamma']
+        solved = state['solved']
+        solved_fail = state['solved_fail']
+        cur_len = state.get('seq_len', cur_len)
+        len_start_iter = state.get('seq_len_iter', len_start_iter)
+        random.setstate(state['rng']['random'])
+        np.random.set_state(state['rng']['numpy'])
+        torch.set_rng_state(state['rng']['torch'])
+        if opt.cuda and state['rng']['cuda'] is not None:
+            torch.cuda.set_rng_state(state['rng']['cuda'])
+        task.load_state_dict(state['task'])
+        print('Loaded training state from', opt.load_state)
+        metrics = util.MetricsLog(opt.save + '/metrics.jsonl', resume_iter=state['iter'])
+    else:
+        metrics = util.MetricsLog(opt.save + '/metrics.jsonl')
+    if opt.live_plot > 0:
+        plotter = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__),
+                                                                 'plot.py'),
+                                    opt.save, '--watch', str(opt.live_plot)])
+    if opt.eval_process > 0:
+        # drop the results of checkpoints from after the resumed iter
+        util.open_jsonl(opt.save + '/eval.jsonl',
+                        resume_iter=state['iter'] if opt.load_state else None).close()
+        evaluator = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__),
+                                                                   'evaluate.py'),
+                                      opt.save, '--watch', str(opt.eval_process)])
+    checkpoint_writer = util.CheckpointWriter()
+    sample_writer = util.SampleWriter(opt.save + '/samples.jsonl', task, opt.echo_samples,
+                                      resume_iter=state['iter'] if opt.load_state else None)
+    if opt.iter_schedule == 'adaptive':
+        # the disc maximizes the W distance, the actor minimizes the costs of its samples
+        disc_stall = util.StallDetector(opt.stall_window, opt.stall_tol, opt.min_disc_iters)
+        actor_stall = util.StallDetector(opt.stall_window, opt.stall_tol, opt.min_actor_iters,
+                                         increasing=False)
+    else:
+        disc_stall = actor_stall = None
+    timer = util.PhaseTimer(torch.cuda.synchronize if opt.cuda and opt.sync_timers else None)
+    profiler = None
     for cur_iter in xrange(start_iter, start_iter + opt.niter):
         if solved >= opt.solved_threshold:
             print('%d: Task solved, exiting.' % cur_iter)
             break
+        if stats.get('stop'):
+            print('%d: Stopped early, exiting.' % cur_iter)
+            break
+        if cur_iter == opt.profile_start:
+            profiler = util.make_profiler(opt.cuda)
+            profiler.__enter__()
+            timer.labels = True
 
         # train disc
         train_disc = opt.freeze_disc < 0 or cur_iter < opt.freeze_disc
@@ -348,63 +788,71 @@ if __name__ == '__main__':
         err_r = []
         err_f = []
         disc_gnorms = []
+        if disc_stall is not None:
+            disc_stall.reset()
         for disc_i in xrange(disc_iters):
             if train_disc:
                 disc.zero_grad()
 
-            generated, _, _, _ = actor()
+            timer.switch('disc_rollout')
+            generated, _, _, _ = actor(seq_len=cur_len)
+            timer.count(opt.batch_size, num_tokens(opt, generated))
+            timer.switch('replay')
             buffer.push(generated.data.cpu().numpy())
-            generated = buffer.sample(opt.batch_size)
-            generated = torch.from_numpy(generated).cuda()
-            costs, _ = disc(generated)
-            norm_costs = costs / costs.sum(2).expand_as(costs)
+            # with a curriculum, replay rows are cut to the current length, and shorter ones are
+            # not sampled
+            generated = buffer.sample(opt.batch_size, cur_len if opt.seq_len_start > 0 else None)
+            generated = util.maybe_cuda(torch.from_numpy(generated), opt.cuda)
+            timer.switch('disc_update')
             if train_disc and opt.disc_entropy_reg > 0:
+                costs, _ = disc(generated)
+                norm_costs = costs / costs.sum(2, keepdim=True)
                 entropy = -((1e-6 + norm_costs) * torch.log(1e-6 + norm_costs)).sum() / \
                           opt.batch_size
+                costs = costs.gather(2, Variable(generated.unsqueeze(2))).squeeze(2)
             else:
                 entropy = 0.0
-            costs = costs.gather(2, Variable(generated.unsqueeze(2))).squeeze(2)
+                costs = disc.action_costs(generated)
             E_generated = costs.sum() / opt.batch_size
             if train_disc:
                 loss = -E_generated - (opt.disc_entropy_reg * entropy)
                 loss.backward()
 
-            real = torch.from_numpy(task.get_data(opt.batch_size)).cuda()
-            costs, _ = disc(real)
-            norm_costs = costs / costs.sum(2).expand_as(costs)
+            timer.switch('data')
+            real = task.get_data(opt.batch_size)[:, :cur_len]
+            real = util.maybe_cuda(torch.from_numpy(real), opt.cuda)
+            timer.switch('disc_update')
             if train_disc and opt.disc_entropy_reg > 0:
+                costs, _ = disc(real)
+                norm_costs = costs / costs.sum(2, keepdim=True)
                 entropy = -((1e-6 + norm_costs) * torch.log(1e-6 + norm_costs)).sum() / \
                           opt.batch_size
+                costs = costs.gather(2, Variable(real.unsqueeze(2))).squeeze(2)
             else:
                 entropy = 0.0
-            costs = costs.gather(2, Variable(real.unsqueeze(2))).squeeze(2)
+                costs = disc.action_costs(real)
             E_real = costs.sum() / opt.batch_size
             if train_disc:
                 loss = (opt.real_multiplier * E_real) - (opt.disc_entropy_reg * entropy)
                 loss.backward()
 
             if train_disc and opt.gradient_penalty > 0:
-                disc.gradient_penalize = True
-                costs, inputs = disc((real, generated))
-                costs = costs * inputs[:, 1:]
-                loss = ((opt.real_multiplier + 1) / 2) * costs.sum()
-                inputs_grad, = autograd.grad([loss], [inputs], create_graph=True)
-                inputs_grad = inputs_grad.view(opt.batch_size, -1)
-                norm_sq = (inputs_grad ** 2).sum(1)
-                norm_errors = norm_sq - 2 * torch.sqrt(norm_sq) + 1
-                loss = opt.gradient_penalty * norm_errors.sum() / opt.batch_size
-                loss.backward()
-                disc.gradient_penalize = False
+                gradient_penalty(opt, disc, real, generated).backward()
 
             disc_gnorms.append(util.gradient_norm(disc.parameters()))
             if train_disc:
                 if opt.max_grad_norm > 0:
-                    nn.utils.clip_grad_norm(disc.parameters(), opt.max_grad_norm)
+                    nn.utils.clip_grad_norm_(disc.parameters(), opt.max_grad_norm)
                 disc_optimizer.step()
-            Wdist = (E_generated - E_real).data[0]
+            Wdist = (E_generated - E_real).item()
             Wdists.append(Wdist)
-            err_r.append(E_real.data[0])
-            err_f.append(E_generated.data[0])
+            err_r.append(E_real.item())
+            err_f.append(E_generated.item())
+            if disc_stall is not None and disc_stall.update(Wdist):
+                break
+
+        # duplicates among this turn's generated rows, an early sign of mode collapse
+        replay_stats = buffer.index_stats() if buffer.hashes is not None else {}
 
         # train actor
         train_actor = opt.freeze_actor < 0 or cur_iter < opt.freeze_actor
@@ -423,26 +871,28 @@ if __name__ == '__main__':
 
         actor_gnorms = []
         critic_gnorms = []
+        if actor_stall is not None:
+            actor_stall.reset()
         for actor_i in xrange(actor_iters):
-            all_generated, all_logprobs, all_probs, avgprobs = actor()
+            timer.switch('actor_rollout')
+            all_generated, all_logprobs, all_entropies, avgprobs = actor(seq_len=cur_len)
+            timer.count(opt.batch_size, num_tokens(opt, all_generated))
+            timer.switch('actor_eval')
             if print_generated:  # last sample is real, for debugging. do not train on it!
-                all_generated = torch.cat([all_generated[:-1],
-                                           torch.from_numpy(task.get_data(1)).cuda()], 0)
+                real = util.maybe_cuda(torch.from_numpy(task.get_data(1)[:, :cur_len]), opt.cuda)
+                all_generated = torch.cat([all_generated[:-1], real], 0)
                 all_logprobs = all_logprobs[:-1]
-                all_probs = all_probs[:-1]
+                all_entropies = all_entropies[:-1]
                 generated = all_generated[:-1]
             else:
                 generated = all_generated
-            logprobs = all_logprobs.gather(2, generated.unsqueeze(2)).squeeze(2)
-            all_costs, _ = disc(all_generated.data)
+            all_costs = disc.action_costs(all_generated.data)
             all_values = critic(all_generated.data)
-            all_costs = all_costs.gather(2, all_generated.unsqueeze(2)).squeeze(2)
-            all_returns = Variable(torch.zeros(all_costs.size()).cuda())
+            all_returns = Variable(util.maybe_cuda(torch.zeros(all_costs.size()), opt.cuda))
             for ret_i in xrange(opt.reward_steps):
                 if ret_i > 0:
-                    cur_costs = torch.cat([all_costs[:, ret_i:],
-                                           Variable(torch.zeros([all_costs.size(0),
-                                                                 ret_i]).cuda())], 1)
+                    zeros = util.maybe_cuda(torch.zeros([all_costs.size(0), ret_i]), opt.cuda)
+                    cur_costs = torch.cat([all_costs[:, ret_i:], Variable(zeros)], 1)
                 else:
                     cur_costs = all_costs
                 # FIXME problem: episode ends suddenly, so the returns at later timesteps are much
@@ -453,9 +903,9 @@ if __name__ == '__main__':
                 #                          use task.inf_horizon
                 all_returns = all_returns + (cur_costs * (gamma ** ret_i))
             if opt.reward_steps > 0:
-                cur_values = torch.cat([all_values[:, opt.reward_steps:],
-                                        Variable(torch.zeros([all_values.size(0),
-                                                              opt.reward_steps]).cuda())], 1)
+                zeros = util.maybe_cuda(torch.zeros([all_values.size(0), opt.reward_steps]),
+                                        opt.cuda)
+                cur_values = torch.cat([all_values[:, opt.reward_steps:], Variable(zeros)], 1)
             else:
                 cur_values = all_values
             all_returns = all_returns + (cur_values * (gamma ** opt.reward_steps))
@@ -464,47 +914,44 @@ if __name__ == '__main__':
                 disadv = all_disadv[:-1]
             else:
                 disadv = all_disadv
+            timer.switch('critic_update')
             if train_critic:
                 critic.zero_grad()
                 loss = (disadv ** 2).sum() / (opt.batch_size - int(print_generated))
-                loss.backward(retain_variables=True)
+                loss.backward(retain_graph=True)
             critic_gnorms.append(util.gradient_norm(critic.parameters()))
             if train_critic:
                 if opt.max_grad_norm > 0:
-                    nn.utils.clip_grad_norm(critic.parameters(), opt.max_grad_norm)
+                    nn.utils.clip_grad_norm_(critic.parameters(), opt.max_grad_norm)
                 critic_optimizer.step()
+            timer.switch('actor_update')
             if train_actor:
-                # this has to be done after critic optimization step since loss.backward() will
-                # accumulate gradients into value function approx as well.
                 actor.zero_grad()
-                loss = (disadv * logprobs).sum() / (opt.batch_size - int(print_generated))
-                entropy = -(all_probs * all_logprobs).sum() / \
-                          (opt.batch_size - int(print_generated))
+                loss = ((disadv.detach() * all_logprobs).sum() /
+                        (opt.batch_size - int(print_generated)))
+                entropy = all_entropies.sum() / (opt.batch_size - int(print_generated))
                 loss -= entropy_reg * entropy
                 loss.backward()
             actor_gnorms.append(util.gradient_norm(actor.parameters()))
             if train_actor:
                 if opt.max_grad_norm > 0:
-                    nn.utils.clip_grad_norm(actor.parameters(), opt.max_grad_norm)
+                    nn.utils.clip_grad_norm_(actor.parameters(), opt.max_grad_norm)
                 actor_optimizer.step()
             if print_generated:
-                # print generated only in the first actor iteration
-                print('Generated (last row is real):')
-                task.display(all_generated.data.cpu().numpy())
-                print()
-                print('Discriminator costs (last row is real):')
-                print(all_costs.data.cpu().numpy(), '\n')
-                print('Discriminator cost sums (last element is real):')
-                print(all_costs.data.cpu().numpy().sum(1), '\n')
-                print('Critic values (last row is real):')
-                print(all_values.data.cpu().numpy(), '\n')
-                print('Critic advantages (last row is real):')
-                print(-all_disadv.data.cpu().numpy(), '\n')
-                if opt.task == 'longterm':
-                    print('Batch-averaged step-wise probs:')
-                    print(avgprobs, '\n')
+                # dump generated only in the first actor iteration, with one copy to the host
+                timer.switch('diagnostics')
+                dump = torch.stack([all_generated.data.float(), all_costs.data, all_values.data,
+                                    -all_disadv.data]).cpu().numpy()
+                sample_writer.write(cur_iter, dump[0].astype(np.int64), dump[1], dump[2], dump[3],
+                                    avgprobs if opt.task == 'longterm' else None)
                 print_generated = False
+            if actor_stall is not None:
+                timer.switch('actor_eval')
+                actor_cost = all_costs.data[:generated.size(0)].sum().item() / generated.size(0)
+                if actor_stall.update(actor_cost):
+                    break
 
+        timer.switch('print')
         if cur_iter % opt.print_every == 0:
             extra = []
             if not train_actor:
@@ -513,6 +960,13 @@ if __name__ == '__main__':
                 extra.append('disc frozen')
             if not train_critic:
                 extra.append('critic frozen')
+            if opt.iter_schedule == 'adaptive':
+                extra.append('%d disc, %d actor iters' % (len(Wdists), len(actor_gnorms)))
+            if cur_len < opt.seq_len:
+                extra.append('seq_len %d' % cur_len)
+            if replay_stats:
+                extra.append('replay %d unique, %.1f%% dup' %
+                             (replay_stats['replay_unique'], 100 * replay_stats['replay_dup_frac']))
             extra = ', '.join(extra)
             print(cur_iter, ':\tWdist:', np.array(Wdists).mean(), '\terr R:',
                   np.array(err_r).mean(), '\terr F:', np.array(err_f).mean(), '\tentropy_reg:',
@@ -521,34 +975,37 @@ if __name__ == '__main__':
             train_log.write('%.4f\t%.4f\t%.4f\n' % (np.array(Wdists).mean(), np.array(err_r).mean(),
                             np.array(err_f).mean()))
             train_log.flush()
+            timing = timer.report()
+            print('\ttiming: %.1f seqs/s\t%.1f tokens/s\t' % (timing['seqs_per_sec'],
+                                                             timing['tokens_per_sec']) +
+                  ', '.join('%s %.1f%%' % (k[5:], 100 * v / timing['seconds'])
+                            for k, v in timing.items() if k.startswith('time_')))
+            timing['iter'] = cur_iter
+            metrics.write(timing)
+        timer.switch('metrics')
         if cur_iter and cur_iter % opt.plot_every == 0:
-            plot_x.append(cur_iter)
-            plot_r.append(np.array(err_r).mean())
-            plot_f.append(np.array(err_f).mean())
-            plot_w.append(np.array(Wdists).mean())
-            fig = plt.figure()
-            x_array = np.array(plot_x)
-            plt.plot(x_array, np.array(plot_w), c=colors[0])
-            plt.plot(x_array, np.array(plot_r), c=colors[1])
-            plt.plot(x_array, np.array(plot_f), c=colors[2])
-            plt.legend(['W dist', 'D(real)', 'D(fake)'], loc=2)
-            fig.savefig(opt.save + '/train.png')
-            plt.close()
-
-            plot_agnorm.append(np.array(actor_gnorms).mean())
-            plot_cgnorm.append(np.array(disc_gnorms).mean())
-            plot_ctgnorm.append(np.array(critic_gnorms).mean())
-            fig = plt.figure()
-            plt.plot(x_array, np.array(plot_agnorm), c=colors[0])
-            plt.plot(x_array, np.array(plot_cgnorm), c=colors[1])
-            plt.plot(x_array, np.array(plot_ctgnorm), c=colors[2])
-            plt.legend(['Actor grad norm', 'Discriminator grad norm', 'Critic grad norm'], loc=2)
-            fig.savefig(opt.save + '/grads.png')
-            plt.close()
+            record = {'iter': cur_iter, 'Wdist': np.array(Wdists).mean(),
+                      'err_r': np.array(err_r).mean(), 'err_f': np.array(err_f).mean(),
+                      'actor_gnorm': np.array(actor_gnorms).mean(),
+                      'disc_gnorm': np.array(disc_gnorms).mean(),
+                      'critic_gnorm': np.array(critic_gnorms).mean(),
+                      'entropy_reg': entropy_reg, 'gamma': gamma, 'solved': solved,
+                      'disc_iters': len(Wdists), 'actor_iters': len(actor_gnorms),
+                      'seq_len': cur_len}
+            record.update(replay_stats)
+            metrics.write(record)
+
+        timer.switch('eval')
+        if opt.eval_every > 0 and opt.eval_process <= 0 and cur_iter % opt.eval_every == 0:
+            results = evaluate.evaluate(opt, task, actor, disc, critic, opt.eval_split)
+            print('%d: eval %s\t%s' % (cur_iter, opt.eval_split, evaluate.format_results(results)))
+            results['iter'] = cur_iter
+            metrics.write(results)
 
         # increment gamma
         gamma = min(1.0, gamma + opt.gamma_inc)
 
+        timer.switch('solved')
         params = [None]
         if opt.task == 'longterm':
             params = [avgprobs]
@@ -567,24 +1024,76 @@ if __name__ == '__main__':
             if reset:
                 solved = 0
                 solved_fail = 0
+        if cur_len < opt.seq_len and (solved >= opt.solved_threshold or (
+                opt.seq_len_every > 0 and cur_iter + 1 - len_start_iter >= opt.seq_len_every)):
+            # only solving the task at the full length ends training
+            cur_len = min(cur_len + opt.seq_len_step, opt.seq_len)
+            len_start_iter = cur_iter + 1
+            solved = 0
+            solved_fail = 0
+            print('%d: Increased the sequence length to %d' % (cur_iter, cur_len))
+        timer.switch('save')
         if opt.save_every > 0 and cur_iter and cur_iter % opt.save_every == 0:
             print('Saving model...')
             save_actor = opt.save_actor
             save_disc = opt.save_disc
             save_critic = opt.save_critic
+            save_state = opt.save_state
             if not opt.save_overwrite:
                 save_actor += ('.%d' % cur_iter)
                 save_disc += ('.%d' % cur_iter)
                 save_critic += ('.%d' % cur_iter)
-            with open(save_actor, 'wb') as f:
-                states = [actor.state_dict(), actor_optimizer.state_dict(), cur_iter]
-                torch.save(states, f)
-                print('Saved actor to', save_actor)
-            with open(save_disc, 'wb') as f:
-                states = [disc.state_dict(), disc_optimizer.state_dict(), cur_iter, buffer]
-                torch.save(states, f)
-                print('Saved disc to', save_disc)
-            with open(save_critic, 'wb') as f:
-                states = [critic.state_dict(), critic_optimizer.state_dict(), cur_iter]
-                torch.save(states, f)
-                print('Saved critic to', save_critic)
+                save_state += ('.%d' % cur_iter)
+            rng = {'random': random.getstate(), 'numpy': np.random.get_state(),
+                   'torch': torch.get_rng_state(),
+                   'cuda': torch.cuda.get_rng_state() if opt.cuda else None}
+            state = {'iter': cur_iter, 'gamma': gamma, 'solved': solved,
+                     'solved_fail': solved_fail, 'seq_len': cur_len, 'seq_len_iter': len_start_iter,
+                     'rng': rng, 'task': task.state_dict()}
+            replay_files, replay_manifest, replay_remove = replay_snapshotter.save(buffer)
+            # the state is written last, so a complete state file implies complete models
+            checkpoint_writer.save(replay_files + [
+                (save_actor, [actor.state_dict(), actor_optimizer.state_dict(), cur_iter]),
+                (save_disc, [disc.state_dict(), disc_optimizer.state_dict(), cur_iter,
+                             replay_manifest]),
+                (save_critic, [critic.state_dict(), critic_optimizer.state_dict(), cur_iter]),
+                (save_state, state)], remove=replay_remove)
+
+        timer.switch('other')
+        if profiler is not None and cur_iter + 1 == opt.profile_start + opt.profile_iters:
+            timer.labels = False
+            profiler.__exit__(None, None, None)
+            profiler.export_chrome_trace(opt.save + '/trace.json')
+            print(profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=25))
+            print('Saved profiler trace to', opt.save + '/trace.json')
+            profiler = None
+
+        stats = {'iter': cur_iter, 'Wdist': np.array(Wdists).mean(),
+                 'err_r': np.array(err_r).mean(), 'err_f': np.array(err_f).mean(),
+                 'solved': solved, 'solved_fail': solved_fail,
+                 'disc_iters': len(Wdists), 'actor_iters': len(actor_gnorms), 'seq_len': cur_len}
+        stats.update(replay_stats)
+        if callback is not None:
+            stats['stop'] = bool(callback(cur_iter, stats))
+    if profiler is not None:
+        profiler.__exit__(None, None, None)
+        profiler.export_chrome_trace(opt.save + '/trace.json')
+    checkpoint_writer.close()
+    sample_writer.close()
+    metrics.close()
+    train_log.close()
+    if opt.eval_process > 0:
+        evaluator.terminate()
+    if opt.live_plot > 0:
+        plotter.terminate()
+        subprocess.call([sys.executable, os.path.join(os.path.dirname(__file__), 'plot.py'),
+                         opt.save])
+    stats['task_solved'] = solved >= opt.solved_threshold
+    return stats
+
+
+if __name__ == '__main__':
+    opt = get_parser().parse_args()
+    print(opt)
+    train(opt, make_task(opt))
+
@@ -0,0 +1,69 @@
+'''Plot the metrics logged by main.py to <save dir>/metrics.jsonl (and eval.jsonl, written by
+evaluate.py) as train.png, grads.png and eval.png.
+
+    python plot.py logs/default               # plot once
+    python plot.py logs/default --watch 60    # redraw every minute while training runs
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+import util
+
+PLOTS = [('train.png', ['Wdist', 'err_r', 'err_f'], ['W dist', 'D(real)', 'D(fake)']),
+         ('grads.png', ['actor_gnorm', 'disc_gnorm', 'critic_gnorm'],
+          ['Actor grad norm', 'Discriminator grad norm', 'Critic grad norm']),
+         ('eval.png', ['eval_Wdist', 'eval_E_real', 'eval_E_fake'],
+          ['Held-out W dist', 'D(held-out real)', 'D(samples)'])]
+LOGS = ['metrics.jsonl', 'eval.jsonl']
+
+
+def plot(save):
+    import matplotlib
+    matplotlib.use('Agg')  # allows for saving images without display
+    import matplotlib.pyplot as plt
+    import matplotlib.cm as cm
+
+    records = []
+    for log in LOGS:
+        if os.path.exists(os.path.join(save, log)):
+            records += util.read_metrics(os.path.join(save, log))
+    colors = cm.rainbow(np.linspace(0, 1, 3))
+    for filename, keys, legend in PLOTS:
+        rows = [r for r in records if all(k in r for k in keys)]
+        if not rows:
+            continue
+        rows.sort(key=lambda r: r['iter'])
+        x_array = np.array([r['iter'] for r in rows])
+        fig = plt.figure()
+        for key, color in zip(keys, colors):
+            plt.plot(x_array, np.array([r[key] for r in rows]), c=color)
+        plt.legend(legend, loc=2)
+        fig.savefig(os.path.join(save, filename))
+        plt.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('save', type=str, help='save directory of the run, like logs/default')
+    parser.add_argument('--watch', type=int, default=0,
+                        help='if > 0, redraw every these many seconds when the log has changed')
+    opt = parser.parse_args()
+
+    log_files = [os.path.join(opt.save, log) for log in LOGS]
+    last_mtimes = None
+    while True:
+        mtimes = [os.path.getmtime(f) if os.path.exists(f) else None for f in log_files]
+        if any(mtimes) and mtimes != last_mtimes:
+            last_mtimes = mtimes
+            plot(opt.save)
+        if opt.watch <= 0:
+            break
+        time.sleep(opt.watch)
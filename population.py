@@ -0,0 +1,557 @@
+'''Train a population of independent imitation GANs in lockstep in one process.
+
+The K members are stacked into batched-parameter modules, so every step runs one batched matmul per
+layer instead of K small ones. Members can differ in their seed (initialization) and in the loss
+weights given with --pop_vary, e.g.
+
+    python population.py --task longterm --cuda 0 --population 8 \\
+        --pop_vary entropy_reg=1e-3,3e-3 real_multiplier=5,7,9,11
+
+A list of n values is tiled over the members, so member k uses value k % n.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+import os
+import random
+from six.moves import xrange
+
+import numpy as np
+import torch
+from torch import autograd
+from torch.autograd import Variable
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+
+import main
+import util
+
+# options that are loss weights, and so can differ between members of the population
+VARIABLE_OPTS = ['entropy_reg', 'real_multiplier', 'gradient_penalty', 'disc_entropy_reg']
+
+
+class BatchedLinear(nn.Module):
+    '''K independent nn.Linear layers. Maps [K, N, in_size] to [K, N, out_size].'''
+
+    def __init__(self, K, in_size, out_size):
+        super(BatchedLinear, self).__init__()
+        self.weight = nn.Parameter(torch.Tensor(K, out_size, in_size))
+        self.bias = nn.Parameter(torch.Tensor(K, out_size))
+        stdv = 1.0 / math.sqrt(in_size)
+        self.weight.data.uniform_(-stdv, stdv)
+        self.bias.data.uniform_(-stdv, stdv)
+
+    def forward(self, inputs):
+        return torch.baddbmm(self.bias.unsqueeze(1), inputs, self.weight.transpose(1, 2))
+
+
+class BatchedEmbedding(nn.Module):
+    '''K independent nn.Embedding tables. Maps [K, ...] indices to [K, ..., emb_size].'''
+
+    def __init__(self, K, vocab_size, emb_size):
+        super(BatchedEmbedding, self).__init__()
+        self.vocab_size = vocab_size
+        self.weight = nn.Parameter(torch.Tensor(K, vocab_size, emb_size).normal_(0, 1))
+
+    def forward(self, indices):
+        K = indices.size(0)
+        offsets = torch.arange(0, K).long() * self.vocab_size
+        offsets = util.maybe_cuda(offsets, indices.is_cuda)
+        offsets = offsets.view(*([K] + [1] * (indices.dim() - 1)))
+        flat = self.weight.view(-1, self.weight.size(2))
+        flat = flat.index_select(0, (indices + offsets).view(-1))
+        return flat.view(*(tuple(indices.size()) + (self.weight.size(2),)))
+
+    def onehot(self, onehot):
+        '''Embed soft one-hot inputs of size [K, ..., vocab_size].'''
+        K = onehot.size(0)
+        flat = torch.bmm(onehot.contiguous().view(K, -1, self.vocab_size), self.weight)
+        return flat.view(*(tuple(onehot.size()[:-1]) + (self.weight.size(2),)))
+
+
+class BatchedGRU(nn.Module):
+    '''K independent GRUs, with parameters named like nn.GRU (or nn.GRUCell if cell=True) so that
+       member k of the state dict loads into the unbatched module.'''
+
+    def __init__(self, K, input_size, hidden_size, num_layers=1, cell=False):
+        super(BatchedGRU, self).__init__()
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        self.suffixes = [''] if cell else ['_l%d' % l for l in xrange(num_layers)]
+        stdv = 1.0 / math.sqrt(hidden_size)
+        for l, suffix in enumerate(self.suffixes):
+            in_size = input_size if l == 0 else hidden_size
+            for name, size in [('weight_ih', (K, 3 * hidden_size, in_size)),
+                               ('weight_hh', (K, 3 * hidden_size, hidden_size)),
+                               ('bias_ih', (K, 3 * hidden_size)),
+                               ('bias_hh', (K, 3 * hidden_size))]:
+                param = nn.Parameter(torch.Tensor(*size).uniform_(-stdv, stdv))
+                setattr(self, name + suffix, param)
+
+    def step(self, inputs, hidden, layer=0):
+        '''One GRU step of the given layer. inputs: [K, B, in_size], hidden: [K, B, hidden_size].'''
+        suffix = self.suffixes[layer]
+        gi = torch.baddbmm(getattr(self, 'bias_ih' + suffix).unsqueeze(1), inputs,
+                           getattr(self, 'weight_ih' + suffix).transpose(1, 2))
+        gh = torch.baddbmm(getattr(self, 'bias_hh' + suffix).unsqueeze(1), hidden,
+                           getattr(self, 'weight_hh' + suffix).transpose(1, 2))
+        i_r, i_z, i_n = gi.chunk(3, 2)
+        h_r, h_z, h_n = gh.chunk(3, 2)
+        resetgate = torch.sigmoid(i_r + h_r)
+        updategate = torch.sigmoid(i_z + h_z)
+        newgate = torch.tanh(i_n + resetgate * h_n)
+        return newgate + updategate * (hidden - newgate)
+
+    def forward(self, inputs, hidden):
+        '''inputs: [K, B, T, in_size], hidden: [num_layers, K, B, hidden_size].
+           Returns the top layer outputs [K, B, T, hidden_size].'''
+        outputs = inputs
+        for l in xrange(self.num_layers):
+            h = hidden[l]
+            steps = []
+            for t in xrange(outputs.size(2)):
+                h = self.step(outputs[:, :, t], h, l)
+                steps.append(h.unsqueeze(2))
+            outputs = torch.cat(steps, 2)
+        return outputs
+
+
+class PopDiscriminator(nn.Module):
+    '''K stacked main.Discriminator networks.'''
+
+    def __init__(self, opt):
+        super(PopDiscriminator, self).__init__()
+        self.opt = opt
+        K = opt.population
+        self.embedding = BatchedEmbedding(K, opt.vocab_size, opt.emb_size)
+        self.rnn = BatchedGRU(K, opt.emb_size, opt.disc_hidden_size, opt.disc_layers)
+        self.cost = BatchedLinear(K, opt.disc_hidden_size, opt.vocab_size)
+        self.zero_input = util.maybe_cuda(torch.LongTensor(K, opt.batch_size, 1).zero_(), opt.cuda)
+        self.zero_state = util.maybe_cuda(torch.zeros([opt.disc_layers, K, opt.batch_size,
+                                                       opt.disc_hidden_size]), opt.cuda)
+        self.gradient_penalize = False
+
+    def forward(self, actions):
+        K = self.opt.population
+        if self.gradient_penalize:
+            # actions is tuple of (real_batch, fake_batch), each [K, B, T]
+            real, fake = actions
+            padded_real = torch.cat([self.zero_input, real], 2).unsqueeze(3)
+            padded_fake = torch.cat([self.zero_input, fake], 2).unsqueeze(3)
+            size = padded_real.size()[:-1] + (self.opt.vocab_size,)
+            onehot_real = util.maybe_cuda(torch.zeros(size), self.opt.cuda).scatter_(3,
+                                                                                    padded_real, 1)
+            onehot_fake = util.maybe_cuda(torch.zeros(size), self.opt.cuda).scatter_(3,
+                                                                                    padded_fake, 1)
+            alpha = util.maybe_cuda(torch.rand(K, real.size(1), 1, 1), self.opt.cuda)
+            onehot_actions = (alpha * onehot_real) + ((1 - alpha) * onehot_fake)
+            onehot_actions = Variable(onehot_actions, requires_grad=True)
+            inputs = self.embedding.onehot(onehot_actions)
+        else:
+            padded_actions = torch.cat([self.zero_input, actions], 2)
+            inputs = self.embedding(Variable(padded_actions))
+            onehot_actions = None
+        outputs = self.rnn(inputs, Variable(self.zero_state))
+        flat_costs = self.cost(outputs.view(K, -1, self.opt.disc_hidden_size))
+        costs = flat_costs.view(K, self.opt.batch_size, self.opt.seq_len + 1, self.opt.vocab_size)
+        costs = costs[:, :, :-1]  # account for the padding
+        costs_abs = torch.abs(costs)
+        if self.opt.smooth_zero > 1e-4:
+            select = (costs_abs >= self.opt.smooth_zero).float()
+            costs_abs = costs_abs - (self.opt.smooth_zero / 2)
+            costs_sq = (costs ** 2) / (self.opt.smooth_zero * 2)
+            return (select * costs_abs) + ((1.0 - select) * costs_sq), onehot_actions
+        else:
+            return costs_abs, onehot_actions
+
+
+class PopCritic(nn.Module):
+    '''K stacked main.Critic networks.'''
+
+    def __init__(self, opt):
+        super(PopCritic, self).__init__()
+        self.opt = opt
+        K = opt.population
+        self.embedding = BatchedEmbedding(K, opt.vocab_size, opt.emb_size)
+        self.rnn = BatchedGRU(K, opt.emb_size, opt.critic_hidden_size, opt.critic_layers)
+        self.value = BatchedLinear(K, opt.critic_hidden_size, 1)
+        self.zero_input = util.maybe_cuda(torch.LongTensor(K, opt.batch_size, 1).zero_(), opt.cuda)
+        self.zero_state = util.maybe_cuda(torch.zeros([opt.critic_layers, K, opt.batch_size,
+                                                       opt.critic_hidden_size]), opt.cuda)
+
+    def forward(self, actions):
+        K = self.opt.population
+        padded_actions = torch.cat([self.zero_input, actions], 2)
+        inputs = self.embedding(Variable(padded_actions))
+        outputs = self.rnn(inputs, Variable(self.zero_state))
+        flat_value = self.value(outputs.view(K, -1, self.opt.critic_hidden_size))
+        value = flat_value.view(K, self.opt.batch_size, self.opt.seq_len + 1)
+        # account for the padding
+        return value[:, :, :-1]
+
+
+class PopActor(nn.Module):
+    '''K stacked main.Actor networks.'''
+
+    def __init__(self, opt):
+        super(PopActor, self).__init__()
+        self.opt = opt
+        K = opt.population
+        self.embedding = BatchedEmbedding(K, opt.vocab_size, opt.emb_size)
+        self.cell = BatchedGRU(K, opt.emb_size, opt.actor_hidden_size, cell=True)
+        self.dist = BatchedLinear(K, opt.actor_hidden_size, opt.vocab_size)
+        self.zero_input = util.maybe_cuda(torch.LongTensor(K, opt.batch_size).zero_(), opt.cuda)
+        self.zero_state = util.maybe_cuda(torch.zeros([K, opt.batch_size,
+                                                       opt.actor_hidden_size]), opt.cuda)
+
+    def forward(self):
+        K = self.opt.population
+        outputs = []
+        all_logprobs = []
+        all_probs = []
+        probs = []  # for debugging
+        hidden = Variable(self.zero_state)
+        inputs = self.embedding(Variable(self.zero_input))
+        for out_i in xrange(self.opt.seq_len):
+            hidden = self.cell.step(inputs, hidden)
+            dist = F.log_softmax(self.dist(hidden), dim=2)
+            all_logprobs.append(dist.unsqueeze(2))
+            prob = torch.exp(dist)
+            all_probs.append(prob.unsqueeze(2))
+            probs.append(prob.data.mean(1).unsqueeze(1))  # for debugging
+            sampled = torch.multinomial(prob.detach().view(-1, self.opt.vocab_size), 1)
+            sampled = sampled.view(K, -1)
+            outputs.append(sampled.unsqueeze(2))
+            if out_i < self.opt.seq_len - 1:
+                inputs = self.embedding(sampled)
+        return (torch.cat(outputs, 2), torch.cat(all_logprobs, 2), torch.cat(all_probs, 2),
+                torch.cat(probs, 1).cpu().numpy())
+
+
+def member_state_dict(state_dict, k):
+    '''Slice member k out of a population module or optimizer state, as a state for the
+       corresponding unbatched module.'''
+    if torch.is_tensor(state_dict):
+        return state_dict[k].clone() if state_dict.dim() else state_dict
+    elif isinstance(state_dict, dict):
+        return type(state_dict)((key, member_state_dict(v, k)) for key, v in state_dict.items())
+    elif isinstance(state_dict, list):
+        return [member_state_dict(v, k) for v in state_dict]
+    return state_dict
+
+
+def clip_member_grads(parameters, K, max_norm):
+    '''Clip the gradient of each member separately, as main.py would for a single model. Returns
+       the per-member gradient norms.'''
+    parameters = [p for p in parameters if p.grad is not None]
+    norms = 0
+    for p in parameters:
+        norms = norms + (p.grad.data.view(K, -1) ** 2).sum(1)
+    norms = norms ** 0.5
+    if max_norm > 0:
+        scale = (max_norm / (norms + 1e-6)).clamp(max=1.0)
+        for p in parameters:
+            p.grad.data.mul_(scale.view(*([K] + [1] * (p.dim() - 1))))
+    return norms.cpu().numpy()
+
+
+def parse_vary(opt):
+    '''Returns {option: numpy array of its value for each member} for the options in opt.pop_vary.
+       Options not given are the same for all members.'''
+    values = {}
+    for name in VARIABLE_OPTS:
+        values[name] = np.ones(opt.population) * getattr(opt, name)
+    for item in opt.pop_vary:
+        name, _, member_values = item.partition('=')
+        if name not in VARIABLE_OPTS:
+            raise ValueError('%s cannot vary across the population, only %s' %
+                             (name, ', '.join(VARIABLE_OPTS)))
+        member_values = [float(v) for v in member_values.split(',')]
+        values[name] = np.array([member_values[k % len(member_values)]
+                                 for k in xrange(opt.population)])
+    return values
+
+
+def train_population(opt, task):
+    K = opt.population
+    B = opt.batch_size
+    opt.save = 'logs/' + opt.name
+    if not os.path.exists(opt.save):
+        os.makedirs(opt.save)
+    train_log = open(opt.save + '/train.log', 'w')
+    gamma = opt.gamma
+    opt.replay_size = opt.replay_actors * B * opt.disc_iters
+    opt.replay_size_half = opt.replay_actors_half * B * opt.disc_iters
+    if opt.disc_dropout > 0 or opt.critic_dropout > 0:
+        raise ValueError('dropout is not supported in population training')
+    if opt.actor_softmax != 'full':
+        raise ValueError('the adaptive softmax is not supported in population training')
+    if opt.pack_sequences:
+        raise ValueError('packed sequences are not supported in population training')
+    if opt.seq_len_start > 0:
+        raise ValueError('the sequence length curriculum is not supported in population training')
+    if opt.bf16:
+        raise ValueError('bfloat16 autocast is not supported in population training')
+    np.set_printoptions(precision=4, threshold=10000, linewidth=200, suppress=True)
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    if opt.seed >= 0:
+        random.seed(opt.seed)
+        np.random.seed(opt.seed)
+        torch.manual_seed(opt.seed)
+        if opt.cuda:
+            torch.cuda.manual_seed(opt.seed)
+    task.shuffle()
+
+    vary = parse_vary(opt)
+    for name in VARIABLE_OPTS:
+        print('%s:' % name, vary[name])
+    # skip the work for terms that are disabled for every member
+    use_disc_entropy = (vary['disc_entropy_reg'] > 0).any()
+    use_gradient_penalty = (vary['gradient_penalty'] > 0).any()
+
+    def member_weights(name):
+        return Variable(util.maybe_cuda(torch.from_numpy(vary[name]).float(), opt.cuda))
+
+    real_multiplier = member_weights('real_multiplier')
+    gradient_penalty = member_weights('gradient_penalty')
+    disc_entropy_reg = member_weights('disc_entropy_reg')
+
+    disc = PopDiscriminator(opt)
+    critic = PopCritic(opt)
+    actor = PopActor(opt)
+    if opt.cuda:
+        actor.cuda()
+        disc.cuda()
+        critic.cuda()
+
+    kwargs = {'lr': opt.learning_rate}
+    if opt.optimizer == 'Adam':
+        kwargs['betas'] = (opt.beta1, opt.beta2)
+    elif opt.optimizer not in ['RMSprop', 'SGD', 'Adagrad']:
+        # the optimizer has to be elementwise for a stacked model to train like K separate ones
+        raise ValueError('optimizer not supported in population training: %s' % opt.optimizer)
+    actor_optimizer = getattr(optim, opt.optimizer)(actor.parameters(), **kwargs)
+    disc_optimizer = getattr(optim, opt.optimizer)(disc.parameters(), **kwargs)
+    critic_optimizer = getattr(optim, opt.optimizer)(critic.parameters(), **kwargs)
+
+    assert opt.replay_size >= B
+    if opt.exp_replay_buffer:
+        buffers = [util.ExponentialReplayMemory(opt.replay_size, opt.replay_size_half,
+                                                index=opt.replay_index,
+                                                max_copies=opt.replay_max_copies)
+                   for _ in xrange(K)]
+    else:
+        buffers = [util.ReplayMemory(opt.replay_size, index=opt.replay_index,
+                                     max_copies=opt.replay_max_copies)
+                   for _ in xrange(K)]
+
+    solved = np.zeros(K, dtype=np.int64)
+    solved_fail = np.zeros(K, dtype=np.int64)
+    solved_at = -np.ones(K, dtype=np.int64)
+    for cur_iter in xrange(opt.niter):
+        if (solved_at >= 0).all():
+            print('%d: Task solved by all members, exiting.' % cur_iter)
+            break
+
+        # train disc
+        for param in disc.parameters():
+            param.requires_grad = True
+        disc_iters = opt.burnin_disc_iters if cur_iter < opt.burnin else opt.disc_iters
+        Wdists = []
+        err_r = []
+        err_f = []
+        for disc_i in xrange(disc_iters):
+            disc.zero_grad()
+            generated, _, _, _ = actor()
+            generated = generated.data.cpu().numpy()
+            for k in xrange(K):
+                buffers[k].push(generated[k])
+            generated = np.stack([buffers[k].sample(B) for k in xrange(K)])
+            generated = util.maybe_cuda(torch.from_numpy(generated), opt.cuda)
+            costs, _ = disc(generated)
+            if use_disc_entropy:
+                norm_costs = costs / costs.sum(3, keepdim=True)
+                entropy = -((1e-6 + norm_costs) * torch.log(1e-6 + norm_costs)).sum(3).sum(2)
+                entropy = entropy.sum(1) / B
+            else:
+                entropy = 0.0
+            costs = costs.gather(3, Variable(generated.unsqueeze(3))).squeeze(3)
+            E_generated = costs.sum(2).sum(1) / B  # [K]
+            loss = -E_generated - (disc_entropy_reg * entropy)
+            loss.sum().backward()
+
+            real = task.get_data(K * B).reshape(K, B, -1)
+            real = util.maybe_cuda(torch.from_numpy(real), opt.cuda)
+            costs, _ = disc(real)
+            if use_disc_entropy:
+                norm_costs = costs / costs.sum(3, keepdim=True)
+                entropy = -((1e-6 + norm_costs) * torch.log(1e-6 + norm_costs)).sum(3).sum(2)
+                entropy = entropy.sum(1) / B
+            else:
+                entropy = 0.0
+            costs = costs.gather(3, Variable(real.unsqueeze(3))).squeeze(3)
+            E_real = costs.sum(2).sum(1) / B
+            loss = (real_multiplier * E_real) - (disc_entropy_reg * entropy)
+            loss.sum().backward()
+
+            if use_gradient_penalty:
+                disc.gradient_penalize = True
+                costs, inputs = disc((real, generated))
+                costs = costs * inputs[:, :, 1:]
+                loss = (((real_multiplier + 1) / 2) * costs.view(K, -1).sum(1)).sum()
+                inputs_grad, = autograd.grad([loss], [inputs], create_graph=True)
+                norm_sq = (inputs_grad.view(K, B, -1) ** 2).sum(2)
+                norm_errors = norm_sq - 2 * torch.sqrt(norm_sq) + 1
+                loss = (gradient_penalty * norm_errors.sum(1) / B).sum()
+                loss.backward()
+                disc.gradient_penalize = False
+
+            disc_gnorms = clip_member_grads(disc.parameters(), K, opt.max_grad_norm)
+            disc_optimizer.step()
+            Wdists.append((E_generated - E_real).data.cpu().numpy())
+            err_r.append(E_real.data.cpu().numpy())
+            err_f.append(E_generated.data.cpu().numpy())
+
+        # train actor
+        for param in disc.parameters():
+            param.requires_grad = False  # to avoid computation
+        actor_iters = opt.burnin_actor_iters if cur_iter < opt.burnin else opt.actor_iters
+        entropy_reg = np.maximum(vary['entropy_reg'] * (opt.entropy_decay ** cur_iter),
+                                 opt.entropy_reg_min)
+        entropy_reg_var = Variable(util.maybe_cuda(torch.from_numpy(entropy_reg).float(),
+                                                   opt.cuda))
+        for actor_i in xrange(actor_iters):
+            generated, all_logprobs, all_probs, avgprobs = actor()
+            logprobs = all_logprobs.gather(3, generated.unsqueeze(3)).squeeze(3)
+            costs, _ = disc(generated.data)
+            values = critic(generated.data)
+            costs = costs.gather(3, generated.unsqueeze(3)).squeeze(3)
+            returns = Variable(util.maybe_cuda(torch.zeros(costs.size()), opt.cuda))
+            for ret_i in xrange(opt.reward_steps):
+                if ret_i > 0:
+                    zeros = util.maybe_cuda(torch.zeros([K, B, ret_i]), opt.cuda)
+                    cur_costs = torch.cat([costs[:, :, ret_i:], Variable(zeros)], 2)
+                else:
+                    cur_costs = costs
+                returns = returns + (cur_costs * (gamma ** ret_i))
+            if opt.reward_steps > 0:
+                zeros = util.maybe_cuda(torch.zeros([K, B, opt.reward_steps]), opt.cuda)
+                cur_values = torch.cat([values[:, :, opt.reward_steps:], Variable(zeros)], 2)
+            else:
+                cur_values = values
+            returns = returns + (cur_values * (gamma ** opt.reward_steps))
+            disadv = returns - values
+
+            critic.zero_grad()
+            loss = (disadv ** 2).sum() / B
+            loss.backward(retain_graph=True)
+            critic_gnorms = clip_member_grads(critic.parameters(), K, opt.max_grad_norm)
+            critic_optimizer.step()
+
+            actor.zero_grad()
+            loss = (disadv.detach() * logprobs).view(K, -1).sum(1) / B
+            entropy = -(all_probs * all_logprobs).view(K, -1).sum(1) / B
+            loss = (loss - entropy_reg_var * entropy).sum()
+            loss.backward()
+            actor_gnorms = clip_member_grads(actor.parameters(), K, opt.max_grad_norm)
+            actor_optimizer.step()
+
+        Wdists = np.array(Wdists).mean(0)
+        err_r = np.array(err_r).mean(0)
+        err_f = np.array(err_f).mean(0)
+        if cur_iter % opt.print_every == 0:
+            print(cur_iter, ':\tgamma:', gamma)
+            print('  Wdist:      ', Wdists)
+            print('  err R:      ', err_r)
+            print('  err F:      ', err_f)
+            print('  solved:     ', solved)
+            print('  solved_at:  ', solved_at)
+            print('  grad norms: ', actor_gnorms, disc_gnorms, critic_gnorms)
+            if buffers[0].hashes is not None:
+                replay_stats = [b.index_stats() for b in buffers]
+                print('  replay dup: ', np.array([r['replay_dup_frac'] for r in replay_stats]))
+                print('  replay uniq:', np.array([r['replay_unique_frac'] for r in replay_stats]))
+            train_log.write('\t'.join('%.4f\t%.4f\t%.4f' % m for m in zip(Wdists, err_r, err_f)))
+            train_log.write('\n')
+            train_log.flush()
+        if cur_iter % opt.gen_every == 0:
+            generated_np = generated.data.cpu().numpy()
+            for k in xrange(K):
+                print('Generated by member %d:' % k)
+                task.display(generated_np[k, :2])
+            print()
+
+        # increment gamma
+        gamma = min(1.0, gamma + opt.gamma_inc)
+
+        generated_np = generated.data.cpu().numpy()
+        for k in xrange(K):
+            params = [None]
+            if opt.task == 'longterm':
+                params = [avgprobs[k]]
+            elif opt.task == 'words' or opt.task == 'lm':
+                params = [generated_np[k]]
+            if task.solved(*params):
+                solved[k] += 1
+            else:
+                reset = True
+                if solved[k] > 0:
+                    reset = False
+                    solved_fail[k] += 1
+                    if solved_fail[k] >= opt.solved_max_fail:
+                        reset = True
+                if reset:
+                    solved[k] = 0
+                    solved_fail[k] = 0
+            if solved[k] >= opt.solved_threshold and solved_at[k] < 0:
+                solved_at[k] = cur_iter
+                print('%d: Task solved by member %d.' % (cur_iter, k))
+        if opt.save_every > 0 and cur_iter and cur_iter % opt.save_every == 0:
+            save_members(opt, cur_iter, actor, actor_optimizer, disc, disc_optimizer, buffers,
+                         critic, critic_optimizer)
+    train_log.close()
+    return solved_at
+
+
+def save_members(opt, cur_iter, actor, actor_optimizer, disc, disc_optimizer, buffers, critic,
+                 critic_optimizer):
+    '''Save each member as actor, disc and critic files that main.py can load.'''
+    print('Saving population...')
+    actor_state = actor.state_dict()
+    actor_optimizer_state = actor_optimizer.state_dict()
+    disc_state = disc.state_dict()
+    disc_optimizer_state = disc_optimizer.state_dict()
+    critic_state = critic.state_dict()
+    critic_optimizer_state = critic_optimizer.state_dict()
+    for k in xrange(opt.population):
+        save = os.path.join(opt.save, 'member%d' % k)
+        if not os.path.exists(save):
+            os.makedirs(save)
+        suffix = '' if opt.save_overwrite else ('.%d' % cur_iter)
+        with open(os.path.join(save, 'actor.model' + suffix), 'wb') as f:
+            torch.save([member_state_dict(actor_state, k),
+                        member_state_dict(actor_optimizer_state, k), cur_iter], f)
+        with open(os.path.join(save, 'disc.model' + suffix), 'wb') as f:
+            torch.save([member_state_dict(disc_state, k),
+                        member_state_dict(disc_optimizer_state, k), cur_iter, buffers[k]], f)
+        with open(os.path.join(save, 'critic.model' + suffix), 'wb') as f:
+            torch.save([member_state_dict(critic_state, k),
+                        member_state_dict(critic_optimizer_state, k), cur_iter], f)
+    print('Saved population to', opt.save)
+
+
+if __name__ == '__main__':
+    parser = main.get_parser()
+    parser.add_argument('--population', type=int, default=4, help='number of members')
+    parser.add_argument('--pop_vary', type=str, nargs='*', default=[],
+                        help='per-member values, as option=value1,value2,... for options in ' +
+                             ', '.join(VARIABLE_OPTS))
+    opt = parser.parse_args()
+    print(opt)
+    solved_at = train_population(opt, main.make_task(opt))
+    print('Iteration at which each member solved the task (-1 if not):', solved_at)
@@ -0,0 +1,216 @@
+'''Sample in bulk on the CPU from the saved actor of a run, with int8 dynamically quantized weights.
+
+The GRU cell and the linear layers of the output head are quantized with
+torch.quantization.quantize_dynamic: their weights are stored as int8, and the activations are
+quantized on the fly. The embedding stays in float.
+
+    python quantize.py logs/default --export                # save logs/default/actor.model.int8
+    python quantize.py logs/default --samples 1000000       # write logs/default/samples.txt
+    python quantize.py logs/default --check 8192            # quality drift of int8 vs float
+
+Sequences are written one per line, in chunks of --batch_size as they are sampled. lm sequences
+are decoded with the vocab of the task and end before their first <e>. --check samples as many
+sequences from both actors with the same seeds, and appends the comparison to
+<save dir>/quantize.jsonl.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import copy
+import os
+from six.moves import xrange
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import evaluate
+import main
+import util
+
+
+class LinearHead(nn.Module):
+    '''main.FullSoftmax around a plain nn.Linear, which quantize_dynamic can replace. It does not
+       replace subclasses of nn.Linear.'''
+
+    def __init__(self, full_softmax):
+        super(LinearHead, self).__init__()
+        self.linear = nn.Linear(full_softmax.in_features, full_softmax.out_features)
+        self.linear.load_state_dict(full_softmax.state_dict())
+
+    def sample(self, hidden):
+        return main.sample_logits(self.linear(hidden))
+
+    def log_prob(self, hidden, targets):
+        return main.logits_log_prob(self.linear(hidden), targets)
+
+
+def last_checkpoint(opt):
+    '''Path of the last actor checkpoint of the run'''
+    suffix = evaluate.checkpoint_suffix(opt)
+    return opt.save_actor + (suffix or '')  # the checkpoints of rnn.py have no training state
+
+
+def load_actor(opt, path):
+    '''Load the float actor saved at path, on the GPU if opt.cuda is set. Returns it and its
+       iter.'''
+    actor = main.Actor(opt)
+    state_dict, _, cur_iter = torch.load(path, map_location=lambda storage, loc: storage)
+    actor.load_state_dict(state_dict)
+    actor.eval()
+    return util.maybe_cuda(actor, opt.cuda), cur_iter
+
+
+def quantize(actor):
+    '''An int8 dynamically quantized copy of the CPU actor'''
+    actor = copy.deepcopy(actor)
+    if isinstance(actor.dist, main.FullSoftmax):
+        actor.dist = LinearHead(actor.dist)
+    return torch.quantization.quantize_dynamic(actor, {nn.GRUCell, nn.Linear}, dtype=torch.qint8,
+                                               inplace=True)
+
+
+def load_quantized(path):
+    '''Load an actor exported with --export. Returns it and its iter.'''
+    actor, cur_iter = util.load(path)
+    actor.eval()
+    return actor, cur_iter
+
+
+def decode(task, batch):
+    '''The sequences of the batch as text. lm sequences end before their first <e>.'''
+    if not isinstance(task, util.LMTask):
+        return task.format(batch)
+    mask = task.token_mask(batch) & (batch != task.word2idx['<e>'])
+    sep = '' if task.char_model else ' '
+    return [sep.join(task.idx2word[w] for w in row[keep]) for row, keep in zip(batch, mask)]
+
+
+def sample(actor, num_samples, batch_size):
+    '''Yield num_samples sequences of actor in batches of up to batch_size'''
+    with torch.no_grad():
+        for start in xrange(0, num_samples, batch_size):
+            yield actor(min(batch_size, num_samples - start))[0].numpy()
+
+
+def write_samples(actor, task, path, num_samples, batch_size):
+    '''Stream num_samples decoded sequences of actor to path, one per line'''
+    start = time.time()
+    written = 0
+    with open(path, 'w') as f:
+        for batch in sample(actor, num_samples, batch_size):
+            f.write('\n'.join(decode(task, batch)) + '\n')
+            f.flush()
+            written += batch.shape[0]
+            print('%d/%d sequences\t%.1f seqs/s' % (written, num_samples,
+                                                     written / (time.time() - start)))
+    print('Wrote %d sequences to %s' % (written, path))
+
+
+def log_probs(actor, actions):
+    '''Log probabilities of the actions under actor given the previous ones, [batch, seq_len]'''
+    batch_size = actions.size(0)
+    hidden = actor.zero_state.expand(batch_size, actor.opt.actor_hidden_size).contiguous()
+    inputs = actor.embedding(actor.zero_input.expand(batch_size))
+    logprobs = []
+    with torch.no_grad():
+        for i in xrange(actions.size(1)):
+            hidden = actor.cell(inputs, hidden)
+            logprobs.append(actor.dist.log_prob(hidden, actions[:, i]))
+            inputs = actor.embedding(actions[:, i])
+    return torch.stack(logprobs, 1)
+
+
+def check(actor, quantized, task, num_samples, batch_size, seed=0):
+    '''Compare num_samples sequences of the float and quantized actors, sampled with the same
+       seeds. Returns a dict of the sample quality of both, the fraction of identical sequences,
+       and the drift of the log probabilities of the float samples.'''
+    results = {}
+    samples = {}
+    for name, model in [('float', actor), ('int8', quantized)]:
+        torch.manual_seed(seed)
+        start = time.time()
+        samples[name] = np.concatenate(list(sample(model, num_samples, batch_size)))
+        results[name + '_seqs_per_sec'] = num_samples / (time.time() - start)
+        results[name + '_distinct'] = np.unique(samples[name], axis=0).shape[0] / num_samples
+        for key, value in task.quality(samples[name]).items():
+            results[name + '_' + key] = value
+    results['same_sequences'] = (samples['float'] == samples['int8']).all(1).mean()
+
+    # teacher forced on the float samples, over the tokens up to the end of each sequence
+    drift = nll_float = nll_int8 = 0.0
+    num_tokens = 0
+    for start in xrange(0, num_samples, batch_size):
+        batch = samples['float'][start:start+batch_size]
+        mask = task.token_mask(batch) if isinstance(task, util.LMTask) else np.ones(batch.shape)
+        mask = torch.from_numpy(mask.astype(np.float32))
+        actions = torch.from_numpy(batch)
+        float_logprobs = log_probs(actor, actions)
+        int8_logprobs = log_probs(quantized, actions)
+        drift += ((float_logprobs - int8_logprobs).abs() * mask).sum().item()
+        nll_float -= (float_logprobs * mask).sum().item()
+        nll_int8 -= (int8_logprobs * mask).sum().item()
+        num_tokens += mask.sum().item()
+    results['logprob_drift'] = drift / max(num_tokens, 1)
+    results['float_nll'] = nll_float / max(num_tokens, 1)
+    results['int8_nll'] = nll_int8 / max(num_tokens, 1)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('save', type=str, help='save directory of the run, like logs/default')
+    parser.add_argument('--actor', type=str, default='',
+                        help='actor checkpoint. default the last one of the run')
+    parser.add_argument('--export', type=int, default=0,
+                        help='1 to save the quantized actor next to the checkpoint, as .int8')
+    parser.add_argument('--float', type=int, default=0, help='1 to sample from the float actor')
+    parser.add_argument('--samples', type=int, default=0, help='number of sequences to write')
+    parser.add_argument('--out', type=str, default='',
+                        help='file to write the sequences to. default samples.txt in the run')
+    parser.add_argument('--batch_size', type=int, default=1024,
+                        help='sequences sampled and written at a time')
+    parser.add_argument('--check', type=int, default=0,
+                        help='if > 0, compare these many sequences of the int8 and float actors')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='number of CPU threads for torch. 0 to use the default')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    qopt = parser.parse_args()
+
+    opt = util.load_opt(os.path.join(qopt.save, 'opt.json'))
+    opt.cuda = 0
+    opt.bf16 = 0  # the float actor is the reference for --check
+    if qopt.threads > 0:
+        torch.set_num_threads(qopt.threads)
+    np.random.seed(qopt.seed)
+    torch.manual_seed(qopt.seed)
+    task = main.make_task(opt)
+    path = qopt.actor or last_checkpoint(opt)
+    if path.endswith('.int8'):  # exported before
+        if qopt.float or qopt.check > 0:
+            parser.error('the float actor is needed, not an exported one')
+        actor = None
+        quantized, cur_iter = load_quantized(path)
+    else:
+        actor, cur_iter = load_actor(opt, path)
+        quantized = quantize(actor)
+    print('Loaded actor of iter %d from %s' % (cur_iter, path))
+
+    if qopt.export:
+        torch.save([quantized, cur_iter], path + '.int8')
+        print('Saved quantized actor to', path + '.int8')
+    if qopt.samples > 0:
+        write_samples(actor if qopt.float else quantized, task,
+                      qopt.out or os.path.join(qopt.save, 'samples.txt'), qopt.samples,
+                      qopt.batch_size)
+    if qopt.check > 0:
+        results = check(actor, quantized, task, qopt.check, qopt.batch_size, qopt.seed)
+        results['iter'] = cur_iter
+        log = util.MetricsLog(os.path.join(qopt.save, 'quantize.jsonl'), append=True)
+        log.write(results)
+        log.close()
+        print('\n'.join('%s: %.4f' % (k, v) for k, v in sorted(results.items())))
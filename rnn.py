@@ -1,122 +1,138 @@
+'''Maximum likelihood baseline of the actor, trained with teacher forcing.
+
+The model and task are configured with main.py's flags. The whole sequence is run through a fused
+nn.GRU, whose weights have the layout of the actor's GRUCell. The saved checkpoint can be loaded
+into main.Actor, to start the GAN from the trained policy:
+
+    python rnn.py --name mle --task lm --niter 5000
+    python main.py --task lm --pretrain_actor logs/mle/actor.model
+'''
+
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import argparse
+import os
 from six.moves import xrange
-import sys
 
 import numpy as np
 import torch
-from torch.autograd import Variable
 import torch.backends.cudnn as cudnn
 import torch.nn as nn
-import torch.nn.functional as F
 import torch.optim as optim
 
+import main
 import util
 
+# names of the nn.GRU parameters in the nn.GRUCell of main.Actor
+ACTOR_NAMES = {'rnn.weight_ih_l0': 'cell.weight_ih', 'rnn.weight_hh_l0': 'cell.weight_hh',
+               'rnn.bias_ih_l0': 'cell.bias_ih', 'rnn.bias_hh_l0': 'cell.bias_hh'}
+
 
 class RNN(nn.Module):
-    '''The RNN model.'''
+    '''The RNN model, with the parameters of main.Actor.'''
 
     def __init__(self, opt):
         super(RNN, self).__init__()
         self.opt = opt
         self.embedding = nn.Embedding(opt.vocab_size, opt.emb_size)
-        self.cell = nn.GRUCell(opt.emb_size, opt.hidden_size)
-        self.dist = nn.Linear(opt.hidden_size, opt.vocab_size)
-        self.zero_input = torch.LongTensor(opt.batch_size, 1).zero_().cuda()
-        self.zero_state = torch.zeros([opt.batch_size, opt.hidden_size]).cuda()
-
-    def forward(self, inputs):
-        logprobs = []
-        hidden = Variable(self.zero_state)
-        inputs = torch.cat([Variable(self.zero_input), inputs], 1)
-        for i in xrange(inputs.size(1) - 1):
-            emb = self.embedding(inputs[:, i])
-            hidden = self.cell(emb, hidden)
-            dist = F.log_softmax(self.dist(hidden)).unsqueeze(1)
-            logprobs.append(dist)
-        return torch.cat(logprobs, 1)
-
-    def sample(self):
+        self.rnn = nn.GRU(input_size=opt.emb_size, hidden_size=opt.actor_hidden_size,
+                          batch_first=True)
+        self.dist = main.make_head(opt)
+        # expanded to the batch size in forward
+        self.zero_input = util.maybe_cuda(torch.LongTensor(1, 1).zero_(), opt.cuda)
+
+    def forward(self, actions):
+        '''Log probabilities of the actions, given the previous ones'''
+        batch_size = actions.size(0)
+        inputs = torch.cat([self.zero_input.expand(batch_size, 1), actions[:, :-1]], 1)
+        outputs, _ = self.rnn(self.embedding(inputs))
+        return self.dist.log_prob(outputs, actions)
+
+    def sample(self, batch_size):
         outputs = []
-        hidden = Variable(self.zero_state)
-        inputs = self.embedding(Variable(self.zero_input.squeeze(1), volatile=True))
-        for out_i in xrange(self.opt.seq_len):
-            hidden = self.cell(inputs, hidden)
-            dist = F.log_softmax(self.dist(hidden))
-            _, sampled = torch.max(dist.data -
-                                   torch.log(-torch.log(torch.rand(*dist.size()).cuda())), 1)
-            sampled = Variable(sampled, requires_grad=False)
-            outputs.append(sampled)
-            if out_i < self.opt.seq_len - 1:
-                inputs = self.embedding(sampled.squeeze(1))
+        hidden = None
+        inputs = self.zero_input.expand(batch_size, 1)
+        with torch.no_grad():
+            for _ in xrange(self.opt.seq_len):
+                output, hidden = self.rnn(self.embedding(inputs), hidden)
+                inputs = self.dist.sample(output.squeeze(1))[0].unsqueeze(1)
+                outputs.append(inputs)
         return torch.cat(outputs, 1)
 
+    def actor_state_dict(self):
+        '''The parameters as a state dict of main.Actor'''
+        return {ACTOR_NAMES.get(k, k): v for k, v in self.state_dict().items()}
+
+
+def nll(model, task, opt):
+    '''Mean negative log likelihood per token of the held-out split'''
+    total = 0.0
+    count = 0
+    model.eval()
+    with torch.no_grad():
+        for batch in task.iterate(opt.eval_split, opt.eval_batch_size, opt.eval_batches):
+            real = util.maybe_cuda(torch.from_numpy(batch), opt.cuda)
+            total -= model(real).sum().item()
+            count += real.numel()
+    model.train()
+    return total / max(count, 1)
+
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--niter', type=int, default=100000, help='number of epochs to train for')
-    parser.add_argument('--batch_size', type=int, default=16, help='batch size')
-    parser.add_argument('--seq_len', type=int, default=15, help='toy sequence length')
-    parser.add_argument('--vocab_size', type=int, default=6,
-                        help='character vocab size for toy data')
-    parser.add_argument('--emb_size', type=int, default=32, help='embedding size')
-    parser.add_argument('--hidden_size', type=int, default=128, help='RNN hidden size')
-    parser.add_argument('--learning_rate', type=float, default=0.00005, help='learning rate')
-    parser.add_argument('--clamp_limit', type=float, default=-1)
-    parser.add_argument('--task', type=str, default='longterm', help='longterm or words')
-    parser.add_argument('--print_every', type=int, default=50,
-                        help='print losses every these many steps')
-    parser.add_argument('--gen_every', type=int, default=50,
-                        help='generate sample every these many steps')
+    parser = main.get_parser()
+    parser.set_defaults(name='mle', niter=10000, print_every=100, gen_every=500,
+                        learning_rate=1e-3, beta1=0.9, beta2=0.999, eval_batches=10)
     opt = parser.parse_args()
     print(opt)
 
     cudnn.benchmark = True
     np.set_printoptions(precision=4, threshold=10000, linewidth=200, suppress=True)
-
-    if opt.task == 'words':
-        task = util.WordsTask(opt.seq_len, opt.vocab_size)
-    elif opt.task == 'longterm':
-        task = util.LongtermTask(opt.seq_len, opt.vocab_size)
-    elif opt.task == 'lm':
-        task = util.LMTask(opt.seq_len, opt.vocab_size, opt.lm_data_dir, opt.lm_char)
-        if task.vocab_size != opt.vocab_size:
-            opt.vocab_size = task.vocab_size
-            print('Updated vocab_size:', opt.vocab_size)
-    else:
-        print('error: invalid task name:', opt.task)
-        sys.exit(1)
-
-    model = RNN(opt).apply(util.weights_init)
-    model.cuda()
-    criterion = torch.nn.NLLLoss()
-
-    optimizer = optim.RMSprop(model.parameters(), lr=opt.learning_rate)
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    if opt.seed >= 0:
+        np.random.seed(opt.seed)
+        torch.manual_seed(opt.seed)
+    task = main.make_task(opt)
+    task.shuffle()
+    opt.save = 'logs/' + opt.name
+    if not os.path.exists(opt.save):
+        os.makedirs(opt.save)
+    if not opt.save_actor:
+        opt.save_actor = opt.save + '/actor.model'
+    util.save_opt(opt, opt.save + '/opt.json')
+
+    model = util.maybe_cuda(RNN(opt), opt.cuda)
+    kwargs = {'lr': opt.learning_rate}
+    if opt.optimizer == 'Adam':
+        kwargs['betas'] = (opt.beta1, opt.beta2)
+    optimizer = getattr(optim, opt.optimizer)(model.parameters(), **kwargs)
 
     print('\nReal examples:')
-    print(task.get_data(opt.batch_size), '\n')
-    for epoch in xrange(opt.niter):
-        if opt.clamp_limit > 0.0:
-            for param in model.parameters():
-                param.data.clamp_(-opt.clamp_limit, opt.clamp_limit)
+    task.display(task.get_data(opt.batch_size))
+    print()
+    for cur_iter in xrange(opt.niter):
         model.zero_grad()
-        real = Variable(torch.from_numpy(task.get_data(opt.batch_size)).cuda())
+        real = util.maybe_cuda(torch.from_numpy(task.get_data(opt.batch_size)), opt.cuda)
         logprobs = model(real)
-        loss = criterion(logprobs.view(-1, opt.vocab_size), real.view(-1))
+        loss = -logprobs.mean()
         loss.backward()
+        if opt.max_grad_norm > 0:
+            nn.utils.clip_grad_norm_(model.parameters(), opt.max_grad_norm)
         optimizer.step()
 
-        if epoch % opt.print_every == 0:
-            print(epoch, ': Loss:', loss.data.cpu().numpy()[0])
-        if epoch % opt.gen_every == 0:
-            sampled = model.sample()
+        if cur_iter % opt.print_every == 0:
+            print(cur_iter, ':\tLoss:', loss.item(), '\theld-out loss:', nll(model, task, opt))
+        if cur_iter % opt.gen_every == 0:
             print('Generated:')
-            print(sampled.data.cpu().numpy(), '\n')
+            task.display(model.sample(opt.batch_size).cpu().numpy())
             if opt.task == 'longterm':
-                probs = torch.exp(logprobs).mean(0).squeeze(0).data.cpu().numpy()
-                print('Batch-averaged step-wise probs:')
+                probs = torch.exp(logprobs).mean(0).data.cpu().numpy()
+                print('Batch-averaged step-wise probs of the real actions:')
                 print(probs, '\n')
+        last = cur_iter == opt.niter - 1
+        if last or (opt.save_every > 0 and cur_iter and cur_iter % opt.save_every == 0):
+            # the format of the actor checkpoints of main.py
+            torch.save([model.actor_state_dict(), optimizer.state_dict(), cur_iter],
+                       opt.save_actor)
+            print('Saved actor to', opt.save_actor)
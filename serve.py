@@ -0,0 +1,382 @@
+'''Serve samples of the saved actor of a run over HTTP, on a local port or a Unix socket.
+
+Only the actor and the vocab of the corpus cache are loaded. Concurrent requests are batched into
+single actor rollouts: a rollout starts once --max_batch sequences are queued, or the oldest
+queued request has waited --max_wait_ms.
+
+    python serve.py logs/default --port 8000
+    python serve.py logs/default --socket /tmp/actor.sock --int8 1
+
+    curl 'localhost:8000/sample?n=4&temperature=0.8&top_k=20'
+    curl localhost:8000/sample -d '{"n": 4, "temperature": 0.8, "top_k": 20}'
+    curl localhost:8000/stats
+    curl --unix-socket /tmp/actor.sock localhost/stats
+
+/sample returns the decoded samples and their tokens. lm samples end at their first <e>, which is
+not decoded. /stats returns the request latencies and the throughput.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+from six.moves import BaseHTTPServer
+from six.moves import queue
+from six.moves import socketserver
+from six.moves.urllib.parse import parse_qs, urlparse
+from six.moves import xrange
+import sys
+import threading
+import time
+import traceback
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import main
+import quantize
+import util
+
+
+def vocab_logprobs(dist, hidden):
+    '''Log probabilities of the whole vocab under the output head of the actor'''
+    if isinstance(dist, main.AdaptiveSoftmax):
+        head_logprobs = F.log_softmax(dist.head(hidden), dim=1)
+        logprobs = [head_logprobs[:, :dist.shortlist]]
+        for k, tail in enumerate(dist.tails):
+            cluster = dist.shortlist + k
+            logprobs.append(head_logprobs[:, cluster:cluster+1] +
+                            F.log_softmax(tail(hidden), dim=1))
+        return torch.cat(logprobs, 1)
+    elif isinstance(dist, quantize.LinearHead):
+        return F.log_softmax(dist.linear(hidden), dim=1)
+    return F.log_softmax(dist(hidden), dim=1)
+
+
+def top_k_filter(logits, top_ks):
+    '''Mask all but the top_ks [batch_size] largest logits of each row. 0 keeps the whole row.'''
+    if not (top_ks > 0).any():
+        return logits
+    vocab_size = logits.size(1)
+    top_ks = torch.where(top_ks > 0, top_ks, torch.full_like(top_ks, vocab_size))
+    sorted_logits, _ = logits.sort(1, descending=True)
+    thresholds = sorted_logits.gather(1, top_ks.clamp(max=vocab_size).unsqueeze(1) - 1)
+    return logits.masked_fill(logits < thresholds, -float('inf'))
+
+
+def rollout(actor, temperatures, top_ks, seq_len, end_token=None):
+    '''Sample a sequence for each of the temperatures and top_ks [batch_size]. With end_token, the
+       rollout stops early once all sequences have ended.'''
+    batch_size = temperatures.size(0)
+    hidden = actor.zero_state.expand(batch_size, actor.opt.actor_hidden_size).contiguous()
+    inputs = actor.embedding(actor.zero_input.expand(batch_size))
+    ended = torch.zeros_like(top_ks, dtype=torch.bool)
+    outputs = []
+    with torch.no_grad():
+        for _ in xrange(seq_len):
+            hidden = actor.cell(inputs, hidden)
+            logits = vocab_logprobs(actor.dist, hidden) / temperatures.unsqueeze(1)
+            probs = F.softmax(top_k_filter(logits, top_ks), dim=1)
+            sampled = torch.multinomial(probs, 1).squeeze(1)
+            outputs.append(sampled)
+            if end_token is not None:
+                ended = ended | (sampled == end_token)
+                if ended.all():
+                    break
+            inputs = actor.embedding(sampled)
+    return torch.stack(outputs, 1)
+
+
+class Request(object):
+    def __init__(self, num_samples, temperature, top_k):
+        self.num_samples = num_samples
+        self.temperature = temperature
+        self.top_k = top_k
+        self.start = time.time()
+        self.done = threading.Event()
+        self.tokens = None
+        self.error = None
+
+
+class Stats(object):
+    '''Counts of the served requests and sequences, and the latencies of the last window
+       requests. Updated from the server threads.'''
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.sequences = 0
+        self.tokens = 0
+        self.batches = 0
+        self.rollout_seconds = 0.0
+        self.latencies = collections.deque(maxlen=window)
+
+    def batch(self, num_sequences, num_tokens, seconds):
+        with self.lock:
+            self.batches += 1
+            self.sequences += num_sequences
+            self.tokens += num_tokens
+            self.rollout_seconds += seconds
+
+    def request(self, latency, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            if not error:
+                self.latencies.append(latency)
+
+    def report(self):
+        with self.lock:
+            uptime = time.time() - self.start
+            report = {'uptime': uptime, 'requests': self.requests, 'errors': self.errors,
+                      'sequences': self.sequences, 'tokens': self.tokens, 'batches': self.batches,
+                      'mean_batch_size': self.sequences / max(self.batches, 1),
+                      'seqs_per_sec': self.sequences / uptime,
+                      'tokens_per_sec': self.tokens / uptime,
+                      'rollout_seqs_per_sec': self.sequences / max(self.rollout_seconds, 1e-9)}
+            latencies = np.array(self.latencies) * 1000
+        if latencies.size:
+            report['latency_ms_mean'] = latencies.mean()
+            for p in [50, 90, 99]:
+                report['latency_ms_p%d' % p] = np.percentile(latencies, p)
+        return report
+
+
+class Batcher(object):
+    '''Runs the submitted requests in a worker thread, several at a time in one rollout'''
+
+    def __init__(self, actor, opt, end_token, max_batch, max_wait, stats):
+        self.actor = actor
+        self.opt = opt
+        self.end_token = end_token
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats = stats
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, request):
+        '''Queue the request and wait for its tokens'''
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.tokens
+
+    def _run(self):
+        pending = None
+        while True:
+            batch = [pending if pending is not None else self.queue.get()]
+            pending = None
+            num_rows = batch[0].num_samples
+            while num_rows < self.max_batch:
+                timeout = batch[0].start + self.max_wait - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if num_rows + request.num_samples > self.max_batch:
+                    pending = request  # starts the next batch
+                    break
+                batch.append(request)
+                num_rows += request.num_samples
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        start = time.time()
+        try:
+            temperatures = np.concatenate([[r.temperature] * r.num_samples for r in batch])
+            top_ks = np.concatenate([[r.top_k] * r.num_samples for r in batch])
+            tokens = rollout(self.actor,
+                             util.maybe_cuda(torch.from_numpy(temperatures).float(), self.opt.cuda),
+                             util.maybe_cuda(torch.from_numpy(top_ks).long(), self.opt.cuda),
+                             self.opt.seq_len, self.end_token).cpu().numpy()
+            lengths = [len(row) for row in self.cut(tokens)]
+            self.stats.batch(tokens.shape[0], sum(lengths), time.time() - start)
+            row = 0
+            for request in batch:
+                request.tokens = tokens[row:row+request.num_samples]
+                row += request.num_samples
+        except Exception as e:
+            traceback.print_exc()
+            for request in batch:
+                request.error = e
+        for request in batch:
+            request.done.set()
+
+    def cut(self, tokens):
+        '''The rows of tokens, up to and including their first end token'''
+        if self.end_token is None:
+            return [row for row in tokens]
+        ends = tokens == self.end_token
+        lengths = np.where(ends.any(1), ends.argmax(1) + 1, tokens.shape[1])
+        return [row[:length] for row, length in zip(tokens, lengths)]
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            self.reply(200, self.server.stats.report())
+        elif url.path == '/sample':
+            self.sample({k: v[-1] for k, v in parse_qs(url.query).items()})
+        else:
+            self.reply(404, {'error': 'unknown path: %s' % url.path})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/sample':
+            self.reply(404, {'error': 'unknown path: %s' % url.path})
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            params = json.loads(body.decode('utf-8') or '{}')
+        except ValueError:
+            self.reply(400, {'error': 'the body is not JSON'})
+            return
+        self.sample(params)
+
+    def sample(self, params):
+        server = self.server
+        start = time.time()
+        try:
+            num_samples = int(params.get('n', 1))
+            temperature = float(params.get('temperature', 1.0))
+            top_k = int(params.get('top_k', 0))
+            if not 0 < num_samples <= server.max_samples:
+                raise ValueError('n has to be in 1..%d' % server.max_samples)
+            if temperature <= 0:
+                raise ValueError('temperature has to be positive')
+            if top_k < 0:
+                raise ValueError('top_k has to be non-negative')
+        except (TypeError, ValueError) as e:
+            server.stats.request(time.time() - start, error=True)
+            self.reply(400, {'error': str(e)})
+            return
+        try:
+            tokens = server.batcher.submit(Request(num_samples, temperature, top_k))
+        except Exception as e:
+            server.stats.request(time.time() - start, error=True)
+            self.reply(500, {'error': str(e)})
+            return
+        rows = server.batcher.cut(tokens)
+        latency = time.time() - start
+        server.stats.request(latency)
+        self.reply(200, {'samples': server.decode(rows), 'tokens': [r.tolist() for r in rows],
+                         'latency_ms': latency * 1000})
+
+    def reply(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            sys.stderr.write('%s %s\n' % (self.log_date_time_string(), format % args))
+
+
+class HTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_decoder(opt):
+    '''Function formatting rows of tokens as text, with the vocab of the corpus cache for lm (or of
+       the corpus, if it was not cached), and the end token, or None'''
+    if opt.task != 'lm':
+        return lambda rows: [' '.join(str(w) for w in row) for row in rows], None
+    path = util.LMTask.cache_path(opt.seq_len, opt.data_vocab_size, opt.lm_data_dir, opt.lm_char,
+                                  opt.lm_word_vocab, opt.lm_single_word)
+    if os.path.exists(path):
+        idx2word = util.LMTask.load_vocab(path)
+    else:  # the run did not cache the corpus (--lm_cache 0), tokenize it again for the vocab
+        print('No corpus cache at %s, building the vocab from %s' % (path, opt.lm_data_dir))
+        idx2word = main.make_task(opt).idx2word
+    end_token = idx2word.index('<e>')
+    sep = '' if opt.lm_char else ' '
+    return (lambda rows: [sep.join(idx2word[w] for w in row if w != end_token) for row in rows],
+            end_token)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('save', type=str, help='save directory of the run, like logs/default')
+    parser.add_argument('--actor', type=str, default='',
+                        help='actor checkpoint, or one exported by quantize.py. default the last '
+                             'one of the run')
+    parser.add_argument('--int8', type=int, default=0,
+                        help='1 to quantize the actor to int8 at startup. CPU only')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--socket', type=str, default='',
+                        help='listen on this Unix socket instead of the port')
+    parser.add_argument('--max_batch', type=int, default=256,
+                        help='max number of sequences of the requests batched into a rollout')
+    parser.add_argument('--max_wait_ms', type=float, default=5,
+                        help='max time a request waits for others to batch with')
+    parser.add_argument('--max_samples', type=int, default=1024,
+                        help='max number of sequences per request')
+    parser.add_argument('--cuda', type=int, default=0, help='1 to sample on the GPU')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='number of CPU threads for torch. 0 to use the default')
+    parser.add_argument('--verbose', type=int, default=0, help='1 to log every request')
+    sopt = parser.parse_args()
+
+    start = time.time()
+    opt = util.load_opt(os.path.join(sopt.save, 'opt.json'))
+    opt.cuda = sopt.cuda
+    opt.bf16 = 0
+    if sopt.threads > 0:
+        torch.set_num_threads(sopt.threads)
+    path = sopt.actor or quantize.last_checkpoint(opt)
+    if (sopt.int8 or path.endswith('.int8')) and opt.cuda:
+        parser.error('int8 actors run on the CPU only')
+    if path.endswith('.int8'):
+        actor, cur_iter = quantize.load_quantized(path)
+    else:
+        actor, cur_iter = quantize.load_actor(opt, path)
+        if sopt.int8:
+            actor = quantize.quantize(actor)
+    decode, end_token = make_decoder(opt)
+
+    if sopt.socket:
+        if os.path.exists(sopt.socket):
+            os.remove(sopt.socket)
+        server = UnixHTTPServer(sopt.socket, Handler)
+        address = sopt.socket
+    else:
+        server = HTTPServer((sopt.host, sopt.port), Handler)
+        address = 'http://%s:%d' % (sopt.host, sopt.port)
+    server.stats = Stats()
+    server.batcher = Batcher(actor, opt, end_token, sopt.max_batch, sopt.max_wait_ms / 1000,
+                             server.stats)
+    server.decode = decode
+    server.max_samples = sopt.max_samples
+    server.verbose = sopt.verbose
+    print('Loaded actor of iter %d from %s in %.2fs, serving on %s' %
+          (cur_iter, path, time.time() - start, address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if sopt.socket:
+            os.remove(sopt.socket)
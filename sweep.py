@@ -0,0 +1,247 @@
+'''Train a grid of imitation GAN configurations concurrently on a fixed CPU core budget.
+
+Arguments after -- are passed to main.py for every trial, e.g.
+
+    python sweep.py --name sweep --cores 16 --threads 2 \\
+        --grid entropy_reg=1e-3,5e-4 real_multiplier=5,7 -- --task lm --cuda 0
+
+The task is created once and its tokenized data is shared by all trials. Trials whose best solved
+streak falls behind the others at a rung (every --prune_every turns) are stopped early.
+'''
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import copy
+import itertools
+import math
+import multiprocessing
+import os
+from six.moves import queue
+import sys
+import time
+import traceback
+
+import main
+
+# flags that change the data of the task, which all trials share, or the options derived from it
+TASK_FLAGS = ['task', 'seq_len', 'vocab_size', 'lm_data_dir', 'lm_char', 'lm_word_vocab',
+              'lm_single_word', 'lm_cache', 'lm_bucket', 'actor_softmax', 'softmax_cutoffs']
+
+
+class Trial(object):
+    def __init__(self, index, overrides, opt):
+        self.index = index
+        self.overrides = overrides
+        self.opt = opt
+        self.status = 'pending'
+        self.iters = 0
+        self.solved = 0
+        self.best_solved = 0
+        self.Wdist = float('nan')
+        self.passes = 0  # disc and actor iters, to compare iteration schedules
+        self.start_time = None
+        self.end_time = None
+        self.process = None
+        self.stop = None
+        self.reported = False
+        self.dead_since = None
+        self.rungs_passed = 0
+
+    def desc(self):
+        return ' '.join('%s=%s' % kv for kv in self.overrides)
+
+    def minutes(self):
+        if self.start_time is None:
+            return 0.0
+        return ((self.end_time or time.time()) - self.start_time) / 60
+
+
+def parse_grid(grid, parser):
+    '''Turn ['key=v1,v2', ...] into a list of [(key, value), ...] overrides, one per trial.'''
+    dests = set(action.dest for action in parser._actions)
+    axes = []
+    for item in grid:
+        key, _, values = item.partition('=')
+        if key not in dests:
+            raise ValueError('unknown flag in grid: %s' % key)
+        if key in TASK_FLAGS:
+            raise ValueError('task flags cannot be swept, the task is shared: %s' % key)
+        axes.append([(key, v) for v in values.split(',')])
+    return [list(overrides) for overrides in itertools.product(*axes)]
+
+
+def run_trial(index, opt, task, messages, stop):
+    '''Trial process entry point. Reports progress through the messages queue and stops training
+       once the stop event is set.'''
+    save = os.path.join('logs', opt.name)
+    if not os.path.exists(save):
+        os.makedirs(save)
+    sys.stdout = open(os.path.join(save, 'stdout.log'), 'w', 1)
+    sys.stderr = sys.stdout
+    if opt.task == 'lm' and opt.lm_bucket > 0 and opt.batch_size != task.bucket_batch_size:
+        task.set_bucketing(opt.batch_size, opt.lm_bucket)  # the batch size is swept
+
+    def callback(cur_iter, stats):
+        messages.put((index, 'progress', stats))
+        return stop.is_set()
+
+    try:
+        stats = main.train(opt, task, callback)
+        messages.put((index, 'done', stats))
+    except Exception:
+        traceback.print_exc()
+        messages.put((index, 'failed', traceback.format_exc()))
+
+
+def prune(trials, rung_scores, sweep_opt):
+    '''Stop running trials whose best solved streak at their last rung is below the top
+       keep fraction of all trials that reached that rung.'''
+    for trial in trials:
+        if trial.status != 'running' or not trial.rungs_passed:
+            continue
+        scores = sorted(rung_scores[trial.rungs_passed], reverse=True)
+        if len(scores) < sweep_opt.min_trials:
+            continue
+        cutoff = scores[int(math.ceil(len(scores) * sweep_opt.keep)) - 1]
+        if trial.best_solved < cutoff:
+            print('Pruning trial %d (%s) at iter %d: best solved %d < %d' %
+                  (trial.index, trial.desc(), trial.iters, trial.best_solved, cutoff))
+            trial.stop.set()
+            trial.status = 'pruning'
+
+
+def print_table(trials, out=None):
+    header = ['trial', 'status', 'iters', 'passes', 'best_solved', 'Wdist', 'minutes', 'config']
+    rows = []
+    for trial in trials:
+        rows.append([str(trial.index), trial.status, str(trial.iters), str(trial.passes),
+                     str(trial.best_solved), '%.4f' % trial.Wdist, '%.1f' % trial.minutes(),
+                     trial.desc()])
+    widths = [max(len(r[i]) for r in rows + [header]) for i in range(len(header))]
+    for row in [header] + rows:
+        print('  '.join(c.ljust(w) for c, w in zip(row, widths)).rstrip())
+    if out is not None:
+        with open(out, 'w') as f:
+            for row in [header] + rows:
+                f.write('\t'.join(row) + '\n')
+
+
+def sort_key(trial):
+    return (trial.status == 'solved', trial.best_solved, -trial.iters)
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if '--' in argv:
+        train_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    else:
+        train_args = []
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--name', type=str, default='sweep')
+    parser.add_argument('--grid', type=str, nargs='+', default=[],
+                        help='flags to sweep over, as flag=value1,value2,...')
+    parser.add_argument('--cores', type=int, default=multiprocessing.cpu_count(),
+                        help='total number of CPU cores to use')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads per trial')
+    parser.add_argument('--prune_every', type=int, default=100,
+                        help='compare trials every these many turns. -1 to disable pruning')
+    parser.add_argument('--keep', type=float, default=0.5,
+                        help='fraction of trials at a rung that are allowed to continue')
+    parser.add_argument('--min_trials', type=int, default=3,
+                        help='minimum number of trials at a rung before any is pruned')
+    parser.add_argument('--poll', type=float, default=1.0, help='seconds between status checks')
+    sweep_opt = parser.parse_args(argv)
+    print(sweep_opt)
+
+    main_parser = main.get_parser()
+    base_opt = main_parser.parse_args(train_args)
+    task = main.make_task(base_opt)
+    task.share_memory()
+
+    trials = []
+    for index, overrides in enumerate(parse_grid(sweep_opt.grid, main_parser)):
+        args = copy.copy(train_args)
+        for key, value in overrides:
+            args += ['--' + key, value]
+        opt = main_parser.parse_args(args)
+        for key, value in main.task_opts(base_opt).items():
+            setattr(opt, key, value)
+        opt.name = '%s/trial%d' % (sweep_opt.name, index)
+        opt.threads = sweep_opt.threads
+        if opt.seed < 0:
+            opt.seed = index
+        trials.append(Trial(index, overrides, opt))
+    print('%d trials, %d at a time' % (len(trials), max(1, sweep_opt.cores // sweep_opt.threads)))
+
+    if hasattr(multiprocessing, 'get_context'):
+        mp = multiprocessing.get_context('fork')  # the shared task is inherited, not pickled
+    else:
+        mp = multiprocessing
+    messages = mp.Queue()
+    rung_scores = {}
+    pending = list(trials)
+    while pending or any(t.process is not None for t in trials):
+        running = [t for t in trials if t.process is not None]
+        while pending and len(running) < max(1, sweep_opt.cores // sweep_opt.threads):
+            trial = pending.pop(0)
+            trial.stop = mp.Event()
+            trial.process = mp.Process(target=run_trial,
+                                       args=(trial.index, trial.opt, task, messages, trial.stop))
+            trial.process.start()
+            trial.status = 'running'
+            trial.start_time = time.time()
+            running.append(trial)
+            print('Started trial %d: %s' % (trial.index, trial.desc()))
+
+        try:
+            index, kind, payload = messages.get(timeout=sweep_opt.poll)
+        except queue.Empty:
+            index, kind = None, None
+        if index is not None:
+            trial = trials[index]
+            if kind == 'progress':
+                trial.iters = payload['iter'] + 1
+                trial.solved = payload['solved']
+                trial.best_solved = max(trial.best_solved, trial.solved)
+                trial.Wdist = payload['Wdist']
+                trial.passes += payload['disc_iters'] + payload['actor_iters']
+                if sweep_opt.prune_every > 0 and trial.iters % sweep_opt.prune_every == 0:
+                    trial.rungs_passed = trial.iters // sweep_opt.prune_every
+                    rung_scores.setdefault(trial.rungs_passed, []).append(trial.best_solved)
+                    prune(trials, rung_scores, sweep_opt)
+            elif kind == 'done':
+                trial.reported = True
+                if payload.get('task_solved'):
+                    trial.status = 'solved'
+                elif trial.status == 'pruning':
+                    trial.status = 'pruned'
+                else:
+                    trial.status = 'done'
+            else:
+                trial.reported = True
+                trial.status = 'failed'
+                print('Trial %d failed:\n%s' % (index, payload))
+
+        for trial in trials:
+            if trial.process is None or trial.process.is_alive():
+                continue
+            if trial.dead_since is None:
+                trial.dead_since = time.time()
+            # give the final report of the trial some time to arrive
+            if trial.reported or time.time() - trial.dead_since > 5 * sweep_opt.poll:
+                trial.process.join()
+                trial.process = None
+                trial.end_time = time.time()
+                if not trial.reported:
+                    trial.status = 'failed'
+
+    print()
+    trials.sort(key=sort_key, reverse=True)
+    save = os.path.join('logs', sweep_opt.name)
+    if not os.path.exists(save):
+        os.makedirs(save)
+    print_table(trials, os.path.join(save, 'results.tsv'))
@@ -2,64 +2,249 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import argparse
 import collections
+import copy
+import ctypes
+import functools
+import json
+import multiprocessing
 import os
 import random
+from six.moves import queue
 from six.moves import xrange
+import threading
+import time
+import traceback
 
 import numpy as np
+import torch
 import torch.nn as nn
 
 
 class ReplayMemory(object):
-    def __init__(self, capacity):
+    '''Ring buffer of generated sequences, sampled uniformly. With width, rows narrower than it
+       are padded with -1, and the length of each row is kept so that sampling can be restricted
+       to rows of at least a given length.
+
+       With index, the number of copies of each distinct row in memory is counted by the hash of
+       its tokens, for the statistics of index_stats(). With max_copies > 0, pushed rows that
+       already have that many copies in memory are dropped. 1 deduplicates the memory.'''
+
+    def __init__(self, capacity, width=None, index=False, max_copies=0):
         self.capacity = capacity
-        self.memory = []
+        self.width = width
+        self.memory = None  # allocated on the first push, when the row shape is known
+        self.lengths = np.zeros(capacity, dtype=np.int64)
+        self.size = 0
         self.position = 0
+        self.pushed = 0  # total number of rows ever stored
+        self.max_copies = max_copies
+        self.hashes = None
+        self.set_index(index, max_copies)
+
+    def set_index(self, index, max_copies=0):
+        '''Change the index and max_copies settings of the constructor, e.g. of a loaded memory. A
+           new index is built from the rows in memory. Rows over max_copies that are already in
+           memory are kept.'''
+        self.max_copies = max_copies
+        if not (index or max_copies > 0):
+            self.hashes = None
+            return
+        if self.hashes is not None:
+            return
+        self.hashes = np.zeros(self.capacity, dtype=np.uint64)
+        self.hashed = np.zeros(self.capacity, dtype=bool)  # whether the slot holds a row
+        self.copies = collections.Counter()  # row hash -> number of copies in memory
+        self.offered = 0  # since the last index_stats()
+        self.duplicates = 0
+        self.dropped = 0
+        if self.size > 0:  # the filled slots are the first ones
+            rows = self.memory[:self.size]
+            self.hashes[:self.size] = sequence_hashes(rows, np.ones(rows.shape, dtype=bool))
+            self.hashed[:self.size] = True
+            self.copies.update(self.hashes[:self.size].tolist())
 
     def push(self, generations):
-        for i in xrange(generations.shape[0]):
-            self._push(generations[i])
+        if self.memory is None:
+            shape = generations.shape[1:]
+            if self.width is not None:
+                shape = (self.width,) + shape[1:]
+            self.memory = np.zeros((self.capacity,) + shape, dtype=generations.dtype)
+        if generations.shape[1] < self.memory.shape[1]:
+            padded = np.full((generations.shape[0],) + self.memory.shape[1:], -1,
+                             dtype=self.memory.dtype)
+            padded[:, :generations.shape[1]] = generations
+            generations = padded
+        if self.hashes is not None:
+            generations, hashes = self.deduplicate(generations)
+        if generations.shape[0] > self.capacity:
+            skipped = generations.shape[0] - self.capacity
+            self.position = (self.position + skipped) % self.capacity
+            self.pushed += skipped
+            generations = generations[skipped:]
+            if self.hashes is not None:
+                hashes = hashes[skipped:]
+        n = generations.shape[0]
+        slots = (self.position + np.arange(n)) % self.capacity
+        self.memory[slots] = generations
+        self.lengths[slots] = (generations >= 0).sum(1)
+        if self.hashes is not None:
+            self.copies.subtract(self.hashes[slots[self.hashed[slots]]].tolist())
+            self.copies.update(hashes.tolist())
+            self.copies += collections.Counter()  # drop the rows no longer in memory
+            self.hashes[slots] = hashes
+            self.hashed[slots] = True
+        self.position = (self.position + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+        self.pushed += n
+
+    def deduplicate(self, generations):
+        '''The rows of generations to store and their hashes, without the rows that would exceed
+           max_copies, counting the copies in memory and earlier in generations'''
+        hashes = sequence_hashes(generations, np.ones(generations.shape, dtype=bool))
+        keep = np.ones(generations.shape[0], dtype=bool)
+        pushed = collections.Counter()
+        for i, h in enumerate(hashes.tolist()):
+            copies = self.copies[h] + pushed[h]
+            if copies > 0:
+                self.duplicates += 1
+            if 0 < self.max_copies <= copies:
+                keep[i] = False
+            else:
+                pushed[h] += 1
+        self.offered += generations.shape[0]
+        self.dropped += generations.shape[0] - keep.sum()
+        return generations[keep], hashes[keep]
 
-    def _push(self, generation):
-        if len(self.memory) < self.capacity:
-            self.memory.append(None)
-        self.memory[self.position] = generation
-        self.position = (self.position + 1) % self.capacity
+    def index_stats(self):
+        '''Statistics of the rows pushed since the last call, and of the rows in memory: the
+           fraction of pushed rows that were copies of rows in memory or earlier in their batch,
+           the number of dropped rows, the number of distinct rows in memory and their fraction,
+           and the most copies of a row'''
+        stats = {'replay_dup_frac': self.duplicates / max(self.offered, 1),
+                 'replay_dropped': int(self.dropped), 'replay_unique': len(self.copies),
+                 'replay_unique_frac': len(self.copies) / max(self.size, 1),
+                 'replay_max_copies': max(self.copies.values()) if self.copies else 0}
+        self.offered = 0
+        self.duplicates = 0
+        self.dropped = 0
+        return stats
 
-    def sample(self, batch_size):
-        generations = random.sample(self.memory, batch_size)
-        return np.array(generations)
+    def rows_since(self, pushed):
+        '''The rows still in memory that were pushed after the first `pushed` rows, oldest first'''
+        n = min(self.pushed - pushed, self.size)
+        return self.memory[(self.position - n + np.arange(n)) % self.capacity]
+
+    def sample(self, batch_size, length=None):
+        '''Sample batch_size rows. With length, only rows of at least that length are sampled, and
+           they are cut to it. Rows are sampled with replacement if there are too few of them.'''
+        if length is None:
+            return self.memory[np.random.choice(self.size, size=batch_size,
+                                                replace=self.size < batch_size)]
+        eligible = np.flatnonzero(self.lengths[:self.size] >= length)
+        slots = np.random.choice(eligible, size=batch_size, replace=len(eligible) < batch_size)
+        return self.memory[slots, :length]
 
     def __len__(self):
-        return len(self.memory)
+        return self.size
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'lengths' not in state:  # pickled before the row lengths were kept, all full width
+            self.width = None
+            width = self.memory.shape[1] if self.memory is not None else 0
+            self.lengths = np.full(self.capacity, width, dtype=np.int64)
+        if 'hashes' not in state:  # or the index
+            self.max_copies = 0
+            self.hashes = None
 
-class ExponentialReplayMemory(object):
-    def __init__(self, capacity, half):
-        self.capacity = capacity
-        self.memory = []
+
+class ExponentialReplayMemory(ReplayMemory):
+    '''Ring buffer of generated sequences, sampled with probability decaying exponentially with
+       age, so that the most recent `half` rows make up half of the samples.'''
+
+    def __init__(self, capacity, half, width=None, index=False, max_copies=0):
+        super(ExponentialReplayMemory, self).__init__(capacity, width, index, max_copies)
+        self.half = half
         exp_lambda = np.log(2) / half
-        self.probs = np.array([exp_lambda * np.exp(-exp_lambda * i) for i in xrange(capacity)])
+        self.probs = exp_lambda * np.exp(-exp_lambda * np.arange(capacity))
 
-    def push(self, generations):
-        for i in xrange(generations.shape[0]):
-            self._push(generations[i])
+    def sample(self, batch_size, length=None):
+        if length is None:
+            probs = self.probs[:self.size] / self.probs[:self.size].sum()
+            ages = np.random.choice(self.size, size=batch_size, replace=self.size < batch_size,
+                                    p=probs)
+            return self.memory[(self.position - 1 - ages) % self.capacity]
+        slots = (self.position - 1 - np.arange(self.size)) % self.capacity  # by age
+        probs = self.probs[:self.size] * (self.lengths[slots] >= length)
+        ages = np.random.choice(self.size, size=batch_size, p=probs / probs.sum(),
+                                replace=np.count_nonzero(probs) < batch_size)
+        return self.memory[slots[ages], :length]
 
-    def _push(self, generation):
-        self.memory.insert(0, generation)
-        if len(self.memory) > self.capacity:
-            self.memory.pop()
 
-    def sample(self, batch_size):
-        probs = self.probs[:len(self.memory)]
-        probs /= probs.sum()
-        indices = np.random.choice(len(self.memory), size=batch_size, replace=False, p=probs)
-        generations = [self.memory[i] for i in indices]
-        return np.array(generations)
+class ReplaySnapshotter(object):
+    '''Saves the contents of a replay memory incrementally. The first save writes all rows to a base
+       file, and later saves only write the rows pushed since the previous save to a delta file.
+       Every compact_every saves a new base is written, and the old files are removed once it is
+       on disk. save() returns a small manifest that load_replay() rebuilds the memory from.'''
 
-    def __len__(self):
-        return len(self.memory)
+    def __init__(self, directory, compact_every, remove_old=True):
+        self.directory = directory
+        self.compact_every = compact_every
+        self.remove_old = remove_old
+        self.files = []
+        self.saved = 0  # memory.pushed at the last save
+
+    def resume(self, manifest):
+        '''Continue the chain of files of a loaded manifest, if it was saved to this directory'''
+        directory = os.path.abspath(self.directory)
+        if all(os.path.dirname(os.path.abspath(f)) == directory for f in manifest['files']):
+            self.files = list(manifest['files'])
+            self.saved = manifest['pushed']
+
+    def save(self, memory):
+        '''Returns (files, manifest, remove): the (path, rows) files to write, the manifest, and
+           the paths that are no longer needed once the manifest is written.'''
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        remove = []
+        new_rows = memory.pushed - self.saved
+        if not self.files or len(self.files) >= self.compact_every or new_rows >= memory.size:
+            if self.remove_old:
+                remove = self.files
+            self.files = []
+            start = memory.pushed - memory.size
+        else:
+            start = self.saved
+        path = os.path.join(self.directory, 'rows-%d-%d.replay' % (start, memory.pushed))
+        self.files = self.files + [path]
+        self.saved = memory.pushed
+        manifest = {'class': type(memory).__name__, 'capacity': memory.capacity,
+                    'pushed': memory.pushed, 'files': list(self.files)}
+        if isinstance(memory, ExponentialReplayMemory):
+            manifest['half'] = memory.half
+        if memory.hashes is not None:
+            manifest['max_copies'] = memory.max_copies
+        return [(path, memory.rows_since(start))], manifest, remove
+
+
+def load_replay(manifest, load_fn):
+    '''Rebuild a replay memory from a ReplaySnapshotter manifest. load_fn loads a saved file.'''
+    if manifest['class'] == 'ExponentialReplayMemory':
+        memory = ExponentialReplayMemory(manifest['capacity'], manifest['half'])
+    else:
+        memory = ReplayMemory(manifest['capacity'])
+    rows = [load_fn(path) for path in manifest['files']]
+    # replay the pushes at the ring positions they were originally made at. the files only hold
+    # the rows that were kept, so they are pushed without the index, which could drop some
+    memory.pushed = manifest['pushed'] - sum(r.shape[0] for r in rows)
+    memory.position = memory.pushed % memory.capacity
+    for r in rows:
+        if r.shape[0]:
+            memory.push(r)
+    memory.set_index('max_copies' in manifest, manifest.get('max_copies', 0))
+    return memory
 
 
 def weights_init(m):
@@ -80,6 +265,335 @@ def weights_init(m):
         m.weight.data.uniform_()
 
 
+def maybe_cuda(obj, use_cuda):
+    '''Move a tensor or module to the GPU if use_cuda is set.'''
+    if use_cuda:
+        return obj.cuda()
+    return obj
+
+
+def shared_array(array):
+    '''Copy a numpy array into shared memory, so that forked processes read the same copy.'''
+    raw = multiprocessing.RawArray(ctypes.c_byte, max(array.nbytes, 1))
+    shared = np.frombuffer(raw, dtype=array.dtype, count=array.size).reshape(array.shape)
+    shared[...] = array
+    return shared
+
+
+def autocast(opt):
+    '''A bfloat16 autocast context on the device of opt if opt.bf16 is set, disabled otherwise'''
+    return torch.autocast('cuda' if opt.cuda else 'cpu', dtype=torch.bfloat16,
+                          enabled=bool(opt.bf16))
+
+
+def float32(obj):
+    '''obj with the floating point tensors in it cast to float32'''
+    if torch.is_tensor(obj):
+        return obj.float() if obj.is_floating_point() else obj
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(float32(v) for v in obj)
+    return obj
+
+
+def autocast_forward(method):
+    '''Decorator running a method of a module with an opt under autocast(self.opt). Its tensor
+       results are cast back to float32, so that everything computed from them is in float32.'''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not getattr(self.opt, 'bf16', 0):  # also for the options of older runs
+            return method(self, *args, **kwargs)
+        with autocast(self.opt):
+            return float32(method(self, *args, **kwargs))
+    return wrapper
+
+
+def load(path, **kwargs):
+    '''torch.load for the files saved by training, which hold numpy arrays and other python objects
+       besides tensors. torch >= 2.6 only loads tensors by default.'''
+    return torch.load(path, weights_only=False, **kwargs)
+
+
+def snapshot(obj):
+    '''Copy obj, moving the tensors in it to the CPU, so that the copy is not affected by further
+       training.'''
+    if torch.is_tensor(obj):
+        return obj.cpu().clone()
+    elif isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+class CheckpointWriter(object):
+    '''Writes checkpoints in a background thread. Each file is written to a temporary file, synced
+       to disk and then renamed over the old file, so a crash never leaves a partial checkpoint.'''
+
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def save(self, files, remove=()):
+        '''files is a list of (path, states). The states are copied before this returns, so training
+           can continue while they are being written. The paths in remove are deleted once all
+           files are written.'''
+        self.wait()
+        files = [(path, snapshot(states)) for path, states in files]
+        self.thread = threading.Thread(target=self._write, args=(files, list(remove)))
+        self.thread.start()
+
+    def _write(self, files, remove):
+        try:
+            for path, states in files:
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    torch.save(states, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmp_path, path)
+                print('Saved', path)
+            # make the renames durable too
+            for dirname in set(os.path.dirname(os.path.abspath(p)) for p, _ in files):
+                fd = os.open(dirname, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            for path in remove:
+                if os.path.exists(path):
+                    os.remove(path)
+        except Exception:
+            self.error = traceback.format_exc()
+
+    def wait(self):
+        '''Block until the checkpoint being written, if any, is on disk.'''
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise IOError('writing checkpoint failed:\n' + error)
+
+    def close(self):
+        self.wait()
+
+
+def open_jsonl(path, resume_iter=None):
+    '''Open a JSON lines log for appending. When resuming, the records logged after resume_iter are
+       dropped, otherwise the log is started over.'''
+    if resume_iter is not None and os.path.exists(path):
+        with open(path, 'r') as f:
+            lines = [l for l in f if l.strip() and json.loads(l).get('iter', -1) <= resume_iter]
+        with open(path, 'w') as f:
+            f.writelines(lines)
+        return open(path, 'a')
+    return open(path, 'w')
+
+
+class MetricsLog(object):
+    '''Appends metrics as one JSON record per line, for plot.py and other offline tools.'''
+
+    def __init__(self, path, resume_iter=None, append=False):
+        self.path = path
+        if append:
+            self.file = open(path, 'a')
+        else:
+            self.file = open_jsonl(path, resume_iter)
+
+    def write(self, record):
+        self.file.write(json.dumps(record, default=lambda x: x.item()) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class SampleWriter(object):
+    '''Formats generated samples and their costs, values and advantages in a background thread,
+       and appends them to a JSON lines file (and stdout if echo is set).'''
+
+    def __init__(self, path, task, echo=True, resume_iter=None):
+        self.task = task
+        self.echo = echo
+        self.file = open_jsonl(path, resume_iter)
+        self.queue = queue.Queue(maxsize=8)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True  # so that a crash in training does not hang on exit
+        self.thread.start()
+
+    def write(self, cur_iter, generated, costs, values, advantages, avgprobs=None):
+        '''Queue host arrays of size [batch, seq_len]. The last row is expected to be real data.'''
+        self._put((cur_iter, generated, costs, values, advantages, avgprobs))
+
+    def _put(self, item):
+        # the thread may stop with a full queue, so do not block on it forever
+        while True:
+            self.check()
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def check(self):
+        '''Raise if the writing thread failed.'''
+        if self.error is not None:
+            raise IOError('writing samples failed:\n' + self.error)
+        if not self.thread.is_alive():
+            raise IOError('the sample writing thread stopped')
+
+    def _run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                self._write(*item)
+        except Exception:
+            self.error = traceback.format_exc()
+
+    def _write(self, cur_iter, generated, costs, values, advantages, avgprobs):
+        texts = self.task.format(generated)
+        samples = []
+        for i in xrange(generated.shape[0]):
+            samples.append({'text': texts[i], 'real': i == generated.shape[0] - 1,
+                            'tokens': generated[i].tolist(), 'costs': costs[i].tolist(),
+                            'cost_sum': float(costs[i].sum()), 'values': values[i].tolist(),
+                            'advantages': advantages[i].tolist()})
+        record = {'iter': cur_iter, 'samples': samples}
+        if avgprobs is not None:
+            record['avgprobs'] = avgprobs.tolist()
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        if self.echo:
+            print('%d: Generated (last row is real):\n' % cur_iter +
+                  '\n'.join('=> ' + t for t in texts) + '\n')
+
+    def close(self):
+        try:
+            if self.error is None and self.thread.is_alive():
+                self._put(None)
+            self.thread.join()
+        finally:
+            self.file.close()
+        if self.error is not None:
+            raise IOError('writing samples failed:\n' + self.error)
+
+
+class PhaseTimer(object):
+    '''Splits wall-clock time into named phases. switch(name) ends the current phase and starts the
+       next one. If given, sync is called at every switch, so that asynchronous device work is
+       charged to the phase that queued it. With labels set, phases are also marked in profiler
+       traces.'''
+
+    def __init__(self, sync=None):
+        self.sync = sync
+        self.labels = False
+        self.phase = None
+        self.label = None
+        self.reset()
+
+    def reset(self):
+        self.totals = collections.OrderedDict()
+        self.sequences = 0
+        self.tokens = 0
+        self.start = self.last = time.time()
+
+    def switch(self, name):
+        if self.sync is not None:
+            self.sync()
+        now = time.time()
+        if self.phase is not None:
+            self.totals[self.phase] = self.totals.get(self.phase, 0.0) + now - self.last
+        self.phase = name
+        self.last = now
+        if self.label is not None:
+            self.label.__exit__(None, None, None)
+            self.label = None
+        if self.labels:
+            self.label = torch.autograd.profiler.record_function(name)
+            self.label.__enter__()
+
+    def count(self, sequences, tokens):
+        '''Count sequences and tokens processed, for the throughput. tokens can be a device
+           tensor, which is only read in report().'''
+        self.sequences += sequences
+        self.tokens += tokens
+
+    def report(self):
+        '''Returns the throughput and the seconds spent in each phase (as time_<phase>) since the
+           last report.'''
+        self.switch(self.phase)
+        seconds = max(self.last - self.start, 1e-9)
+        report = collections.OrderedDict([('seconds', seconds),
+                                          ('seqs_per_sec', self.sequences / seconds),
+                                          ('tokens_per_sec', float(self.tokens) / seconds)])
+        for name, total in self.totals.items():
+            report['time_' + name] = total
+        self.reset()
+        return report
+
+
+class StallDetector(object):
+    '''Detects when a per-iteration training signal stops improving. The mean of the last window
+       values is compared to the mean of the window before it.'''
+
+    def __init__(self, window, tol, min_iters, increasing=True):
+        self.window = window
+        self.tol = tol
+        self.min_iters = max(min_iters, 2 * window)
+        self.sign = 1 if increasing else -1
+        self.values = []
+
+    def reset(self):
+        self.values = []
+
+    def update(self, value):
+        '''Add the signal of an iteration. Returns True if the signal has stalled.'''
+        self.values.append(self.sign * value)
+        if len(self.values) < self.min_iters:
+            return False
+        recent = np.mean(self.values[-self.window:])
+        previous = np.mean(self.values[-2 * self.window:-self.window])
+        return recent - previous < self.tol * abs(previous)
+
+
+def make_profiler(use_cuda):
+    '''A torch profiler context, recording CUDA activity too if use_cuda is set.'''
+    try:
+        import torch.profiler
+    except ImportError:  # torch < 1.8
+        return torch.autograd.profiler.profile(use_cuda=use_cuda)
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if use_cuda:
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(activities=activities, record_shapes=True)
+
+
+def save_opt(opt, path):
+    '''Save the options of a run as JSON, so that tools like evaluate.py can rebuild its models'''
+    with open(path, 'w') as f:
+        json.dump(vars(opt), f, indent=2, sort_keys=True)
+
+
+def load_opt(path):
+    with open(path, 'r') as f:
+        return argparse.Namespace(**json.load(f))
+
+
+def read_metrics(path):
+    '''Read the records of a MetricsLog file'''
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break  # the last line may still be being written
+    return records
+
+
 def gradient_norm(parameters, norm_type=2):
     # remove this method once pytorch is updated, clip_grad_norn will return the original total norm
     parameters = list(filter(lambda p: p.grad is not None, parameters))
@@ -88,12 +602,97 @@ def gradient_norm(parameters, norm_type=2):
     else:
         total_norm = 0
         for p in parameters:
-            param_norm = p.grad.data.norm(norm_type)
+            param_norm = float(p.grad.data.norm(norm_type))
             total_norm += param_norm ** norm_type
         total_norm = total_norm ** (1. / norm_type)
     return total_norm
 
 
+NGRAM_PRIME = np.uint64(1000003)
+
+
+def ngram_hashes(data, n, mask):
+    '''Polynomial hashes of the n-grams of the rows of data, and whether each n-gram lies fully
+       inside mask. Both are [rows, width - n + 1] arrays. The hashes wrap around modulo 2^64.'''
+    data = data.astype(np.uint64) + np.uint64(1)  # so that leading zeros change the hash
+    width = max(data.shape[1] - n + 1, 0)
+    hashes = np.zeros([data.shape[0], width], dtype=np.uint64)
+    valid = np.ones([data.shape[0], width], dtype=bool)
+    for k in xrange(n):
+        hashes = hashes * NGRAM_PRIME + data[:, k:k+width]
+        valid &= mask[:, k:k+width]
+    return hashes, valid
+
+
+def sequence_hashes(data, mask):
+    '''Hashes of the masked contents of the rows of data'''
+    hashes, _ = ngram_hashes(np.where(mask, data, -1), data.shape[1], mask)  # -1 hashes as 0
+    return hashes[:, 0]
+
+
+class NgramIndex(object):
+    '''Sorted unique hashes of the 1..order-grams and whole sequences of a corpus, with their
+       counts, for vectorized lookups of the n-grams of generated batches.'''
+
+    def __init__(self, keys, counts):
+        self.keys = keys  # n -> sorted uint64 hashes. n = 0 for whole sequences
+        self.counts = counts
+        self.order = max(keys)
+
+    @classmethod
+    def build(cls, data, mask, order):
+        keys = {}
+        counts = {}
+        for n in xrange(order + 1):
+            if n == 0:
+                hashes = sequence_hashes(data, mask)[mask.any(1)]
+            else:
+                hashes, valid = ngram_hashes(data, n, mask)
+                hashes = hashes[valid]
+            keys[n], counts[n] = np.unique(hashes, return_counts=True)
+        return cls(keys, counts)
+
+    def save(self, path):
+        arrays = {}
+        for n in self.keys:
+            arrays['keys%d' % n] = self.keys[n]
+            arrays['counts%d' % n] = self.counts[n]
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path)
+        n_values = [int(k[4:]) for k in arrays.files if k.startswith('keys')]
+        return cls({n: arrays['keys%d' % n] for n in n_values},
+                   {n: arrays['counts%d' % n] for n in n_values})
+
+    def lookup(self, n, hashes):
+        '''Corpus counts of the n-grams with the given hashes, 0 for unseen ones'''
+        keys = self.keys[n]
+        if not keys.size:
+            return np.zeros(hashes.shape, dtype=np.int64)
+        idx = np.minimum(np.searchsorted(keys, hashes), keys.size - 1)
+        return np.where(keys[idx] == hashes, self.counts[n][idx], 0)
+
+    def metrics(self, data, mask):
+        '''Precision (fraction seen in the corpus) and diversity (distinct fraction) of the n-grams
+           in the masked part of data, and novelty (fraction of unseen sequences)'''
+        metrics = {}
+        seqs = sequence_hashes(data, mask)
+        if seqs.size:
+            metrics['novelty'] = (self.lookup(0, seqs) == 0).mean()
+        for n in xrange(1, self.order + 1):
+            hashes, valid = ngram_hashes(data, n, mask)
+            hashes = hashes[valid]
+            if hashes.size:
+                metrics['precision%d' % n] = (self.lookup(n, hashes) > 0).mean()
+                metrics['distinct%d' % n] = np.unique(hashes).size / hashes.size
+        return metrics
+
+
 class Task(object):
     def __init__(self, seq_len, vocab_size, inf_horizon=True):
         self.seq_len = seq_len
@@ -104,18 +703,74 @@ class Task(object):
         '''Get a batch of data'''
         raise NotImplementedError
 
+    def shuffle(self):
+        '''Start a new randomly ordered pass over the training data, if the task has any'''
+        pass
+
+    def share_memory(self):
+        '''Move the training data, if any, to shared memory for use by forked processes'''
+        pass
+
+    def state_dict(self):
+        '''Position in the training data, for resuming training'''
+        return {}
+
+    def load_state_dict(self, state):
+        pass
+
     def solved(self, data):
         '''Return true if the task has been solved, according to data'''
         return False
 
+    def iterate(self, split, batch_size, max_batches=0):
+        '''Iterate over batches of held-out data. Generated tasks have no fixed splits, so fresh
+           batches are held out by construction. At least one batch is generated.'''
+        for _ in xrange(max(max_batches, 1)):
+            yield self.get_data(batch_size)
+
+    def quality(self, data):
+        '''Return a dict of sample quality metrics of the generated sequences in data'''
+        return {}
+
+    def format(self, data):
+        '''Format each sequence in data as a string'''
+        return [' '.join(str(w) for w in s) for s in data]
+
     def display(self, data):
         print(data)
 
 
 class LMTask(Task):
-    def __init__(self, seq_len, vocab_size, data_dir, char_model, word_vocab, single_word):
+    ngram_order = 4
+
+    def __init__(self, seq_len, vocab_size, data_dir, char_model, word_vocab, single_word,
+                 cache=False):
         super(LMTask, self).__init__(seq_len, vocab_size)
         self.data_dir = data_dir
+        cache_file = self.cache_path(seq_len, vocab_size, data_dir, char_model, word_vocab,
+                                     single_word)
+        if cache and os.path.exists(cache_file):
+            self.load_cache(cache_file)
+            print('Loaded tokenized corpus from', cache_file)
+        else:
+            self.build(vocab_size, char_model, word_vocab, single_word)
+            if cache:
+                self.save_cache(cache_file)
+        self.cache = cache
+        self.cache_file = cache_file
+        self.bucket_batch_size = 0
+        self.bucket_batches = 0
+        self.ngrams = None
+        self.char_model = char_model
+        self.single_word = single_word
+        self.trunc_word_set = set(w[:seq_len] for w in self.word_set)
+        assert len(self.trunc_word_set) <= len(self.word_set)
+        self.prefix_word_sets = {}  # by length, for the shorter sequences of a curriculum
+        self.vocab_size = len(self.idx2word)
+        self.shuffle()
+
+    def build(self, vocab_size, char_model, word_vocab, single_word):
+        '''Make the vocab and tokenize all splits into padded arrays'''
         self.single_word = False
         self.word_set = None
         if char_model:
@@ -130,15 +785,55 @@ class LMTask(Task):
             self.char_model = False
             self.make_vocab()
             self.word_set = set(self.idx2word)
-        self.trunc_word_set = set(w[:seq_len] for w in self.word_set)
-        assert len(self.trunc_word_set) <= len(self.word_set)
         self.single_word = single_word
         self.splits = {}
+        self.lengths = {}
         for s in ['train', 'valid', 'test']:
-            self.splits[s] = self.tokenize(os.path.join(data_dir, s + '.txt'))
-        random.shuffle(self.splits['train'])
-        self.vocab_size = len(self.idx2word)
-        self.current = 0
+            sents = self.tokenize(os.path.join(self.data_dir, s + '.txt'))
+            self.splits[s], self.lengths[s] = self.pad_sents(sents)
+
+    def save_cache(self, path):
+        arrays = {'idx2word': np.array(self.idx2word),
+                  'counts': np.array([self.word_counts[w] for w in self.idx2word]),
+                  'word_set': np.array(sorted(self.word_set))}
+        for s in self.splits:
+            arrays[s] = self.splits[s]
+            arrays[s + '_lengths'] = self.lengths[s]
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(tmp_path, path)  # atomic, so concurrent runs never see a partial cache
+        print('Saved tokenized corpus to', path)
+
+    @staticmethod
+    def cache_path(seq_len, vocab_size, data_dir, char_model, word_vocab, single_word):
+        '''The tokenized corpus cache file for the arguments of LMTask'''
+        return os.path.join(data_dir, 'cache-c%d-v%d-w%d-s%d-l%d.npz' %
+                            (char_model, vocab_size, word_vocab, single_word, seq_len))
+
+    @staticmethod
+    def load_vocab(path):
+        '''Only the vocab (idx2word) of the cache file at path, without loading the splits'''
+        with np.load(path) as cache:
+            return [str(w) for w in cache['idx2word']]
+
+    def load_cache(self, path):
+        '''Load the vocab and splits saved by save_cache. word_counts only covers the vocab.'''
+        cache = np.load(path)
+        self.idx2word = [str(w) for w in cache['idx2word']]
+        self.word2idx = {w: i for i, w in enumerate(self.idx2word)}
+        self.word_counts = collections.Counter(dict(zip(self.idx2word, cache['counts'])))
+        self.word_set = set(str(w) for w in cache['word_set'])
+        self.splits = {}
+        self.lengths = {}
+        for s in ['train', 'valid', 'test']:
+            self.splits[s] = cache[s]
+            self.lengths[s] = cache[s + '_lengths']
+
+    def share_memory(self):
+        for s in self.splits:
+            self.splits[s] = shared_array(self.splits[s])
+            self.lengths[s] = shared_array(self.lengths[s])
 
     def make_vocab(self):
         self.word_counts = collections.Counter()
@@ -202,58 +897,163 @@ class LMTask(Task):
             ret.append(ids)
         return ret
 
+    def pad_sents(self, sents):
+        '''Pack a list of sentences into a <p>-padded array, returned with the sentence lengths'''
+        lengths = np.array([len(s) for s in sents], dtype=np.int64)
+        if self.seq_len > 0:
+            width = self.seq_len
+        else:
+            width = max(lengths.max(), 1)
+        batch = np.ones([len(sents), width], dtype=np.int64) * self.word2idx['<p>']
+        for i, s in enumerate(sents):
+            batch[i, :len(s)] = s
+        return batch, lengths
+
+    def set_bucketing(self, batch_size, bucket_batches):
+        '''Make the batches of get_data(batch_size) hold sequences of similar length. Lengths are
+           sorted within buckets of bucket_batches batches, then the batches are shuffled.'''
+        self.bucket_batch_size = batch_size
+        self.bucket_batches = bucket_batches
+        self.shuffle()
+
+    def shuffle(self):
+        order = np.random.permutation(self.splits['train'].shape[0])
+        if self.bucket_batches > 0:
+            lengths = self.lengths['train']
+            bucket = self.bucket_batch_size * self.bucket_batches
+            for start in xrange(0, len(order), bucket):
+                rows = order[start:start+bucket]
+                order[start:start+bucket] = rows[np.argsort(lengths[rows], kind='mergesort')]
+            num_batches = len(order) // self.bucket_batch_size
+            batched = num_batches * self.bucket_batch_size
+            batches = order[:batched].reshape(num_batches, self.bucket_batch_size)
+            order = np.concatenate([batches[np.random.permutation(num_batches)].reshape(-1),
+                                    order[batched:]])
+        self.order = order
+        self.current = 0
+
+    def state_dict(self):
+        return {'order': self.order.copy(), 'current': self.current}
+
+    def load_state_dict(self, state):
+        self.order = state['order']
+        self.current = state['current']
+
     def get_data(self, batch_size):
         data = self.splits['train']
-        assert len(data) >= batch_size
-        pad_index = self.word2idx['<p>']
-        if self.current + batch_size > len(data):
-            self.current = 0
-            random.shuffle(data)
-        data = data[self.current:self.current+batch_size]
+        assert data.shape[0] >= batch_size
+        if (self.bucket_batches > 0 and batch_size == self.bucket_batch_size and
+                self.current % batch_size):
+            # rows were taken in a batch of another size, like the real row of main.py's debug
+            # output. skip to the next bucketed batch, so batches do not span two of them
+            self.current += batch_size - self.current % batch_size
+        if self.current + batch_size > data.shape[0]:
+            self.shuffle()
+        indices = self.order[self.current:self.current+batch_size]
         self.current += batch_size
-        batch = np.ones([batch_size, self.seq_len], dtype=np.int) * pad_index
-        for i, s in enumerate(data):
-            batch[i, :len(s)] = s
-        return batch
+        return data[indices]
+
+    def iterate(self, split, batch_size, max_batches=0):
+        '''Iterate over the split in order, in batches. max_batches > 0 limits the number of
+           batches. The last batch can be smaller.'''
+        data = self.splits[split]
+        for i, start in enumerate(xrange(0, data.shape[0], batch_size)):
+            if max_batches > 0 and i >= max_batches:
+                break
+            yield data[start:start+batch_size]
+
+    def format(self, data):
+        if self.char_model:
+            sep = ''
+        else:
+            sep = ' '
+        return [sep.join(self.idx2word[w] for w in s) for s in data]
 
     def display(self, data):
         print(data)
-        for s in data:
-            if self.char_model:
-                end = ''
-            else:
-                end = ' '
-            print('=>', end=' ')
-            for w in s:
-                print(self.idx2word[w], end=end)
-            print()
+        print('\n'.join('=> ' + s for s in self.format(data)))
 
     def solved(self, data):
         if self.single_word:
-            fail = 0
-            succ = 0
-            for dword in data:
-                chars = [self.idx2word[d] for d in dword]
-                strip = 0
-                idx = len(chars) - 1
-                while idx >= 0:
-                    if chars[idx] != '<p>':
-                        break
-                    idx -= 1
-                if idx != len(chars) - 1 and chars[idx] != '<e>':
-                    fail += 1
-                    continue
-                if chars[idx] == '<e>':
-                    idx -= 1
-                word = ''.join(chars[:idx+1])
-                if word in self.trunc_word_set:
-                    succ += 1
-                else:
-                    fail += 1
-            if succ / (succ + fail) > 0.75:
+            if self.word_accuracy(data) > 0.75:
                 return True
         return False
 
+    def quality(self, data):
+        metrics = self.ngram_index().metrics(data, self.token_mask(data))
+        if self.single_word:
+            metrics['word_acc'] = self.word_accuracy(data)
+        return metrics
+
+    def frequency_cutoffs(self, masses):
+        '''Vocab indices at which the given fractions of the word frequency mass are covered. The
+           vocab is sorted by frequency, with the special tokens first.'''
+        counts = np.array([self.word_counts[w] for w in self.idx2word], dtype=np.float64)
+        counts[np.isinf(counts)] = 0  # special tokens
+        mass = np.cumsum(counts) / max(counts.sum(), 1)
+        cutoffs = []
+        for m in masses:
+            cutoff = int(np.searchsorted(mass, m)) + 1
+            if cutoffs and cutoff <= cutoffs[-1]:
+                continue
+            if cutoff >= self.vocab_size:
+                break
+            cutoffs.append(cutoff)
+        return cutoffs
+
+    def token_mask(self, data):
+        '''True for the tokens of data up to and including the first <e>, except for padding'''
+        ends = data == self.word2idx['<e>']
+        after_end = (np.cumsum(ends, 1) - ends) > 0
+        return (data != self.word2idx['<p>']) & ~after_end
+
+    def ngram_index(self):
+        '''The n-gram index of the training split, saved next to the corpus cache'''
+        if self.ngrams is None:
+            path = self.cache_file[:-len('.npz')] + '-ngrams%d.npz' % self.ngram_order
+            if self.cache and os.path.exists(path):
+                self.ngrams = NgramIndex.load(path)
+            else:
+                data = self.splits['train']
+                self.ngrams = NgramIndex.build(data, self.token_mask(data), self.ngram_order)
+                if self.cache:
+                    self.ngrams.save(path)
+                    print('Saved n-gram index to', path)
+        return self.ngrams
+
+    def word_accuracy(self, data):
+        '''Fraction of the single word sequences in data that are (truncated) vocabulary words.
+           Sequences shorter than seq_len are checked against the words truncated to their
+           length.'''
+        if data.shape[1] < self.seq_len:
+            if data.shape[1] not in self.prefix_word_sets:
+                self.prefix_word_sets[data.shape[1]] = set(w[:data.shape[1]]
+                                                           for w in self.word_set)
+            word_set = self.prefix_word_sets[data.shape[1]]
+        else:
+            word_set = self.trunc_word_set
+        fail = 0
+        succ = 0
+        for dword in data:
+            chars = [self.idx2word[d] for d in dword]
+            strip = 0
+            idx = len(chars) - 1
+            while idx >= 0:
+                if chars[idx] != '<p>':
+                    break
+                idx -= 1
+            if idx != len(chars) - 1 and chars[idx] != '<e>':
+                fail += 1
+                continue
+            if chars[idx] == '<e>':
+                idx -= 1
+            word = ''.join(chars[:idx+1])
+            if word in word_set:
+                succ += 1
+            else:
+                fail += 1
+        return succ / max(succ + fail, 1)
+
 
 class WordsTask(Task):
     def __init__(self, seq_len, vocab_size):
@@ -293,11 +1093,11 @@ class LongtermTask(Task):
         return batch
 
     def solved(self, avgprobs):
-        # avgprobs size: (seq_len, vocab_size)
-        assert avgprobs.shape[0] == self.seq_len
+        # avgprobs size: (seq_len, vocab_size), or shorter for a prefix of the sequences
+        assert avgprobs.shape[0] <= self.seq_len
         indices = set([int(0.33 * self.seq_len), int(0.8 * self.seq_len)])
         half_indices = set([int(0.5 * self.seq_len)])
-        for i in xrange(self.seq_len):
+        for i in xrange(avgprobs.shape[0]):
             probs = avgprobs[i]
             if i in indices:
                 if probs[0] > min(0.05, 1 / (2 * self.vocab_size)):
@@ -347,4 +1147,4 @@ def verify_graph_desc(fn):
     result = graph_desc(fn, S)
     print('Ops used:', S)
     if 'Error' in result:
-        raise ValueError, result
+        raise ValueError(result)